@@ -0,0 +1,297 @@
+"""
+Benchmarks the GCM and APNS senders against the local stand-in servers
+of benchmarks.servers, entirely offline:
+
+    python -m benchmarks.run --devices 1000,100000 --scenarios gcm,apns
+
+Every scenario runs once per device count in a fresh process, and the
+servers in processes of their own, so the CPU time and memory reported
+are those of the sender alone. Latency percentiles come from the
+instapush metrics of the run.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from .servers import generate_certificate, serve
+
+
+## the timing whose percentiles are reported for each server kind,
+## the feedback service reads a single stream
+LATENCY_METRICS = {
+    "gcm": "gcm.request",
+    "apns": "apns.write",
+    "http2": "apns.http2.stream",
+    "feedback": None,
+}
+
+
+def gcm_ids(count):
+    return ["benchmark-%d" % index for index in range(count)]
+
+
+def apns_tokens(count):
+    return ["%064x" % index for index in range(count)]
+
+
+def create_devices(model, registration_ids, batch_size=10000):
+    for offset in range(0, len(registration_ids), batch_size):
+        model.objects.bulk_create([model(registration_id=registration_id)
+            for registration_id in registration_ids[offset:offset + batch_size]])
+
+
+def prepare_gcm(devices, options):
+    from instapush.libs.gcm import gcm_send_bulk_message
+    ids = gcm_ids(devices)
+    return lambda: gcm_send_bulk_message(ids, {"message": "benchmark"},
+            concurrency=options.concurrency)
+
+
+def prepare_gcm_queryset(devices, options):
+    from instapush.models.base import GCMDevice
+    create_devices(GCMDevice, gcm_ids(devices))
+    return lambda: GCMDevice.objects.filter(active=True).send_message(
+            "benchmark", concurrency=options.concurrency)
+
+
+def prepare_apns(devices, options):
+    from instapush.libs.apns import apns_send_bulk_message
+    tokens = apns_tokens(devices)
+    return lambda: apns_send_bulk_message(tokens, "benchmark")
+
+
+def prepare_apns_queryset(devices, options):
+    from instapush.models.base import APNSDevice
+    create_devices(APNSDevice, apns_tokens(devices))
+    return lambda: APNSDevice.objects.filter(active=True).send_message(
+            "benchmark")
+
+
+def prepare_apns_feedback(devices, options):
+    from instapush.libs.apns import apns_fetch_inactive_ids
+    return apns_fetch_inactive_ids
+
+
+## name: (server kind, apns backend, prepare function)
+SCENARIOS = OrderedDict([
+    ("gcm", ("gcm", None, prepare_gcm)),
+    ("gcm-queryset", ("gcm", None, prepare_gcm_queryset)),
+    ("apns", ("apns", "binary", prepare_apns)),
+    ("apns-queryset", ("apns", "binary", prepare_apns_queryset)),
+    ("apns-http2", ("http2", "http2", prepare_apns)),
+    ("apns-http2-queryset", ("http2", "http2", prepare_apns_queryset)),
+    ("apns-feedback", ("feedback", None, prepare_apns_feedback)),
+])
+
+
+def configure(kind, backend, port, certs):
+    """
+    Points the instapush settings at the server of kind
+    """
+
+    from instapush.settings import INSTAPUSH_SETTINGS as settings
+
+    certfile, keyfile, pemfile = certs
+    settings["GCM_SETTINGS"]["API_URL"] = "http://127.0.0.1:%d/send" % port
+    settings["APNS_SETTINGS"].update({
+        "APNS_CERTIFICATE": pemfile,
+        "APNS_CA_CERTIFICATES": certfile,
+        "PORT": port,
+        "HTTP2_PORT": port,
+        "FEEDBACK_PORT": port,
+    })
+    if backend is not None:
+        settings["APNS_SETTINGS"]["BACKEND"] = backend
+
+
+def count_failed(result):
+    """
+    Returns the number of devices a send function reported as failed
+    """
+
+    if hasattr(result, "failure"):
+        return result.failure
+    if isinstance(result, dict):
+        return result.get("failure", len(result))
+    if isinstance(result, list):
+        return len(result)
+    return 0
+
+
+def rss():
+    """
+    Returns the peak resident memory of the process in MB
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## kilobytes on linux, bytes on macOS
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024.0
+
+
+def run_scenario(name, devices, options, certs, port, database, results):
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.settings"
+    os.environ["INSTAPUSH_BENCHMARK_DB"] = database
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    from instapush.metrics import get_metrics
+
+    call_command("migrate", run_syncdb=True, verbosity=0)
+
+    kind, backend, prepare = SCENARIOS[name]
+    configure(kind, backend, port, certs)
+    send = prepare(devices, options)
+
+    metrics = get_metrics()
+    metrics.reset()
+    rss_before = rss()
+    cpu = time.process_time()
+    started = time.time()
+
+    result = send()
+
+    seconds = time.time() - started
+    cpu = time.process_time() - cpu
+
+    snapshot = metrics.snapshot()
+    results.send({
+        "scenario": name,
+        "devices": devices,
+        "seconds": seconds,
+        "throughput": devices / seconds if seconds else None,
+        "cpu_seconds": cpu,
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": rss(),
+        "latency_metric": LATENCY_METRICS[kind],
+        "latency": snapshot["histograms"].get(LATENCY_METRICS[kind], {}),
+        "failed": count_failed(result),
+        "counters": snapshot["counters"],
+    })
+
+
+def run(name, devices, options, certs, directory):
+    kind = SCENARIOS[name][0]
+    server_options = {
+        "certfile": certs[0],
+        "keyfile": certs[1],
+        "latency": options.latency,
+        "error_rate": options.error_rate,
+        "unavailable_rate": options.unavailable_rate,
+        "throttle": options.throttle,
+        "max_streams": options.max_streams,
+        "count": devices,
+    }
+
+    pipe, server_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve,
+            args=(kind, server_options, server_pipe))
+    server.daemon = True
+    server.start()
+    port = pipe.recv()
+
+    database = os.path.join(directory, "%s-%d.sqlite3" % (name, devices))
+    results, client_pipe = multiprocessing.Pipe(duplex=False)
+    client = multiprocessing.Process(target=run_scenario, args=(name, devices,
+        options, certs, port, database, client_pipe))
+    client.start()
+    client_pipe.close()
+
+    try:
+        result = results.recv()
+    except EOFError:
+        result = None
+    client.join()
+
+    pipe.send("stop")
+    server_stats = pipe.recv()
+    server.join()
+    if os.path.exists(database):
+        os.remove(database)
+
+    if result is None:
+        return {"scenario": name, "devices": devices, "error": "exit code %s"
+                % client.exitcode}
+
+    result["server"] = server_stats
+    return result
+
+
+def report(result):
+    if "error" in result:
+        print("%-20s %9d  failed with %s" % (result["scenario"],
+            result["devices"], result["error"]))
+        return
+
+    latency = result["latency"]
+    print("%-20s %9d %9.2fs %11.0f/s %8.2fs %8.1fMB %8s %8s %8s %8d" % (
+        result["scenario"], result["devices"], result["seconds"],
+        result["throughput"] or 0, result["cpu_seconds"],
+        result["peak_rss_mb"],
+        "%.1fms" % (latency["p50"] * 1000) if latency else "-",
+        "%.1fms" % (latency["p95"] * 1000) if latency else "-",
+        "%.1fms" % (latency["p99"] * 1000) if latency else "-",
+        result["failed"]))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--devices", default="1000,100000,1000000",
+            help="comma separated device counts to run each scenario with")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+            help="comma separated scenarios among %s" % ", ".join(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0,
+            help="seconds the servers take to answer a request")
+    parser.add_argument("--error-rate", type=float, default=0.001,
+            help="fraction of registration ids the servers reject")
+    parser.add_argument("--unavailable-rate", type=float, default=0,
+            help="fraction of GCM results that are Unavailable")
+    parser.add_argument("--throttle", type=float, default=None,
+            help="messages per second above which the servers throttle")
+    parser.add_argument("--concurrency", type=int, default=4,
+            help="GCM requests in flight at once")
+    parser.add_argument("--max-streams", type=int, default=1000,
+            help="concurrent streams the HTTP/2 server accepts")
+    parser.add_argument("--json", help="file to write the results to")
+    options = parser.parse_args(argv)
+
+    scenarios = options.scenarios.split(",")
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario %r" % name)
+
+    directory = tempfile.mkdtemp()
+    try:
+        certs = generate_certificate(directory)
+
+        print("%-20s %9s %10s %13s %9s %10s %8s %8s %8s %8s" % ("scenario",
+            "devices", "time", "throughput", "cpu", "peak rss", "p50",
+            "p95", "p99", "failed"))
+        results = []
+        for name in scenarios:
+            for devices in options.devices.split(","):
+                result = run(name, int(devices), options, certs, directory)
+                report(result)
+                results.append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    if options.json:
+        with open(options.json, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
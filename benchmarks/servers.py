@@ -0,0 +1,449 @@
+"""
+Local stand-ins for the GCM and APNS services, for benchmarking
+without network access. Every server runs in threads of the process
+that started it; ``serve`` runs one in a process of its own so that
+its CPU time does not count against the client being measured.
+
+Error injection is deterministic per registration id, so a rejected id
+is rejected again when it is resent, as it would be by the real
+services.
+"""
+
+import gzip
+import heapq
+import json
+import os
+import random
+import select
+import socket
+import ssl
+import struct
+import subprocess
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def generate_certificate(directory):
+    """
+    Creates a self signed certificate for localhost in directory and
+    returns the paths of (certfile, keyfile, pemfile), pemfile holding
+    both as the APNS_CERTIFICATE setting expects
+    """
+
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    pemfile = os.path.join(directory, "apns.pem")
+
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+        "-nodes", "-keyout", keyfile, "-out", certfile, "-days", "1",
+        "-subj", "/CN=localhost",
+        "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    ## instapush only accepts traditional RSA keys, which OpenSSL 3
+    ## only writes when asked to
+    rsa_key = subprocess.check_output(["openssl", "rsa", "-in", keyfile,
+        "-traditional"], stderr=subprocess.DEVNULL)
+
+    with open(pemfile, "wb") as pem:
+        with open(certfile, "rb") as cert:
+            pem.write(cert.read())
+        pem.write(rsa_key)
+
+    return certfile, keyfile, pemfile
+
+
+def is_rejected(registration_id, rate):
+    """
+    Returns whether the servers reject registration_id when rejecting
+    the given fraction of ids
+    """
+
+    if not rate:
+        return False
+    checksum = zlib.crc32(registration_id.encode("utf-8")) & 0xffffffff
+    return checksum % 100000 < rate * 100000
+
+
+class Throttle(object):
+    """
+    Admits at most ``rate`` messages per second, or any number if
+    rate is None
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._tokens = rate or 0
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def admit(self, count=1):
+        if not self.rate:
+            return True
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate,
+                    self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < count:
+                return False
+            self._tokens -= count
+            return True
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+class GCMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+
+        server.stats.add("requests")
+        if server.latency:
+            time.sleep(server.latency)
+
+        if self.headers["Content-Type"].startswith("application/json"):
+            ids = json.loads(body.decode("utf-8"))["registration_ids"]
+        else:
+            ids = parse_qs(body.decode("utf-8"))["registration_id"]
+
+        if not server.throttle.admit(len(ids)):
+            server.stats.add("throttled", len(ids))
+            return self.respond(429, b"", {"Retry-After": "1"})
+
+        results = []
+        for registration_id in ids:
+            if is_rejected(registration_id, server.error_rate):
+                results.append({"error": "NotRegistered"})
+            elif server.unavailable_rate and \
+                    server.random() < server.unavailable_rate:
+                results.append({"error": "Unavailable"})
+            else:
+                results.append({"message_id": "0:%d" % server.next_id()})
+        server.stats.add("messages", len(ids))
+
+        if not self.headers["Content-Type"].startswith("application/json"):
+            result = results[0]
+            text = "Error=%s" % result["error"] if "error" in result \
+                    else "id=%s" % result["message_id"]
+            return self.respond(200, text.encode("utf-8"))
+
+        failure = len([result for result in results if "error" in result])
+        self.respond(200, json.dumps({
+            "multicast_id": server.next_id(),
+            "success": len(results) - failure,
+            "failure": failure,
+            "canonical_ids": 0,
+            "results": results,
+        }).encode("utf-8"), {"Content-Type": "application/json"})
+
+    def respond(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGCMServer(ThreadingHTTPServer):
+    """
+    Answers GCM json and plain text requests. ``error_rate`` of the ids
+    are NotRegistered, ``unavailable_rate`` of the results are randomly
+    Unavailable and requests above ``throttle`` messages per second get
+    a 429 response.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0, error_rate=0, unavailable_rate=0,
+            throttle=None, **kwargs):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), GCMHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unavailable_rate = unavailable_rate
+        self.throttle = Throttle(throttle)
+        self.stats = Stats()
+        self._id = 0
+        self._id_lock = threading.Lock()
+        self.random = random.Random(0).random
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def next_id(self):
+        with self._id_lock:
+            self._id += 1
+            return self._id
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class TLSServer(object):
+    """
+    Accepts TLS connections and handles each in a thread of its own
+    """
+
+    def __init__(self, certfile, keyfile, alpn_protocols=None):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile, keyfile)
+        if alpn_protocols:
+            self.context.set_alpn_protocols(alpn_protocols)
+
+        self.socket = socket.socket()
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(128)
+        self.port = self.socket.getsockname()[1]
+        self.stats = Stats()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        while True:
+            connection, _ = self.socket.accept()
+            thread = threading.Thread(target=self._handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, connection):
+        try:
+            connection = self.context.wrap_socket(connection, server_side=True)
+        except (ssl.SSLError, OSError):
+            connection.close()
+            return
+
+        self.stats.add("connections")
+        try:
+            self.handle(connection)
+        except (ssl.SSLError, OSError):
+            pass
+        finally:
+            connection.close()
+
+
+class FakeAPNSServer(TLSServer):
+    """
+    Speaks the binary APNS protocol. Frames to ``error_rate`` of the
+    tokens get an invalid token error response after ``latency``
+    seconds, and the connection is closed as APNS does. Connections
+    writing more than ``throttle`` frames per second are dropped
+    without an error response, which is how APNS sheds load.
+    """
+
+    def __init__(self, certfile, keyfile, latency=0, error_rate=0,
+            throttle=None, **kwargs):
+        super(FakeAPNSServer, self).__init__(certfile, keyfile)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = Throttle(throttle)
+
+    def handle(self, connection):
+        header = struct.Struct("!BI")
+        buffered = b""
+
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                return
+            buffered += data
+
+            offset = 0
+            while len(buffered) - offset >= header.size:
+                command, length = header.unpack_from(buffered, offset)
+                end = offset + header.size + length
+                if len(buffered) < end:
+                    break
+                items = self._items(buffered[offset + header.size:end])
+                offset = end
+
+                if not self.throttle.admit():
+                    self.stats.add("throttled")
+                    return
+
+                token = items[1].hex()
+                identifier = struct.unpack("!I", items[3])[0]
+                if is_rejected(token, self.error_rate):
+                    self.stats.add("rejected")
+                    if self.latency:
+                        time.sleep(self.latency)
+                    connection.sendall(struct.pack("!BBI", 8, 8, identifier))
+                    self._linger(connection)
+                    return
+
+                self.stats.add("messages")
+                self.stats.add("bytes", len(items[2]))
+            buffered = buffered[offset:]
+
+    def _linger(self, connection):
+        ## closing with unread frames resets the connection, which may
+        ## discard the error response before the client read it
+        connection.settimeout(1)
+        try:
+            while connection.recv(65536):
+                pass
+        except socket.timeout:
+            pass
+
+    def _items(self, frame):
+        items = {}
+        offset = 0
+        while offset < len(frame):
+            item, length = struct.unpack_from("!BH", frame, offset)
+            items[item] = frame[offset + 3:offset + 3 + length]
+            offset += 3 + length
+        return items
+
+
+class FakeFeedbackServer(TLSServer):
+    """
+    Sends ``count`` (timestamp, token) tuples to every connection,
+    in reads of ``chunk_size`` bytes, then closes it
+    """
+
+    def __init__(self, certfile, keyfile, count=1000, chunk_size=4096,
+            **kwargs):
+        super(FakeFeedbackServer, self).__init__(certfile, keyfile)
+        item = struct.Struct("!LH32s")
+        now = int(time.time())
+        self.data = b"".join(item.pack(now, 32, struct.pack("!Q", index) * 4)
+                for index in range(count))
+        self.chunk_size = chunk_size
+
+    def handle(self, connection):
+        for offset in range(0, len(self.data), self.chunk_size):
+            connection.sendall(self.data[offset:offset + self.chunk_size])
+        self.stats.add("messages", len(self.data) // 38)
+
+
+class FakeAPNSHTTP2Server(TLSServer):
+    """
+    Speaks the HTTP/2 provider API, answering each stream ``latency``
+    seconds after it ended. Tokens in ``error_rate`` get a 400
+    BadDeviceToken response and streams above ``throttle`` per second
+    a 429 TooManyRequests one. Requires the ``h2`` package.
+    """
+
+    def __init__(self, certfile, keyfile, latency=0, error_rate=0,
+            throttle=None, max_streams=1000, **kwargs):
+        super(FakeAPNSHTTP2Server, self).__init__(certfile, keyfile, ["h2"])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = Throttle(throttle)
+        self.max_streams = max_streams
+
+    def handle(self, connection):
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.settings
+
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(
+            client_side=False, header_encoding="utf-8"))
+        conn.initiate_connection()
+        conn.update_settings({
+            h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: self.max_streams})
+        connection.sendall(conn.data_to_send())
+
+        paths = {}
+        ## (due, stream_id, status, reason) of the responses to send
+        due = []
+
+        while True:
+            timeout = max(0, due[0][0] - time.time()) if due else None
+            if not connection.pending():
+                readable, _, _ = select.select([connection], [], [], timeout)
+            else:
+                readable = True
+
+            if readable:
+                data = connection.recv(65535)
+                if not data:
+                    return
+                for event in conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        paths[event.stream_id] = dict(event.headers)[":path"]
+                    elif isinstance(event, h2.events.DataReceived):
+                        conn.acknowledge_received_data(
+                                event.flow_controlled_length, event.stream_id)
+                        self.stats.add("bytes", len(event.data))
+                    elif isinstance(event, h2.events.StreamEnded):
+                        token = paths.pop(event.stream_id).rsplit("/", 1)[1]
+                        heapq.heappush(due, (time.time() + self.latency,
+                            event.stream_id) + self._response(token))
+
+            now = time.time()
+            while due and due[0][0] <= now:
+                _, stream_id, status, reason = heapq.heappop(due)
+                if reason is None:
+                    conn.send_headers(stream_id, [(":status", str(status))],
+                            end_stream=True)
+                    continue
+                body = json.dumps({"reason": reason}).encode("utf-8")
+                conn.send_headers(stream_id, [(":status", str(status)),
+                    ("content-length", str(len(body)))])
+                conn.send_data(stream_id, body, end_stream=True)
+
+            data = conn.data_to_send()
+            if data:
+                connection.sendall(data)
+
+    def _response(self, token):
+        if not self.throttle.admit():
+            self.stats.add("throttled")
+            return 429, "TooManyRequests"
+        if is_rejected(token, self.error_rate):
+            self.stats.add("rejected")
+            return 400, "BadDeviceToken"
+        self.stats.add("messages")
+        return 200, None
+
+
+SERVERS = {
+    "gcm": FakeGCMServer,
+    "apns": FakeAPNSServer,
+    "feedback": FakeFeedbackServer,
+    "http2": FakeAPNSHTTP2Server,
+}
+
+
+def serve(kind, options, pipe):
+    """
+    Runs a server of kind until "stop" is received on pipe. Sends the
+    port of the server once it listens and its counters once stopped.
+    """
+
+    server = SERVERS[kind](**options)
+    server.start()
+    pipe.send(server.port)
+
+    pipe.recv()
+    pipe.send(dict(server.stats.counters))
@@ -0,0 +1,43 @@
+"""
+Django settings of the benchmarks. The hosts, ports and certificates
+of the stand-in servers are filled in by the runner.
+"""
+
+import os
+import tempfile
+
+
+SECRET_KEY = "benchmarks"
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "instapush",
+]
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ.get("INSTAPUSH_BENCHMARK_DB",
+            os.path.join(tempfile.gettempdir(), "instapush-benchmark.sqlite3")),
+    },
+}
+
+INSTAPUSH_SETTINGS = {
+    "DEVICE_OWNER_MODEL": "auth.User",
+    "METRICS_BACKEND": "instapush.metrics.MemoryMetrics",
+    "METRICS_OPTIONS": {"max_samples": 100000},
+    "GCM_SETTINGS": {
+        "API_KEY": "benchmark",
+        "DEVICE_MODEL": "instapush.models.base.GCMDevice",
+        "RETRY_BACKOFF": 0.1,
+    },
+    "APNS_SETTINGS": {
+        "HOST": "localhost",
+        "FEEDBACK_HOST": "localhost",
+        "HTTP2_HOST": "localhost",
+        "DEVICE_MODEL": "instapush.models.base.APNSDevice",
+        "ERROR_TIMEOUT": 0.5,
+        "FEEDBACK_TIMEOUT": 1,
+    },
+}
@@ -0,0 +1,202 @@
+"""
+Sends one message to the GCM and APNS devices matching a filter. The
+devices of both platforms are streamed page by page from their models
+(sql or mongo) and sent through the GCM and APNS senders concurrently,
+so a broadcast takes as long as the slowest platform rather than their
+sum.
+"""
+
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from django.utils import six
+
+from .metrics import get_metrics
+from .settings import INSTAPUSH_SETTINGS as settings
+from .utils import get_model
+
+
+PLATFORMS = ('gcm', 'apns')
+
+## the device model used for a platform without a DEVICE_MODEL setting
+DEFAULT_MODELS = {
+    'gcm': 'instapush.models.base.GCMDevice',
+    'apns': 'instapush.models.base.APNSDevice',
+}
+
+
+class PlatformReport(object):
+    """
+    The outcome of the send to the devices of one platform. ``failed``
+    maps the registration ids the provider rejected to their error,
+    ``error`` is the exception that aborted the send, if any.
+    """
+
+    def __init__(self, platform):
+        self.platform = platform
+        self.devices = 0
+        self.failed = {}
+        self.error = None
+        self.duration = 0
+
+    @property
+    def success(self):
+        return self.devices - len(self.failed)
+
+    @property
+    def failure(self):
+        return len(self.failed)
+
+    def count(self, pages):
+        """
+        Yields the pages of registration ids, counting their devices
+        """
+
+        for page in pages:
+            self.devices += len(page)
+            yield page
+
+    def __repr__(self):
+        return "<PlatformReport %s: %d devices, %d failed%s>" % (
+            self.platform, self.devices, self.failure,
+            ", %r" % self.error if self.error is not None else "")
+
+
+class BroadcastResult(dict):
+    """
+    The PlatformReport of each platform a broadcast sent to, by platform
+    """
+
+    @property
+    def devices(self):
+        return sum(report.devices for report in self.values())
+
+    @property
+    def success(self):
+        return sum(report.success for report in self.values())
+
+    @property
+    def failure(self):
+        return sum(report.failure for report in self.values())
+
+    @property
+    def errors(self):
+        return dict((platform, report.error) for platform, report
+                in self.items() if report.error is not None)
+
+
+def get_device_model(platform, model=None):
+    """
+    Returns the device model/document of a platform: model, which may
+    be a dotted path, or else its DEVICE_MODEL setting or the sql model
+    """
+
+    if model is None:
+        model = settings['%s_SETTINGS' % platform.upper()].get(
+                'DEVICE_MODEL') or DEFAULT_MODELS[platform]
+    if isinstance(model, six.string_types):
+        model = get_model(model)
+    return model
+
+
+def _by_app(devices, app_id):
+    if app_id is not None:
+        return [(app_id, devices)]
+    return devices.group_by_app()
+
+
+def _send_gcm(report, devices, message, extra, app_id, options):
+    from .libs.gcm import gcm_send_chunked_message
+
+    data = dict(extra or {})
+    if message is not None:
+        data["message"] = message
+
+    page_size = settings['GCM_SETTINGS']['MAX_RECIPIENTS']
+    for app_id, queryset in _by_app(devices, app_id):
+        result = gcm_send_chunked_message(report.count(
+            queryset.iter_registration_id_pages(page_size)), data=data,
+            app_id=app_id, **options)
+        report.failed.update(result.failed)
+
+
+def _send_apns(report, devices, message, extra, app_id, options):
+    from .libs.apns import apns_send_bulk_message
+
+    if extra:
+        options = dict(options, extra=extra)
+
+    for app_id, queryset in _by_app(devices, app_id):
+        ids = itertools.chain.from_iterable(report.count(
+            queryset.iter_registration_id_pages(settings['PAGE_SIZE'])))
+        report.failed.update(apns_send_bulk_message(registration_ids=ids,
+            alert=message, app_id=app_id, **options))
+
+
+SENDERS = {
+    'gcm': _send_gcm,
+    'apns': _send_apns,
+}
+
+
+def _run(send, report, *args):
+    """
+    Runs the send of a platform in a worker thread, recording the
+    exception it raised in its report rather than aborting the other
+    """
+
+    started = time.time()
+    try:
+        send(report, *args)
+    except Exception as e:
+        report.error = e
+    finally:
+        report.duration = time.time() - started
+        get_metrics().timing("%s.broadcast" % report.platform,
+                report.duration)
+        ## database connections are per thread, close the worker's own
+        for connection in connections.all():
+            connection.close()
+    return report
+
+
+def broadcast(message, extra=None, platforms=PLATFORMS, app_id=None,
+        models=None, gcm_options=None, apns_options=None, **filters):
+    """
+    Sends message to the devices of every platform that match filters,
+    lookups on the device fields such as owner, name or active (which
+    defaults to True), and returns a BroadcastResult.
+
+    GCM devices get {"message": message} updated with extra as data and
+    APNS devices get message as alert and extra as custom payload.
+    gcm_options and apns_options are passed on to the platform's bulk
+    sender, e.g. collapse_key or badge, and models maps platforms to
+    device models/documents replacing those of get_device_model. The
+    devices of each app are sent with its credentials unless app_id is
+    given.
+
+    Every platform is sent from a thread of its own. A platform whose
+    send raised is reported with its error, and does not stop the
+    others.
+    """
+
+    filters.setdefault('active', True)
+    models = models or {}
+    options = {'gcm': gcm_options or {}, 'apns': apns_options or {}}
+
+    result = BroadcastResult()
+    with ThreadPoolExecutor(max_workers=len(platforms) or 1) as executor:
+        futures = []
+        for platform in platforms:
+            devices = get_device_model(platform, models.get(platform)
+                    ).objects.filter(**filters)
+            report = result[platform] = PlatformReport(platform)
+            futures.append(executor.submit(_run, SENDERS[platform], report,
+                devices, message, extra, app_id, options[platform]))
+
+        for future in futures:
+            future.result()
+
+    return result
@@ -0,0 +1,198 @@
+"""
+Resumable sends to large sets of devices. A campaign splits the devices
+matching a filter into shards of consecutive primary keys, per platform
+and app, and queues one job per shard, so the ``instapush_worker``
+processes send the shards in parallel. Each shard checkpoints the last
+device it reached after every page it sent: a shard whose worker died
+is resumed from its checkpoint once its job lease expired, and at most
+the page in flight is sent twice.
+"""
+
+import json
+import time
+
+from django.db.models import Case, Count, F, IntegerField, Sum, When
+from django.utils import six, timezone
+
+from .broadcast import PLATFORMS, get_device_model
+from .metrics import get_metrics
+from .queue import enqueue
+from .settings import INSTAPUSH_SETTINGS as settings
+from .utils import get_model
+
+
+def _models():
+    from .models.campaign import Campaign, CampaignShard
+    return Campaign, CampaignShard
+
+
+def _path(model):
+    return "%s.%s" % (model.__module__, model.__name__)
+
+
+def _text(pk):
+    if pk is None:
+        return None
+    return six.text_type(pk)
+
+
+def start_campaign(message, extra=None, platforms=PLATFORMS, shards=8,
+        app_id=None, models=None, gcm_options=None, apns_options=None,
+        name='', **filters):
+    """
+    Creates a campaign sending message to the devices of every platform
+    that match filters, split into at most shards shards per platform
+    and app, queues its shards and returns it. The arguments are those
+    of instapush.broadcast.broadcast; extra, the options and filters
+    must be json serializable (e.g. owner_id=user.pk rather than
+    owner=user).
+    """
+
+    Campaign, CampaignShard = _models()
+
+    filters.setdefault('active', True)
+    models = models or {}
+    campaign = Campaign.objects.create(name=name, message=message,
+            app_id=app_id, extra=json.dumps(extra or {}), filters=json.dumps(filters),
+            options=json.dumps({'gcm': gcm_options or {},
+                'apns': apns_options or {}}))
+
+    created = []
+    for platform in platforms:
+        model = get_device_model(platform, models.get(platform))
+        devices = model.objects.filter(**filters)
+        groups = [(app_id, devices)] if app_id is not None else \
+                devices.group_by_app()
+
+        for group_app_id, queryset in groups:
+            bounds = [None] + [_text(pk) for pk in
+                    queryset.shard_bounds(shards)] + [None]
+            for start_after, end in zip(bounds, bounds[1:]):
+                created.append(CampaignShard(campaign=campaign,
+                    platform=platform, model=_path(model),
+                    app_id=group_app_id, start_after=start_after, end=end))
+
+    CampaignShard.objects.bulk_create(created)
+    if not created:
+        campaign.finished = timezone.now()
+        campaign.save(update_fields=['finished'])
+
+    resume_campaign(campaign)
+    return campaign
+
+
+def resume_campaign(campaign):
+    """
+    Queues a job for each unfinished shard of a campaign, e.g. after
+    their jobs were buried or lost with the queue. Returns the job ids.
+    """
+
+    Campaign, CampaignShard = _models()
+    shards = CampaignShard.objects.filter(campaign=campaign, done=False)
+    return [enqueue('campaign_send_shard', shard_id=shard_id)
+            for shard_id in shards.values_list('pk', flat=True)]
+
+
+def campaign_progress(campaign):
+    """
+    Returns the number of shards, finished shards, devices sent to and
+    devices that failed of a campaign
+    """
+
+    Campaign, CampaignShard = _models()
+    return CampaignShard.objects.filter(campaign=campaign).aggregate(
+            shards=Count('pk'), done=Sum(Case(When(done=True, then=1),
+                default=0, output_field=IntegerField())),
+            sent=Sum('sent'), failed=Sum('failed'))
+
+
+def _send_gcm_page(ids, message, extra, app_id, options):
+    from .libs.gcm import gcm_send_chunked_message
+
+    data = dict(extra)
+    if message is not None:
+        data["message"] = message
+    return gcm_send_chunked_message([ids], data=data, app_id=app_id,
+            **options).failed
+
+
+def _send_apns_page(ids, message, extra, app_id, options):
+    from .libs.apns import apns_send_bulk_message
+
+    if extra:
+        options = dict(options, extra=extra)
+    return apns_send_bulk_message(registration_ids=ids, alert=message,
+            app_id=app_id, **options)
+
+
+SENDERS = {
+    'gcm': _send_gcm_page,
+    'apns': _send_apns_page,
+}
+
+
+def _page_size(platform):
+    if platform == 'gcm':
+        return settings['GCM_SETTINGS']['MAX_RECIPIENTS']
+    return settings['PAGE_SIZE']
+
+
+def send_shard(shard_id, time_limit=None):
+    """
+    Sends a campaign shard page by page from its checkpoint, recording
+    the checkpoint after every page. The queued task of campaigns: a
+    shard still unfinished after time_limit seconds, half the queue
+    LEASE by default, is queued again rather than outliving its lease.
+    """
+
+    Campaign, CampaignShard = _models()
+    shard = CampaignShard.objects.select_related('campaign').get(pk=shard_id)
+    if shard.done:
+        return
+
+    if time_limit is None:
+        time_limit = settings['QUEUE_SETTINGS']['LEASE'] / 2.0
+
+    campaign = shard.campaign
+    extra = json.loads(campaign.extra)
+    options = json.loads(campaign.options)[shard.platform]
+    send = SENDERS[shard.platform]
+
+    devices = get_model(shard.model).objects.filter(
+            **json.loads(campaign.filters))
+    ## without an app_id the devices of each app are sharded apart
+    if campaign.app_id is None:
+        devices = devices.filter(app_id=shard.app_id)
+    if shard.end is not None:
+        devices = devices.filter(pk__lte=shard.end)
+
+    started = time.time()
+    checkpoint = shard.checkpoint or shard.start_after
+    for page in devices.iter_device_pages(_page_size(shard.platform),
+            after=checkpoint):
+        failed = send([registration_id for _, registration_id in page],
+                campaign.message, extra, shard.app_id, options)
+
+        last = _text(page[-1][0])
+        ## a shard is only advanced from the checkpoint it was read at,
+        ## a worker that lost the shard to another one stops here
+        advanced = CampaignShard.objects.filter(pk=shard.pk,
+                checkpoint=shard.checkpoint).update(checkpoint=last,
+                sent=F('sent') + len(page), failed=F('failed') + len(failed),
+                updated=timezone.now())
+        if not advanced:
+            return
+
+        shard.checkpoint = last
+        get_metrics().increment("%s.campaign.sent" % shard.platform,
+                len(page))
+        if time.time() - started > time_limit:
+            enqueue('campaign_send_shard', shard_id=shard.pk)
+            return
+
+    CampaignShard.objects.filter(pk=shard.pk).update(done=True,
+            updated=timezone.now())
+    if not CampaignShard.objects.filter(campaign=campaign,
+            done=False).exists():
+        Campaign.objects.filter(pk=campaign.pk, finished=None).update(
+                finished=timezone.now())
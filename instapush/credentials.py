@@ -0,0 +1,162 @@
+"""
+A registry of the credentials of every app sending through instapush.
+Apps are defined under INSTAPUSH_SETTINGS['APPS'] or registered at
+runtime, and each owns its own GCM session and APNS connection pools.
+Those are created the first time the app sends and are closed again
+when the app is evicted as one of the least recently used, without
+interrupting the sends still using them.
+"""
+
+import collections
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import INSTAPUSH_SETTINGS as settings
+
+
+class AppCredentials(object):
+    """
+    The settings and transports of one app. Its settings are the
+    global GCM_SETTINGS and APNS_SETTINGS updated with the app's own.
+    """
+
+    def __init__(self, app_id, gcm_settings=None, apns_settings=None):
+        self.app_id = app_id
+        self.gcm_settings = dict(settings['GCM_SETTINGS'], **(gcm_settings or {}))
+        self.apns_settings = dict(settings['APNS_SETTINGS'],
+                **(apns_settings or {}))
+        self._gcm_session = None
+        self._apns_pools = {}
+        self._lock = threading.Lock()
+
+    @property
+    def gcm_session(self):
+        with self._lock:
+            if self._gcm_session is None:
+                from .libs.gcm import create_session
+                self._gcm_session = create_session(self.gcm_settings['POOL_SIZE'])
+        return self._gcm_session
+
+    def apns_pool(self, connection_class=None):
+        """
+        Returns the app's pool of connections of connection_class
+        """
+
+        from .libs.apns import APNSConnection, APNSConnectionPool
+        connection_class = connection_class or APNSConnection
+
+        with self._lock:
+            pool = self._apns_pools.get(connection_class)
+            if pool is None:
+                pool = self._apns_pools[connection_class] = APNSConnectionPool(
+                        connection_class, self.apns_settings)
+        return pool
+
+    def close(self):
+        """
+        Closes the idle connections of the app. Connections still in use
+        are closed once released: urllib3 closes those returned to the
+        closed session's pools, and the APNS pools close theirs.
+        """
+
+        with self._lock:
+            session, self._gcm_session = self._gcm_session, None
+            pools, self._apns_pools = self._apns_pools, {}
+
+        if session is not None:
+            session.close()
+        for pool in pools.values():
+            pool.close()
+
+
+class CredentialRegistry(object):
+    """
+    Holds the credentials of apps by app id, keeping at most max_size
+    of them with their transports alive
+    """
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._definitions = {}
+        self._apps = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return self._max_size or settings['MAX_CACHED_APPS']
+
+    def register(self, app_id, gcm_settings=None, apns_settings=None):
+        """
+        Defines or redefines the GCM and APNS settings of an app
+        """
+
+        with self._lock:
+            self._definitions[app_id] = {
+                'GCM_SETTINGS': gcm_settings or {},
+                'APNS_SETTINGS': apns_settings or {},
+            }
+            app = self._apps.pop(app_id, None)
+
+        if app is not None:
+            app.close()
+
+    def get(self, app_id):
+        evicted = None
+
+        with self._lock:
+            app = self._apps.pop(app_id, None)
+            if app is None:
+                definition = self._definitions.get(app_id) or \
+                        settings['APPS'].get(app_id)
+                if definition is None:
+                    raise ImproperlyConfigured("No instapush app is "\
+                            "registered as %r" % app_id)
+                app = AppCredentials(app_id, definition.get('GCM_SETTINGS'),
+                        definition.get('APNS_SETTINGS'))
+
+                if len(self._apps) >= self.max_size:
+                    evicted = self._apps.popitem(last=False)[1]
+
+            ## the most recently used app is kept last
+            self._apps[app_id] = app
+
+        if evicted is not None:
+            evicted.close()
+        return app
+
+    def clear(self):
+        with self._lock:
+            apps, self._apps = self._apps, collections.OrderedDict()
+
+        for app in apps.values():
+            app.close()
+
+
+registry = CredentialRegistry()
+
+## apps loaded from the previous settings are built again on first use
+settings.on_reload(registry.clear)
+
+
+def get_app(app_id):
+    """
+    Returns the AppCredentials of app_id
+    """
+
+    return registry.get(app_id)
+
+
+def get_provider_settings(provider, app_id=None):
+    """
+    Returns the settings of provider, 'GCM_SETTINGS' or 'APNS_SETTINGS',
+    for app_id, or the global ones if app_id is None
+    """
+
+    if app_id is None:
+        return settings[provider]
+
+    app = get_app(app_id)
+    if provider == 'GCM_SETTINGS':
+        return app.gcm_settings
+    return app.apns_settings
@@ -0,0 +1,116 @@
+"""
+Buffers the registration ids of devices reported as unregistered or
+invalid by GCM and APNS and deactivates them in bulk
+"""
+
+import atexit
+import logging
+import threading
+
+from django.apps import apps
+from django.utils import six
+
+from .broadcast import DEFAULT_MODELS
+from .settings import INSTAPUSH_SETTINGS as settings
+from .utils import get_model
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeactivationBuffer(object):
+    """
+    Collects registration ids to deactivate, dropping duplicates, and
+    deactivates them with one bulk update per ``batch_size`` ids, at
+    the latest ``flush_interval`` seconds after the first id of a batch
+    was buffered. ``batch_size`` and ``flush_interval`` default to
+    DEACTIVATE_BATCH_SIZE and DEACTIVATE_FLUSH_INTERVAL, a flush_interval
+    of 0 only flushes full batches. ``model`` is a device model/document
+    class or its dotted path and defaults to the DEVICE_MODEL of the
+    ``provider`` settings, or else the sql model when instapush is
+    installed; ids are kept buffered while there is no model.
+    """
+
+    def __init__(self, model=None, provider=None, batch_size=None,
+            flush_interval=None):
+        self.model = model
+        self.provider = provider
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._ids = set()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def batch_size(self):
+        return self._batch_size or settings['DEACTIVATE_BATCH_SIZE']
+
+    @property
+    def flush_interval(self):
+        if self._flush_interval is None:
+            return settings['DEACTIVATE_FLUSH_INTERVAL']
+        return self._flush_interval
+
+    def add(self, rids):
+        with self._lock:
+            self._ids.update(rids)
+            full = len(self._ids) >= self.batch_size
+
+            if self._ids and self._timer is None and self.flush_interval:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Deactivates every buffered id and returns how many there were
+        """
+
+        model = self.get_model()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if model is None:
+                if self._ids:
+                    logger.warning("Keeping %d registration ids to deactivate "
+                            "until %s['DEVICE_MODEL'] is set", len(self._ids),
+                            self.provider)
+                return 0
+            ids, self._ids = list(self._ids), set()
+
+        if not ids:
+            return 0
+
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start:start + self.batch_size]
+            model.objects.with_registration_ids(batch).deactivate()
+
+        return len(ids)
+
+    def get_model(self):
+        model = self.model
+        if model is None and self.provider:
+            model = settings[self.provider].get('DEVICE_MODEL')
+            if model is None and apps.is_installed('instapush'):
+                model = DEFAULT_MODELS[self.provider.split('_')[0].lower()]
+        if isinstance(model, six.string_types):
+            model = get_model(model)
+        return model
+
+
+gcm_deactivator = DeactivationBuffer(provider='GCM_SETTINGS')
+apns_deactivator = DeactivationBuffer(provider='APNS_SETTINGS')
+
+
+@atexit.register
+def flush_all():
+    """
+    Deactivates every id still buffered
+    """
+
+    gcm_deactivator.flush()
+    apns_deactivator.flush()
@@ -0,0 +1,273 @@
+"""
+Drops repeated sends of a notification to a device. The bulk senders
+record a key per (registration id, notification) in a backend for
+DEDUP_TTL seconds and leave out the registration ids whose key is
+already there, before any GCM chunk or APNS frame is built. The
+notification is identified by its collapse key, if it has one, or by
+a fingerprint of its payload.
+"""
+
+import binascii
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from django.utils import six
+
+from .metrics import get_metrics
+from .settings import INSTAPUSH_SETTINGS as settings
+from .utils import get_model, normalize_apns_token
+
+
+class LocalBackend(object):
+    """
+    Keeps the keys of at most ``max_size`` sends in memory, dropping the
+    least recently seen ones first, and deduplicates each process on its
+    own
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, keys, ttl):
+        """
+        Records ``keys`` for ``ttl`` seconds and returns those that were
+        not recorded yet, in order
+        """
+
+        now = time.time()
+        added = []
+        with self._lock:
+            for key in keys:
+                expires = self._keys.pop(key, None)
+                if expires is None or expires <= now:
+                    expires = now + ttl
+                    added.append(key)
+                ## the most recently seen key is kept last
+                self._keys[key] = expires
+
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+        return added
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+
+class CacheBackend(object):
+    """
+    Records the keys in a django cache, so that every process sharing
+    the cache deduplicates against the others. Keys are added with the
+    cache's atomic add, which memcached and redis support.
+    """
+
+    def __init__(self, alias='default', prefix='instapush:dedup'):
+        self.alias = alias
+        self.prefix = prefix
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _key(self, key):
+        ## memcached keys are short and may not hold any character
+        return "%s:%s" % (self.prefix,
+                hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def add(self, keys, ttl):
+        cache = self.cache
+        timeout = int(ttl) or 1
+        return [key for key in keys if cache.add(self._key(key), 1, timeout)]
+
+    def discard(self, keys):
+        self.cache.delete_many([self._key(key) for key in keys])
+
+
+def fingerprint(*parts):
+    """
+    Returns a short digest identifying a notification by the json
+    encoding of parts
+    """
+
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"),
+            default=repr)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:20]
+
+
+class Deduplicator(object):
+    """
+    Filters the registration ids a notification is sent to, for the
+    duration of a with block. The key of each id kept is held until the
+    sender reports the id as sent; when the block raises, the keys of
+    the ids not sent yet are discarded again so that a retried send is
+    not dropped. A ttl of None disables it.
+    """
+
+    def __init__(self, provider, notification, ttl, backend=None):
+        self.provider = provider.split('_')[0].lower()
+        self.prefix = "%s:%s:" % (self.provider, notification)
+        self.ttl = ttl
+        self.backend = backend
+        self.duplicates = 0
+        ## keys of the ids filtered but not sent yet
+        self._pending = set()
+
+    @property
+    def enabled(self):
+        return bool(self.ttl)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self._pending:
+            self.backend.discard(list(self._pending))
+        self._pending.clear()
+
+    def _key(self, registration_id):
+        ## an id keys the same whichever form it is given in, hex or
+        ## bytes tokens, and str or unicode on python 2
+        if self.provider == 'apns':
+            try:
+                registration_id = normalize_apns_token(registration_id)
+            except ValueError:
+                pass
+        if isinstance(registration_id, six.binary_type):
+            try:
+                registration_id = registration_id.decode('utf-8')
+            except UnicodeDecodeError:
+                registration_id = binascii.hexlify(registration_id).decode(
+                        'ascii')
+        return self.prefix + six.text_type(registration_id)
+
+    def filter(self, registration_ids):
+        """
+        Returns the list of registration_ids the notification was not
+        sent to within the ttl, without repeated ones
+        """
+
+        if not self.enabled:
+            return registration_ids
+
+        registration_ids = list(registration_ids)
+        keys = [self._key(registration_id)
+                for registration_id in registration_ids]
+        added = set(self.backend.add(keys, self.ttl))
+
+        kept = []
+        for registration_id, key in zip(registration_ids, keys):
+            if key in added:
+                kept.append(registration_id)
+                self._pending.add(key)
+                ## a repeated id in the same batch is only kept once
+                added.discard(key)
+
+        duplicates = len(registration_ids) - len(kept)
+        if duplicates:
+            self.duplicates += duplicates
+            get_metrics().increment("%s.duplicates" % self.provider,
+                    duplicates)
+        return kept
+
+    def sent(self, registration_ids):
+        """
+        Releases the keys of registration ids once the provider answered
+        for them, so that only those of the ids still being sent are
+        held
+        """
+
+        if self.enabled:
+            self._pending.difference_update(self._key(registration_id)
+                    for registration_id in registration_ids)
+
+    def forget(self, registration_ids):
+        """
+        Discards the keys of registration ids the notification failed
+        to be sent to, so that a retried send is not dropped
+        """
+
+        if not self.enabled:
+            return
+        keys = [self._key(registration_id)
+                for registration_id in registration_ids]
+        if keys:
+            self._pending.difference_update(keys)
+            self.backend.discard(keys)
+
+    def filter_chunks(self, chunks):
+        """
+        Yields each chunk of an iterable filtered, skipping the chunks
+        left empty
+        """
+
+        for chunk in chunks:
+            chunk = self.filter(chunk)
+            if chunk:
+                yield chunk
+
+    def iter_filter(self, registration_ids, batch_size=1000):
+        """
+        Yields the registration ids of an iterable that are kept,
+        filtering them batch_size at a time. The sender reports each id
+        as sent once its delivery was checked.
+        """
+
+        if not self.enabled:
+            for registration_id in registration_ids:
+                yield registration_id
+            return
+
+        batch = []
+        for registration_id in registration_ids:
+            batch.append(registration_id)
+            if len(batch) >= batch_size:
+                for kept in self.filter(batch):
+                    yield kept
+                batch = []
+
+        for kept in self.filter(batch):
+            yield kept
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+@settings.on_reload
+def _reset_backend():
+    global _backend
+    _backend = None
+
+
+def get_dedup_backend():
+    """
+    Returns the backend configured in DEDUP_BACKEND
+    """
+
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                backend_class = get_model(settings['DEDUP_BACKEND'])
+                _backend = backend_class(**settings['DEDUP_OPTIONS'])
+    return _backend
+
+
+def get_deduplicator(provider, notification, provider_settings):
+    """
+    Returns the Deduplicator of a notification of ``provider``,
+    'GCM_SETTINGS' or 'APNS_SETTINGS', enabled if the DEDUP_TTL of the
+    provider_settings is set
+    """
+
+    ttl = provider_settings.get('DEDUP_TTL')
+    return Deduplicator(provider, notification, ttl,
+            get_dedup_backend() if ttl else None)
@@ -14,6 +14,14 @@ class GCMPushError(PushError):
     pass
 
 
+class GCMServerError(GCMPushError):
+    def __init__(self, status, retry_after=None):
+        super(GCMServerError, self).__init__("GCM returned HTTP status "\
+                "%s" % status)
+        self.status = status
+        self.retry_after = retry_after
+
+
 class APNSPushError(PushError):
     pass
 
@@ -23,7 +31,9 @@ class APNSDataOverflow(APNSPushError):
 
 
 class APNSServerError(APNSPushError):
-    def __init__(self, status, identifier):
-        super(APNSServerError, self).__init__(status, identifier)
+    def __init__(self, status, identifier, reason=None):
+        super(APNSServerError, self).__init__("APNS returned status %s "\
+                "for identifier %s" % (status, identifier))
         self.status = status
         self.identifier = identifier
+        self.reason = reason
@@ -3,23 +3,44 @@ Apple Push Notification Service
 """
 
 import codecs
+import collections
 import json
+import logging
+import os
+import select
 import ssl
 import struct
 import socket
+import threading
 import time
-from contextlib import closing
-from binascii import unhexlify
+from contextlib import closing, contextmanager
+from binascii import hexlify, unhexlify
 
 from django.core.exceptions import ImproperlyConfigured
+from django.utils import six
+
 from ..exceptions import (
+    APNSPushError,
     APNSServerError,
     APNSDataOverflow,
 )
+from ..credentials import get_app, get_provider_settings
+from ..dedup import fingerprint, get_deduplicator
+from ..metrics import get_metrics, instrumented
+from ..payloads import compile_template
+from ..ratelimit import get_rate_limiter
 from ..settings import INSTAPUSH_SETTINGS as settings
+from ..signals import devices_unregistered
+from ..utils import APNS_TOKEN_SIZE, normalize_apns_token
+
+
+SETTINGS = settings.section('APNS_SETTINGS')
 
+logger = logging.getLogger(__name__)
 
-SETTINGS = settings.get('APNS_SETTINGS')
+## status of the error response for an invalid token
+INVALID_TOKEN = 8
+INVALID_PAYLOAD_SIZE = 7
 
 
 def _check_certificate(ss):
@@ -38,12 +59,20 @@ def _check_certificate(ss):
         raise Exception("The certificate doesn't contain a private key")
 
 
-def _apns_create_socket(address_tuple, **kwargs):
-    certfile = kwargs.get('certfile') or SETTINGS.get("APNS_CERTIFICATE")
-    if not certfile:
-        raise ImproperlyConfigured(
-            'You need to set PUSH_NOTIFICATIONS_SETTINGS["APNS_CERTIFICATE"] to send messages through APNS.'
-        )
+def _apns_load_certificate(certfile):
+    """
+    Reads and validates the certificate file. The result is cached
+    per file and modification time so that pooled connections do not
+    re-read and re-parse the certificate on every reconnect.
+    """
+
+    try:
+        mtime = os.path.getmtime(certfile)
+    except Exception as e:
+        raise ImproperlyConfigured("The APNS certificate file at %r is not readable: %s" % (certfile, e))
+
+    if _certificate_cache.get(certfile) == mtime:
+        return
 
     try:
         with open(certfile, "r") as f:
@@ -56,71 +85,776 @@ def _apns_create_socket(address_tuple, **kwargs):
     except Exception as e:
         raise ImproperlyConfigured("The APNS certificate file at %r is unusable: %s" % (certfile, e))
 
-    ca_certs = SETTINGS.get("APNS_CA_CERTIFICATES")
+    _certificate_cache[certfile] = mtime
+
+
+def _apns_settings(app_id=None):
+    return get_provider_settings('APNS_SETTINGS', app_id)
 
-    sock = socket.socket()
-    sock = ssl.wrap_socket(sock, ssl_version=ssl.PROTOCOL_TLSv1, certfile=certfile, ca_certs=ca_certs)
+
+def _apns_get_certfile(**kwargs):
+    certfile = kwargs.get('certfile') or _apns_settings(
+            kwargs.get('app_id')).get("APNS_CERTIFICATE")
+    if not certfile:
+        raise ImproperlyConfigured(
+            'You need to set PUSH_NOTIFICATIONS_SETTINGS["APNS_CERTIFICATE"] to send messages through APNS.'
+        )
+    return certfile
+
+
+def _apns_create_socket(address_tuple, **kwargs):
+    ## the context negotiates the highest TLS version both ends support,
+    ## TLSv1 alone is refused by current OpenSSL builds
+    context = _apns_ssl_context(_apns_get_certfile(**kwargs))
+
+    sock = context.wrap_socket(socket.socket(), server_hostname=address_tuple[0])
     sock.connect(address_tuple)
 
     return sock
 
 
+def _apns_ssl_context(certfile, alpn_protocols=None):
+    """
+    Returns an SSLContext authenticating with the certificate file and
+    verifying the server against APNS_CA_CERTIFICATES or the system CAs
+    """
+
+    _apns_load_certificate(certfile)
+
+    ## PROTOCOL_TLS_CLIENT is only defined from python 3.6, and unlike
+    ## PROTOCOL_SSLv23 verifies the server by default
+    context = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS_CLIENT",
+        ssl.PROTOCOL_SSLv23))
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    context.load_cert_chain(certfile)
+    ca_certs = SETTINGS.get("APNS_CA_CERTIFICATES")
+    if ca_certs:
+        context.load_verify_locations(ca_certs)
+    else:
+        context.load_default_certs()
+    if alpn_protocols:
+        context.set_alpn_protocols(alpn_protocols)
+    return context
+
+
+class APNSConnection(object):
+    """
+    A TLS connection to an APNS gateway that can be kept warm in
+    the connection pool and reused across sends. ``settings`` are the
+    APNS settings of the app it belongs to, the global ones by default.
+    """
+
+    def __init__(self, address_tuple, certfile, settings=None):
+        self.address = address_tuple
+        self.certfile = certfile
+        self.key = (address_tuple[0], address_tuple[1], certfile)
+        self.settings = SETTINGS if settings is None else settings
+        self.socket = None
+        self.last_used = None
+
+    def connect(self):
+        self.close()
+        metrics = get_metrics()
+        with metrics.timer("apns.connect"):
+            self.socket = _apns_create_socket(self.address, certfile=self.certfile)
+        metrics.increment("apns.connections.opened")
+        self.last_used = time.time()
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except (socket.error, ssl.SSLError):
+                pass
+            self.socket = None
+
+    def is_alive(self):
+        """
+        Checks whether the connection can be reused. APNS never writes
+        to a push socket except to report an error right before closing
+        it, so a readable socket is a dead one.
+        """
+
+        if self.socket is None:
+            return False
+
+        max_idle = self.settings.get("CONNECTION_MAX_IDLE")
+        if max_idle is not None and time.time() - self.last_used > max_idle:
+            return False
+
+        try:
+            if self.socket.pending():
+                return False
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+
+        return not readable
+
+    def write(self, data):
+        """
+        Writes data to the gateway, reconnecting once if the pooled
+        socket turns out to have been dropped by the peer.
+        """
+
+        if self.socket is None:
+            self.connect()
+
+        try:
+            self.socket.sendall(data)
+        except (socket.error, ssl.SSLError):
+            self.connect()
+            self.socket.sendall(data)
+
+        self.last_used = time.time()
+
+
+class APNSConnectionPool(object):
+    """
+    A pool of idle APNS connections keyed by (host, port, certfile),
+    sized by the APNS ``settings`` of its app, the global ones by
+    default.
+    """
+
+    def __init__(self, connection_class=APNSConnection, settings=None):
+        self.connection_class = connection_class
+        self.settings = SETTINGS if settings is None else settings
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._closed = False
+
+    def _slot(self, key):
+        """
+        Returns the semaphore capping the connections to a key that are
+        checked out at once at MAX_CONNECTIONS, or None if uncapped
+        """
+
+        max_connections = self.settings.get("MAX_CONNECTIONS")
+        if not max_connections:
+            return None
+
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = threading.BoundedSemaphore(
+                        max_connections)
+        return slot
+
+    def acquire(self, address_tuple, certfile):
+        key = (address_tuple[0], address_tuple[1], certfile)
+
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection = idle.pop()
+                if connection.is_alive():
+                    get_metrics().increment("apns.connections.reused")
+                    return connection
+                connection.close()
+
+        connection = self.connection_class(address_tuple, certfile,
+                self.settings)
+        connection.connect()
+        return connection
+
+    def release(self, connection):
+        if connection.socket is None:
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(connection.key, [])
+            if not self._closed and len(idle) < self.settings["POOL_SIZE"]:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    @contextmanager
+    def connection(self, address_tuple, certfile):
+        """
+        Checks out a connection for the duration of the block. The
+        connection is closed instead of returned to the pool if the
+        block raises, as APNS drops the socket after any error.
+        """
+
+        slot = self._slot((address_tuple[0], address_tuple[1], certfile))
+        if slot is not None:
+            slot.acquire()
+
+        try:
+            connection = self.acquire(address_tuple, certfile)
+            try:
+                yield connection
+            except:
+                connection.close()
+                raise
+            else:
+                self.release(connection)
+        finally:
+            if slot is not None:
+                slot.release()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def close(self):
+        """
+        Closes the idle connections, and those checked out once they
+        are released, for good
+        """
+
+        with self._lock:
+            self._closed = True
+        self.clear()
+
+
+_certificate_cache = {}
+connection_pool = APNSConnectionPool()
+
+
+@settings.on_reload
+def _apns_reset():
+    connection_pool.clear()
+    _certificate_cache.clear()
+
+
+def _apns_connection_pool(app_id=None, connection_class=APNSConnection):
+    """
+    Returns the pool of the app, or the process wide pool
+    """
+
+    if app_id is None:
+        return connection_pool
+    return get_app(app_id).apns_pool(connection_class)
+
+
+def _apns_push_connection(**kwargs):
+    app_settings = _apns_settings(kwargs.get('app_id'))
+    return _apns_connection_pool(kwargs.get('app_id')).connection(
+            (app_settings["HOST"], app_settings["PORT"]),
+            _apns_get_certfile(**kwargs))
+
+
 def _apns_create_socket_to_push(**kwargs):
-    return _apns_create_socket((SETTINGS["HOST"], SETTINGS["PORT"]), **kwargs)
+    app_settings = _apns_settings(kwargs.get('app_id'))
+    return _apns_create_socket((app_settings["HOST"], app_settings["PORT"]),
+            **kwargs)
 
 
-def _apns_create_socket_to_feedback():
-    return _apns_create_socket((SETTINGS["FEEDBACK_HOST"], SETTINGS["FEEDBACK_PORT"]))
+def _apns_create_socket_to_feedback(**kwargs):
+    app_settings = _apns_settings(kwargs.get('app_id'))
+    return _apns_create_socket((app_settings["FEEDBACK_HOST"],
+        app_settings["FEEDBACK_PORT"]), **kwargs)
 
 
-def _apns_pack_frame(token_hex, payload, identifier, expiration, priority):
-    token = unhexlify(token_hex)
+class APNSFrameTemplate(object):
+    """
+    Packs command 2 frames that share a payload, expiration and
+    priority. Everything but the token and identifier is packed once,
+    so a frame is built by splicing those two into precomputed bytes.
+    """
+
     # |COMMAND|FRAME-LEN|{token}|{payload}|{id:4}|{expiration:4}|{priority:1}
-    frame_len = 3 * 5 + len(token) + len(payload) + 4 + 4 + 1  # 5 items, each 3 bytes prefix, then each item length
-    frame_fmt = "!BIBH%ssBH%ssBHIBHIBHB" % (len(token), len(payload))
-    frame = struct.pack(
-        frame_fmt,
-        2, frame_len,
-        1, len(token), token,
-        2, len(payload), payload,
-        3, 4, identifier,
-        4, 4, expiration,
-        5, 1, priority)
-
-    return frame
-
-
-def _apns_check_errors(sock):
-    timeout = SETTINGS["ERROR_TIMEOUT"]
+    header = struct.Struct("!BIBH")
+    identifier_item = struct.Struct("!I")
+    payload_item = struct.Struct("!BH")
+
+    def __init__(self, payload, expiration, priority):
+        self.payload = payload
+        self.identifier_header = struct.pack("!BH", 3, 4)
+        self.middle = self.payload_item.pack(2, len(payload)) + payload + \
+                self.identifier_header
+        self.tail = struct.pack("!BHIBHB", 4, 4, expiration, 5, 1, priority)
+        # 5 items, each 3 bytes prefix, then each item length (sans token and payload)
+        self.items_len = 3 * 5 + 4 + 4 + 1
+        self.frame_len = self.items_len + len(payload)
+
+    def pack(self, token, identifier):
+        return b"".join((
+            self.header.pack(2, self.frame_len + len(token), 1, len(token)),
+            token,
+            self.middle,
+            self.identifier_item.pack(identifier),
+            self.tail))
+
+    def pack_payload(self, token, identifier, payload):
+        """
+        Packs a frame with a payload of its own instead of the shared one
+        """
+
+        return b"".join((
+            self.header.pack(2, self.items_len + len(payload) + len(token),
+                1, len(token)),
+            token,
+            self.payload_item.pack(2, len(payload)),
+            payload,
+            self.identifier_header,
+            self.identifier_item.pack(identifier),
+            self.tail))
+
+
+def _apns_pack_frame(token_hex, payload, identifier, expiration, priority):
+    template = APNSFrameTemplate(payload, expiration, priority)
+    return template.pack(_apns_token_bytes(token_hex), identifier)
+
+
+def _apns_token_bytes(token):
+    """
+    Returns the 32 bytes of a device token given in hex or already
+    decoded, raising ValueError for anything else
+    """
+
+    if isinstance(token, bytes) and len(token) == APNS_TOKEN_SIZE:
+        return token
+
+    try:
+        data = unhexlify(token)
+    except (TypeError, ValueError):
+        data = None
+    if data is None or len(data) != APNS_TOKEN_SIZE:
+        raise ValueError("%r is not a valid APNS device token" % (token,))
+    return data
+
+
+def _apns_token_hex(token):
+    """
+    Returns the hex form of a token passed as 32 bytes, which is how
+    failed tokens are reported
+    """
+
+    if isinstance(token, bytes) and len(token) == APNS_TOKEN_SIZE:
+        return hexlify(token).decode("ascii")
+    return token
+
+
+def _apns_decode_token(registration_id, failed):
+    """
+    Returns the bytes of a device token, or None after recording an
+    invalid one in failed as INVALID_TOKEN so that it is never written
+    """
+
+    try:
+        return _apns_token_bytes(registration_id)
+    except ValueError:
+        failed[_apns_token_hex(registration_id)] = INVALID_TOKEN
+        get_metrics().increment("apns.invalid_tokens")
+        return None
+
+
+def _apns_normalize_token(registration_id, failed):
+    """
+    Returns the hex form of a device token, or None after recording an
+    invalid one in failed as INVALID_TOKEN
+    """
+
+    try:
+        return normalize_apns_token(registration_id)
+    except ValueError:
+        failed[_apns_token_hex(registration_id)] = INVALID_TOKEN
+        get_metrics().increment("apns.invalid_tokens")
+        return None
+
+
+def _apns_check_errors(sock, timeout):
     if timeout is None:
         return  # assume everything went fine!
-    saved_timeout = sock.gettimeout()
+    with get_metrics().timer("apns.check_errors"):
+        saved_timeout = sock.gettimeout()
+        try:
+            sock.settimeout(timeout)
+            data = sock.recv(6)
+            if data:
+                command, status, identifier = struct.unpack("!BBI", data)
+                # apple protocol says command is always 8. See http://goo.gl/ENUjXg
+                assert command == 8, "Command must be 8!"
+                if status != 0:
+                    get_metrics().increment("apns.errors.%d" % status)
+                    raise APNSServerError(status, identifier)
+        except socket.timeout:  # py3, see http://bugs.python.org/issue10272
+            pass
+        except ssl.SSLError as e:  # py2
+            if "timed out" not in e.message:
+                raise
+        finally:
+            sock.settimeout(saved_timeout)
+
+
+def _apns_read_error(sock, timeout=0):
+    """
+    Waits at most ``timeout`` seconds for an error-response packet and
+    returns its (status, identifier), or None if there is nothing to
+    read. Raises socket.error if the gateway closed the connection
+    without reporting an error.
+    """
+
+    deadline = time.time() + timeout
+    data = None
+    while data is None:
+        if not sock.pending():
+            readable, _, _ = select.select([sock], [], [],
+                    max(0, deadline - time.time()))
+            if not readable:
+                return None
+
+        ## under TLS 1.3 session tickets make the socket readable without
+        ## any data, so the read itself must not block
+        saved_timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            data = sock.recv(6)
+        except ssl.SSLWantReadError:
+            pass
+        finally:
+            sock.settimeout(saved_timeout)
+
+    if not data:
+        raise socket.error("APNS closed the connection")
+
+    command, status, identifier = struct.unpack("!BBI", data)
+    # apple protocol says command is always 8. See http://goo.gl/ENUjXg
+    assert command == 8, "Command must be 8!"
+    return status, identifier
+
+
+class APNSBulkSender(object):
+    """
+    Writes a stream of frames over a pooled connection. The most recently
+    written frames are kept in a ring buffer keyed by identifier so that
+    when APNS rejects a frame and drops the connection, everything written
+    after it can be resent on a fresh connection. Error responses are
+    polled without blocking between writes. settled, if given, is called
+    with the registration ids of the frames that were written, checked
+    for errors and left the buffer, as they can no longer be resent.
+    """
+
+    ## identifier in a shutdown response is the last frame APNS accepted
+    SHUTDOWN = 10
+    MAX_RECONNECTS = 3
+    ## frames are coalesced into writes of roughly this many bytes
+    WRITE_SIZE = 64 * 1024
+
+    def __init__(self, connection, buffer_size=None, write_size=None,
+            rate_limiter=None, settled=None):
+        self.connection = connection
+        self.rate_limiter = rate_limiter
+        self.settled = settled
+        self.buffer = collections.deque(maxlen=buffer_size or
+                connection.settings["RESEND_BUFFER_SIZE"])
+        self.write_size = write_size or self.WRITE_SIZE
+        self.failed = {}
+        self._pending = collections.deque()
+        self._pending_size = 0
+        self._reconnects = 0
+        ## [first, last] identifiers of the runs of consecutive frames
+        ## written on the current connection
+        self._written = []
+        ## registration ids of the frames that left the buffer, settled
+        ## once they were written
+        self._evicted = []
+
+    def send(self, identifier, registration_id, frame):
+        entry = (identifier, registration_id, frame)
+        if self.settled is not None and \
+                len(self.buffer) == self.buffer.maxlen:
+            self._evicted.append(self.buffer[0][1])
+        self.buffer.append(entry)
+        self._pending.append(entry)
+        self._pending_size += len(frame)
+        if self._pending_size >= self.write_size:
+            self._drain()
+
+    def finish(self, timeout=None):
+        """
+        Writes any pending frames, waits for late error responses,
+        resending as needed, and returns a dict of
+        {registration_id: status} for every rejected frame.
+        """
+
+        self._drain()
+        with get_metrics().timer("apns.error_wait"):
+            while True:
+                error = self._read_error(timeout or 0)
+                if error is None:
+                    return self.failed
+                self._recover(*error)
+                self._drain()
+
+    def _drain(self):
+        while self._pending:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(len(self._pending))
+
+            data = b"".join(entry[2] for entry in self._pending)
+            metrics = get_metrics()
+            try:
+                with metrics.timer("apns.write"):
+                    self.connection.socket.sendall(data)
+            except (socket.error, ssl.SSLError):
+                error = self._read_error(0)
+                if error is not None:
+                    self._recover(*error)
+                else:
+                    ## a reset without an error response is how APNS
+                    ## sheds load
+                    self._throttled()
+                    self._reconnect()
+                continue
+
+            metrics.increment("apns.frames", len(self._pending))
+            metrics.increment("apns.bytes", len(data))
+            self._record_written(self._pending)
+            self._pending.clear()
+            self._pending_size = 0
+            self._reconnects = 0
+            error = self._read_error(0)
+            if error is not None:
+                self._recover(*error)
+
+        self.connection.last_used = time.time()
+        if self._evicted:
+            self.settled(self._evicted)
+            self._evicted = []
+
+    def _read_error(self, timeout):
+        try:
+            return _apns_read_error(self.connection.socket, timeout)
+        except (socket.error, ssl.SSLError):
+            return None
+
+    def _recover(self, status, identifier):
+        self._rewind(status, identifier)
+        self._reconnect()
+
+    def _record_written(self, entries):
+        runs = self._written
+        for entry in entries:
+            if runs and runs[-1][1] == entry[0] - 1:
+                runs[-1][1] = entry[0]
+            else:
+                runs.append([entry[0], entry[0]])
+
+    def _written_after(self, identifier):
+        """
+        Returns how many frames were written on the current connection
+        after the frame of identifier
+        """
+
+        return sum(last - max(first, identifier + 1) + 1
+                for first, last in self._written if last > identifier)
+
+    def _rewind(self, status, identifier):
+        """
+        Records the rejected frame and queues every frame written after
+        it to be written again, ahead of the frames not written yet
+        """
+
+        if status == self.SHUTDOWN:
+            self._throttled()
+        else:
+            for entry in self.buffer:
+                if entry[0] == identifier:
+                    self.failed[_apns_token_hex(entry[1])] = status
+                    break
+
+        ## the frames not written yet are the most recent ones, whether
+        ## or not they are still buffered
+        unwritten = self._pending
+        first_unwritten = unwritten[0][0] if unwritten else None
+        resent = [entry for entry in self.buffer if entry[0] > identifier
+                and (first_unwritten is None or entry[0] < first_unwritten)]
+
+        self._pending = collections.deque(resent)
+        self._pending.extend(unwritten)
+        self._pending_size = sum(len(entry[2]) for entry in self._pending)
+
+        metrics = get_metrics()
+        metrics.increment("apns.errors.%d" % status)
+        metrics.increment("apns.resent", len(resent))
+
+        ## frames written after the rejected one that already left the
+        ## buffer cannot be resent
+        lost = self._written_after(identifier) - len(resent)
+        if lost > 0:
+            metrics.increment("apns.lost", lost)
+            logger.warning("%d APNS frames written after frame %d were "
+                    "dropped and are no longer in the resend buffer, "
+                    "consider raising RESEND_BUFFER_SIZE", lost, identifier)
+
+    def _reconnect(self):
+        self._reconnects += 1
+        if self._reconnects > self.MAX_RECONNECTS:
+            raise APNSPushError("Could not reconnect to APNS after %i "\
+                    "attempts" % self.MAX_RECONNECTS)
+        get_metrics().increment("apns.reconnects")
+        self.connection.connect()
+        self._written = []
+
+    def _throttled(self):
+        get_metrics().increment("apns.throttled")
+        if self.rate_limiter is not None:
+            self.rate_limiter.throttled()
+
+
+def _apns_build_payload(alert, truncate=None, **kwargs):
+    """
+    Builds and validates the encoded JSON payload of a notification
+    against the MAX_SIZE of its app. With truncate (or TRUNCATE_ALERT)
+    an oversized alert is shortened to fit instead.
+    """
+
+    data = _apns_payload_data(alert, **kwargs)
+    json_data = _apns_encode_payload(data)
+
+    max_size = _apns_settings(kwargs.get("app_id"))["MAX_SIZE"]
+    if len(json_data) > max_size:
+        if not _apns_truncate(truncate, kwargs.get("app_id")):
+            raise APNSDataOverflow("Notification body cannot exceed %i bytes" % (max_size))
+        json_data, cut = _apns_fit_payload(data, max_size)
+        get_metrics().increment("apns.truncated")
+        logger.info("Truncated %d characters of an APNS alert to fit %d bytes",
+                cut, max_size)
+
+    return json_data
+
+
+def _apns_encode_payload(data):
+    # convert to json, avoiding unnecessary whitespace with separators (keys sorted for tests)
+    return json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+
+def _apns_truncate(truncate=None, app_id=None):
+    if truncate is None:
+        return _apns_settings(app_id)["TRUNCATE_ALERT"]
+    return truncate
+
+
+## json escapes every character outside of printable ascii, so the
+## encoded size of a string is known without encoding it
+ELLIPSIS = u"\u2026"
+ESCAPED_SIZES = dict((char, 2) for char in u'"\\\b\f\n\r\t')
+
+
+def _json_escaped_size(char):
+    if u" " <= char <= u"~":
+        return ESCAPED_SIZES.get(char, 1)
+    if ord(char) > 0xFFFF:
+        ## a surrogate pair, \uXXXX\uXXXX
+        return 12
+    return ESCAPED_SIZES.get(char, 6)
+
+
+def _truncate_escaped(text, size):
+    """
+    Returns the longest prefix of text, followed by an ellipsis, whose
+    JSON encoding fits in size bytes, along with how many characters
+    were cut
+    """
+
+    ellipsis = ELLIPSIS if size >= _json_escaped_size(ELLIPSIS) else u""
+    size -= _json_escaped_size(ELLIPSIS) if ellipsis else 0
+
+    end = 0
+    for char in text:
+        size -= _json_escaped_size(char)
+        if size < 0:
+            break
+        end += 1
+
+    ## never split the surrogate pairs of narrow python 2 builds
+    if end and u"\ud800" <= text[end - 1] <= u"\udbff":
+        end -= 1
+
+    text, cut = text[:end].rstrip(), text
+    return text + ellipsis, len(cut) - len(text)
+
+
+def _apns_fit_payload(data, max_size):
+    """
+    Encodes data, truncating the alert (or its body) so that the payload
+    fits in max_size bytes. The size left for the alert is computed once
+    and the alert cut in a single pass over its characters. Returns the
+    payload and the number of characters cut.
+    """
+
+    container = data.get("aps", {})
+    key = "alert"
+    if isinstance(container.get(key), dict):
+        container, key = container[key], "body"
+
+    text = container.get(key)
+    if not isinstance(text, six.string_types):
+        raise APNSDataOverflow("Notification body cannot exceed %i bytes "\
+                "and has no alert to truncate" % max_size)
+
+    container[key] = u""
+    size = max_size - len(_apns_encode_payload(data))
+    if size < 0:
+        container[key] = text
+        raise APNSDataOverflow("Notification body cannot exceed %i bytes "\
+                "even without its alert" % max_size)
+
+    container[key], cut = _truncate_escaped(text, size)
+    return _apns_encode_payload(data), cut
+
+
+def apns_fit_payload(alert, **kwargs):
+    """
+    Returns the encoded payload of a notification, with its alert
+    truncated to fit in the MAX_SIZE bytes of its app if needed, and the
+    number of characters that were cut
+    """
+
+    data = _apns_payload_data(alert, **kwargs)
+    json_data = _apns_encode_payload(data)
+    max_size = _apns_settings(kwargs.get("app_id"))["MAX_SIZE"]
+    if len(json_data) <= max_size:
+        return json_data, 0
+    return _apns_fit_payload(data, max_size)
+
+
+def _apns_render_payload(template, variables, truncate=None, app_id=None):
+    """
+    Renders a PayloadTemplate for one device, truncating its alert if
+    it overflows and truncation is enabled
+    """
+
     try:
-        sock.settimeout(timeout)
-        data = sock.recv(6)
-        if data:
-            command, status, identifier = struct.unpack("!BBI", data)
-            # apple protocol says command is always 8. See http://goo.gl/ENUjXg
-            assert command == 8, "Command must be 8!"
-            if status != 0:
-                raise APNSServerError(status, identifier)
-    except socket.timeout:  # py3, see http://bugs.python.org/issue10272
-        pass
-    except ssl.SSLError as e:  # py2
-        if "timed out" not in e.message:
+        return template.render(variables)
+    except APNSDataOverflow:
+        if not _apns_truncate(truncate, app_id):
             raise
-    finally:
-        sock.settimeout(saved_timeout)
+        return _apns_fit_payload(template.fill(variables), template.max_size)[0]
+
+
+def _apns_payload_template(alert, **kwargs):
+    """
+    Returns the compiled PayloadTemplate of a notification whose alert
+    or custom values hold placeholders
+    """
 
+    return compile_template(_apns_payload_data(alert, **kwargs),
+            _apns_settings(kwargs.get("app_id"))["MAX_SIZE"], APNSDataOverflow)
 
-def _apns_send(token, alert, badge=None, sound="default", category=None, content_available=True,
+
+def _apns_payload_data(alert, badge=None, sound="default", category=None, content_available=True,
     action_loc_key=None, loc_key=None, loc_args=[], title_loc_key=None, title_loc_args=None,
-    extra={}, identifier=0, expiration=None, priority=10, socket=None, **kwargs):
+    extra={}, **kwargs):
+
     data = {}
     aps_data = {}
 
-    custom_params = alert
-    alert = custom_params.pop('message', '')
+    if isinstance(alert, dict):
+        custom_params = dict(alert)
+        alert = custom_params.pop('message', '')
+    else:
+        custom_params = {}
 
     if action_loc_key or loc_key or loc_args:
         alert = {"body": alert} if alert else {}
@@ -157,61 +891,79 @@ def _apns_send(token, alert, badge=None, sound="default", category=None, content
 
     data["aps"] = aps_data
     data.update(extra)
+    return data
 
-    # convert to json, avoiding unnecessary whitespace with separators (keys sorted for tests)
-    json_data = json.dumps(data, separators=(",", ":"), sort_keys=True).encode("utf-8")
-
-    max_size = SETTINGS["MAX_SIZE"]
-    if len(json_data) > max_size:
-        raise APNSDataOverflow("Notification body cannot exceed %i bytes" % (max_size))
 
+def _apns_frame_template(payload, expiration=None, priority=10, **kwargs):
     # if expiration isn't specified use 1 month from now
     expiration_time = expiration if expiration is not None else int(time.time()) + 2592000
+    return APNSFrameTemplate(payload, expiration_time, priority)
+
+
+def _apns_prepare_frame(token, alert, identifier=0, **kwargs):
+    template = _apns_frame_template(_apns_build_payload(alert, **kwargs), **kwargs)
+    return template.pack(_apns_token_bytes(token), identifier)
+
 
-    frame = _apns_pack_frame(token, json_data, identifier, expiration_time, priority)
+def _apns_send(token, alert, socket=None, **kwargs):
+    frame = _apns_prepare_frame(token, alert, **kwargs)
+
+    rate_limiter = get_rate_limiter('APNS_SETTINGS', _apns_get_certfile(**kwargs),
+            _apns_settings(kwargs.get('app_id')))
+    if rate_limiter is not None:
+        rate_limiter.acquire()
 
     if socket:
         socket.write(frame)
     else:
-        with closing(_apns_create_socket_to_push(**kwargs)) as socket:
-            socket.write(frame)
-            _apns_check_errors(socket)
+        with _apns_push_connection(**kwargs) as connection:
+            connection.write(frame)
+            _apns_check_errors(connection.socket,
+                    connection.settings["ERROR_TIMEOUT"])
 
+    metrics = get_metrics()
+    metrics.increment("apns.frames")
+    metrics.increment("apns.bytes", len(frame))
 
-def _apns_read_and_unpack(socket, data_format):
-    length = struct.calcsize(data_format)
-    data = socket.recv(length)
-    if data:
-        return struct.unpack_from(data_format, data, 0)
-    else:
-        return None
 
+def _apns_iter_feedback(sock, timeout=None):
+    """
+    Yields (timestamp, token) tuples from the feedback service as they
+    arrive. Reads are buffered, so tuples split across several reads
+    are reassembled. Stops once the server closes the connection or
+    nothing arrives for ``timeout`` seconds.
+    """
 
-def _apns_receive_feedback(socket):
-    expired_token_list = []
+    header = struct.Struct("!LH")
+    buffered = b""
 
-    header_format = '!LH'
-    has_data = True
-    while has_data:
+    sock.settimeout(timeout)
+    while True:
         try:
-            header_data = _apns_read_and_unpack(socket, header_format)
-            if header_data is not None:
-                timestamp, token_length = header_data
-                token_format = '%ss' % token_length
-                device_token = _apns_read_and_unpack(socket, token_format)
-                if device_token is not None:
-                    expired_token_list.append((timestamp, device_token[0]))
-            else:
-                has_data = False
-        except socket.timeout:
-            pass
-        except ssl.SSLError as e:
-            if "timed out" not in e.message:
+            data = sock.recv(4096)
+        except socket.timeout:  # py3, see http://bugs.python.org/issue10272
+            return
+        except ssl.SSLError as e:  # py2
+            if "timed out" not in str(e):
                 raise
+            return
 
-    return expired_token_list
+        if not data:
+            return
 
+        buffered += data
+        offset = 0
+        while len(buffered) - offset >= header.size:
+            timestamp, token_length = header.unpack_from(buffered, offset)
+            end = offset + header.size + token_length
+            if len(buffered) < end:
+                break
+            yield timestamp, buffered[offset + header.size:end]
+            offset = end
+        buffered = buffered[offset:]
 
+
+@instrumented("apns")
 def apns_send_message(registration_id, alert, **kwargs):
     """
     Sends an APNS notification to a single registration_id.
@@ -224,9 +976,40 @@ def apns_send_message(registration_id, alert, **kwargs):
     to this for silent notifications.
     """
 
-    _apns_send(registration_id, alert, **kwargs)
+    try:
+        if _apns_settings(kwargs.get('app_id'))["BACKEND"] == "http2":
+            from .apns_http2 import apns_http2_send_message
+            apns_http2_send_message(registration_id, alert, **kwargs)
+        else:
+            _apns_send(registration_id, alert, **kwargs)
+    except APNSServerError as e:
+        if e.status == INVALID_TOKEN:
+            _apns_deactivate_invalid([registration_id], kwargs.get('app_id'))
+        raise
+
+
+def _apns_deactivate_invalid(registration_ids, app_id=None):
+    deactivate_callback = _apns_settings(app_id).get('DEACTIVATE_UNREG_CALLBACK')
+    if registration_ids:
+        get_metrics().increment("apns.unregistered", len(registration_ids))
+        devices_unregistered.send(sender="apns",
+                registration_ids=registration_ids, app_id=app_id)
+        deactivate_callback(registration_ids)
+
+
+def _apns_deduplicator(alert, app_settings, kwargs):
+    """
+    Returns the Deduplicator of a bulk send, identifying the
+    notification by its collapse_id if it has one
+    """
 
+    notification = kwargs.get('collapse_id') or fingerprint(alert,
+            dict((key, value) for key, value in kwargs.items()
+                if key not in ('app_id', 'socket')))
+    return get_deduplicator('APNS_SETTINGS', notification, app_settings)
 
+
+@instrumented("apns")
 def apns_send_bulk_message(registration_ids, alert, **kwargs):
     """
     Sends an APNS notification to one or more registration_ids.
@@ -235,22 +1018,149 @@ def apns_send_bulk_message(registration_ids, alert, **kwargs):
     Note that if set alert should always be a string. If it is not set,
     it won't be included in the notification. You will need to pass None
     to this for silent notifications.
+
+    Frames rejected by APNS do not abort the send; everything written
+    after a rejected frame is resent on a new connection. Returns a dict
+    of {registration_id: status} for the rejected registration_ids.
+    Registration ids rejected as invalid tokens are deactivated.
+
+    Registration ids may be given in hex or as their 32 bytes. Malformed
+    ones are reported as invalid tokens without ever being written.
+    """
+    app_settings = _apns_settings(kwargs.get('app_id'))
+    with _apns_deduplicator(alert, app_settings, kwargs) as deduplicator:
+        registration_ids = deduplicator.iter_filter(registration_ids)
+        if app_settings["BACKEND"] == "http2":
+            from .apns_http2 import apns_http2_send_bulk_message
+            failed = apns_http2_send_bulk_message(registration_ids, alert,
+                    settled=deduplicator.sent, **kwargs)
+        else:
+            failed = _apns_send_bulk(registration_ids, alert,
+                    settled=deduplicator.sent, **kwargs)
+        deduplicator.forget(failed)
+
+    _apns_deactivate_invalid([registration_id for registration_id, status
+        in failed.items() if status == INVALID_TOKEN], kwargs.get('app_id'))
+    return failed
+
+
+@instrumented("apns")
+def apns_send_personalized_message(registrations, alert, **kwargs):
+    """
+    Sends an APNS notification rendered for each device. registrations
+    is an iterable of (registration_id, variables) tuples, and the alert
+    and extra values may hold $name placeholders filled from each dict
+    of variables (see instapush.payloads).
+
+    The payload is compiled once, so only the variables are encoded per
+    device. Devices whose rendered payload exceeds MAX_SIZE are skipped
+    and reported with status 7 (invalid payload size). Returns a dict of
+    {registration_id: status} for the rejected registration_ids.
     """
-    with closing(_apns_create_socket_to_push(**kwargs)) as socket:
+    if _apns_settings(kwargs.get('app_id'))["BACKEND"] == "http2":
+        from .apns_http2 import apns_http2_send_personalized_message
+        failed = apns_http2_send_personalized_message(registrations, alert,
+                **kwargs)
+    else:
+        failed = _apns_send_personalized(registrations, alert, **kwargs)
+
+    _apns_deactivate_invalid([registration_id for registration_id, status
+        in failed.items() if status == INVALID_TOKEN], kwargs.get('app_id'))
+    return failed
+
+
+def _apns_send_bulk(registration_ids, alert, settled=None, **kwargs):
+    ## the payload is the same for every device, so it is encoded
+    ## and validated once and only the token is spliced per frame
+    template = _apns_frame_template(_apns_build_payload(alert, **kwargs), **kwargs)
+    failed = {}
+
+    def frames():
         for identifier, registration_id in enumerate(registration_ids):
-            _apns_send(registration_id, alert, identifier=identifier, socket=socket, **kwargs)
-        _apns_check_errors(socket)
+            token = _apns_decode_token(registration_id, failed)
+            if token is not None:
+                yield identifier, registration_id, template.pack(token,
+                        identifier)
+
+    failed.update(_apns_send_frames(frames(), settled=settled, **kwargs))
+    return failed
+
+
+def _apns_send_personalized(registrations, alert, **kwargs):
+    payload_template = _apns_payload_template(alert, **kwargs)
+    template = _apns_frame_template(b"", **kwargs)
+    failed = {}
 
+    def frames():
+        for identifier, (registration_id, variables) in enumerate(registrations):
+            token = _apns_decode_token(registration_id, failed)
+            if token is None:
+                continue
+            try:
+                payload = _apns_render_payload(payload_template, variables,
+                        kwargs.get("truncate"), kwargs.get("app_id"))
+            except APNSDataOverflow:
+                failed[_apns_token_hex(registration_id)] = INVALID_PAYLOAD_SIZE
+                continue
+            yield identifier, registration_id, template.pack_payload(
+                    token, identifier, payload)
 
-def apns_fetch_inactive_ids():
+    failed.update(_apns_send_frames(frames(), **kwargs))
+    return failed
+
+
+def _apns_send_frames(frames, settled=None, **kwargs):
+    """
+    Writes (identifier, registration_id, frame) tuples over a pooled
+    connection and returns the rejected registration ids
+    """
+
+    with _apns_push_connection(**kwargs) as connection:
+        sender = APNSBulkSender(connection, rate_limiter=get_rate_limiter(
+            'APNS_SETTINGS', connection.certfile, connection.settings),
+            settled=settled)
+        for identifier, registration_id, frame in frames:
+            sender.send(identifier, registration_id, frame)
+        return sender.finish(connection.settings["ERROR_TIMEOUT"])
+
+
+def apns_iter_inactive_ids(app_id=None):
+    """
+    Queries the APNS feedback service and yields (timestamp,
+    registration_id) tuples for the ids that are no longer active
+    since the last fetch, as they are received.
+    """
+    with closing(_apns_create_socket_to_feedback(app_id=app_id)) as sock:
+        for timestamp, token in _apns_iter_feedback(sock, SETTINGS["FEEDBACK_TIMEOUT"]):
+            yield timestamp, codecs.encode(token, 'hex_codec').decode('ascii')
+
+
+def apns_fetch_inactive_ids(app_id=None):
     """
     Queries the APNS server for id's that are no longer active since
     the last fetch
     """
-    with closing(_apns_create_socket_to_feedback()) as socket:
-        inactive_ids = []
+    return [registration_id for _, registration_id in
+            apns_iter_inactive_ids(app_id)]
+
+
+def apns_deactivate_inactive_devices(model=None, batch_size=None, app_id=None):
+    """
+    Reads the feedback service and deactivates the matching devices
+    with one bulk update per ``batch_size`` ids. ``model`` defaults to
+    APNS_SETTINGS["DEVICE_MODEL"], or else the sql model. Returns the
+    number of inactive ids received.
+    """
+
+    from ..deactivation import DeactivationBuffer
+
+    deactivator = DeactivationBuffer(model, provider='APNS_SETTINGS',
+            batch_size=batch_size, flush_interval=0)
 
-        for _, registration_id in _apns_receive_feedback(socket):
-            inactive_ids.append(codecs.encode(registration_id, 'hex_codec'))
+    count = 0
+    for _, registration_id in apns_iter_inactive_ids(app_id):
+        count += 1
+        deactivator.add([registration_id])
 
-        return inactive_ids
+    deactivator.flush()
+    return count
@@ -0,0 +1,346 @@
+"""
+asyncio variants of the APNS senders
+
+Connections are asyncio streams kept warm in a pool per event loop.
+With APNS_SETTINGS["BACKEND"] set to "http2" the coroutines delegate
+to apns_http2_async, which multiplexes every coroutine of a loop over
+one connection. Deactivation callbacks run in the default executor of
+the loop.
+"""
+
+import asyncio
+import ssl
+import struct
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+from ..exceptions import APNSPushError, APNSServerError
+from ..metrics import get_metrics, record_failed, record_sent
+from ..ratelimit import get_rate_limiter
+from .apns import (
+    INVALID_TOKEN,
+    SETTINGS,
+    APNSBulkSender,
+    _apns_build_payload,
+    _apns_decode_token,
+    _apns_deactivate_invalid,
+    _apns_frame_template,
+    _apns_get_certfile,
+    _apns_settings,
+    _apns_ssl_context,
+)
+
+
+class AsyncAPNSConnection(object):
+    """
+    A TLS stream to an APNS gateway. APNS only ever writes to a push
+    connection to report an error right before closing it, so a
+    listener reads that one error response in the background.
+    """
+
+    def __init__(self, address_tuple, certfile, settings=None):
+        self.address = address_tuple
+        self.certfile = certfile
+        self.key = (address_tuple[0], address_tuple[1], certfile)
+        self.settings = SETTINGS if settings is None else settings
+        self.writer = None
+        self.last_used = None
+        self._listener = None
+
+    async def connect(self):
+        self.close()
+        metrics = get_metrics()
+        with metrics.timer("apns.connect"):
+            reader, self.writer = await asyncio.open_connection(
+                    self.address[0], self.address[1],
+                    ssl=_apns_ssl_context(self.certfile))
+        metrics.increment("apns.connections.opened")
+        self._listener = asyncio.ensure_future(self._listen(reader))
+        self.last_used = time.time()
+
+    async def _listen(self, reader):
+        try:
+            data = await reader.readexactly(6)
+        except (asyncio.IncompleteReadError, OSError, ssl.SSLError):
+            return None
+
+        command, status, identifier = struct.unpack("!BBI", data)
+        # apple protocol says command is always 8. See http://goo.gl/ENUjXg
+        assert command == 8, "Command must be 8!"
+        return status, identifier
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def is_alive(self):
+        if self.writer is None or self._listener.done():
+            return False
+
+        max_idle = self.settings.get("CONNECTION_MAX_IDLE")
+        return max_idle is None or time.time() - self.last_used <= max_idle
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+        self.last_used = time.time()
+
+    async def read_error(self, timeout=0):
+        """
+        Waits at most ``timeout`` seconds for an error-response packet
+        and returns its (status, identifier), or None if there is none
+        """
+
+        if not self._listener.done():
+            await asyncio.wait([self._listener], timeout=timeout)
+        if self._listener.done() and not self._listener.cancelled():
+            return self._listener.result()
+        return None
+
+
+class AsyncAPNSConnectionPool(object):
+    """
+    A pool of idle APNS connections of one event loop keyed by
+    (host, port, certfile). Connections are sized by the APNS
+    ``settings`` of the app they were opened for.
+    """
+
+    def __init__(self, connection_class=AsyncAPNSConnection):
+        self.connection_class = connection_class
+        self._idle = {}
+
+    async def acquire(self, address_tuple, certfile, settings=None):
+        key = (address_tuple[0], address_tuple[1], certfile)
+
+        idle = self._idle.get(key, [])
+        while idle:
+            connection = idle.pop()
+            if connection.is_alive():
+                get_metrics().increment("apns.connections.reused")
+                return connection
+            connection.close()
+
+        connection = self.connection_class(address_tuple, certfile, settings)
+        await connection.connect()
+        return connection
+
+    def release(self, connection):
+        if connection.is_alive():
+            idle = self._idle.setdefault(connection.key, [])
+            if len(idle) < connection.settings["POOL_SIZE"]:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    @asynccontextmanager
+    async def connection(self, address_tuple, certfile, settings=None):
+        connection = await self.acquire(address_tuple, certfile, settings)
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            raise
+        else:
+            self.release(connection)
+
+    def clear(self):
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class AsyncAPNSBulkSender(APNSBulkSender):
+    """
+    An APNSBulkSender writing to an AsyncAPNSConnection
+    """
+
+    async def send(self, identifier, registration_id, frame):
+        entry = (identifier, registration_id, frame)
+        self.buffer.append(entry)
+        self._pending.append(entry)
+        self._pending_size += len(frame)
+        if self._pending_size >= self.write_size:
+            await self._drain()
+
+    async def finish(self, timeout=None):
+        await self._drain()
+        with get_metrics().timer("apns.error_wait"):
+            while True:
+                error = await self._read_error(timeout or 0)
+                if error is None:
+                    return self.failed
+                await self._recover(*error)
+                await self._drain()
+
+    async def _drain(self):
+        while self._pending:
+            if self.rate_limiter is not None:
+                await _acquire(self.rate_limiter, len(self._pending))
+
+            data = b"".join(entry[2] for entry in self._pending)
+            metrics = get_metrics()
+            try:
+                with metrics.timer("apns.write"):
+                    await self.connection.write(data)
+            except (OSError, ssl.SSLError):
+                error = await self._read_error(0)
+                if error is not None:
+                    await self._recover(*error)
+                else:
+                    self._throttled()
+                    await self._reconnect()
+                continue
+
+            metrics.increment("apns.frames", len(self._pending))
+            metrics.increment("apns.bytes", len(data))
+            self._record_written(self._pending)
+            self._pending.clear()
+            self._pending_size = 0
+            self._reconnects = 0
+            error = await self._read_error(0)
+            if error is not None:
+                await self._recover(*error)
+
+    async def _read_error(self, timeout):
+        return await self.connection.read_error(timeout)
+
+    async def _recover(self, status, identifier):
+        self._rewind(status, identifier)
+        await self._reconnect()
+
+    async def _reconnect(self):
+        self._reconnects += 1
+        if self._reconnects > self.MAX_RECONNECTS:
+            raise APNSPushError("Could not reconnect to APNS after %i "\
+                    "attempts" % self.MAX_RECONNECTS)
+        get_metrics().increment("apns.reconnects")
+        await self.connection.connect()
+        self._written = []
+
+
+## connections are bound to the loop they were opened in
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_connection_pool():
+    """
+    Returns the connection pool of the running loop
+    """
+
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = AsyncAPNSConnectionPool()
+    return pool
+
+
+async def _acquire(rate_limiter, count=1):
+    while True:
+        wait = rate_limiter.reserve(count)
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+
+async def _run_sync(function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, function, *args)
+
+
+async def _instrumented(awaitable, app_id=None):
+    """
+    Awaits a send, reporting its duration and sending push_sent or
+    push_failed
+    """
+
+    started = time.time()
+    try:
+        result = await awaitable
+    except Exception as e:
+        record_failed("apns", e, started, app_id)
+        raise
+    record_sent("apns", result, started, app_id)
+    return result
+
+
+async def _apns_send_bulk_async(registration_ids, alert, **kwargs):
+    template = _apns_frame_template(_apns_build_payload(alert, **kwargs), **kwargs)
+
+    app_settings = _apns_settings(kwargs.get('app_id'))
+    async with get_connection_pool().connection(
+            (app_settings["HOST"], app_settings["PORT"]),
+            _apns_get_certfile(**kwargs), app_settings) as connection:
+        sender = AsyncAPNSBulkSender(connection, rate_limiter=get_rate_limiter(
+            'APNS_SETTINGS', connection.certfile, app_settings))
+        failed = {}
+        for identifier, registration_id in enumerate(registration_ids):
+            token = _apns_decode_token(registration_id, failed)
+            if token is not None:
+                await sender.send(identifier, registration_id,
+                        template.pack(token, identifier))
+        failed.update(await sender.finish(app_settings["ERROR_TIMEOUT"]))
+        return failed
+
+
+async def apns_send_message_async(registration_id, alert, **kwargs):
+    """
+    Sends an APNS notification to a single registration_id from a
+    coroutine. Raises APNSServerError if the notification is rejected.
+    """
+
+    return await _instrumented(_apns_send_message_async(registration_id,
+        alert, **kwargs), kwargs.get('app_id'))
+
+
+async def _apns_send_message_async(registration_id, alert, **kwargs):
+    try:
+        if _apns_settings(kwargs.get('app_id'))["BACKEND"] == "http2":
+            from .apns_http2_async import apns_http2_send_message_async
+            await apns_http2_send_message_async(registration_id, alert, **kwargs)
+        else:
+            failed = await _apns_send_bulk_async([registration_id], alert,
+                    **kwargs)
+            ## failed is keyed by the hex form of the token
+            if failed:
+                raise APNSServerError(next(iter(failed.values())), 0)
+    except APNSServerError as e:
+        if e.status == INVALID_TOKEN:
+            await _run_sync(_apns_deactivate_invalid, [registration_id],
+                    kwargs.get('app_id'))
+        raise
+
+
+async def apns_send_bulk_message_async(registration_ids, alert,
+        concurrency=None, **kwargs):
+    """
+    Sends an APNS notification to one or more registration_ids from a
+    coroutine and returns a dict of {registration_id: status} for the
+    rejected ones, deactivating invalid tokens. With the http2 backend
+    up to concurrency notifications are in flight at once; the binary
+    protocol streams every frame over a single connection.
+    """
+
+    return await _instrumented(_apns_send_bulk_message_async(registration_ids,
+        alert, concurrency, **kwargs), kwargs.get('app_id'))
+
+
+async def _apns_send_bulk_message_async(registration_ids, alert,
+        concurrency=None, **kwargs):
+    if _apns_settings(kwargs.get('app_id'))["BACKEND"] == "http2":
+        from .apns_http2_async import apns_http2_send_bulk_message_async
+        failed = await apns_http2_send_bulk_message_async(registration_ids,
+                alert, concurrency=concurrency, **kwargs)
+    else:
+        failed = await _apns_send_bulk_async(registration_ids, alert, **kwargs)
+
+    await _run_sync(_apns_deactivate_invalid, [registration_id for
+        registration_id, status in failed.items() if status == INVALID_TOKEN],
+        kwargs.get('app_id'))
+    return failed
@@ -0,0 +1,604 @@
+"""
+Apple Push Notification Service over the HTTP/2 provider API
+
+Requires the ``h2`` package. Enable it by setting
+APNS_SETTINGS["BACKEND"] to "http2"; apns_send_message and
+apns_send_bulk_message then delegate to this module.
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import select
+import socket
+import ssl
+import time
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+from ..exceptions import (
+    APNSPushError,
+    APNSServerError,
+    APNSDataOverflow,
+)
+from ..credentials import get_app
+from ..metrics import get_metrics
+from ..ratelimit import get_rate_limiter
+from ..settings import INSTAPUSH_SETTINGS as settings
+from ..utils import normalize_apns_token
+from .apns import (
+    APNSConnection,
+    APNSConnectionPool,
+    _apns_build_payload,
+    _apns_get_certfile,
+    _apns_normalize_token,
+    _apns_payload_template,
+    _apns_render_payload,
+    _apns_settings,
+    _apns_ssl_context,
+)
+
+
+## maps provider API reasons onto the status codes of the binary
+## protocol so callers can handle both backends the same way
+REASON_STATUS = {
+    'BadDeviceToken': 8,
+    'DeviceTokenNotForTopic': 8,
+    'Unregistered': 8,
+    'MissingDeviceToken': 2,
+    'MissingTopic': 3,
+    'BadTopic': 6,
+    'TopicDisallowed': 6,
+    'PayloadEmpty': 4,
+    'PayloadTooLarge': 7,
+    'InternalServerError': 1,
+    'ServiceUnavailable': 10,
+    'Shutdown': 10,
+}
+UNKNOWN_STATUS = 255
+TOO_MANY_REQUESTS = 429
+SERVICE_UNAVAILABLE = 503
+## statuses of notifications that are resent after a backoff
+RETRY_STATUSES = (TOO_MANY_REQUESTS, SERVICE_UNAVAILABLE)
+## streams the server may have processed but never answered, because it
+## went silent or sent a GOAWAY, are reported with this status instead
+## of being resent
+NO_RESPONSE = 0
+PAGE_SIZE = 10000
+
+
+class APNSHTTP2Connection(APNSConnection):
+    """
+    A TLS connection speaking the HTTP/2 provider API. Notifications
+    are multiplexed as concurrent streams over the one connection.
+    """
+
+    def connect(self):
+        self.close()
+        metrics = get_metrics()
+        with metrics.timer("apns.connect"):
+            self._connect()
+        metrics.increment("apns.connections.opened")
+
+    def _connect(self):
+        context = _apns_ssl_context(self.certfile, ["h2"])
+
+        sock = socket.create_connection(self.address,
+                self.settings["CONNECT_TIMEOUT"])
+        self.socket = context.wrap_socket(sock, server_hostname=self.address[0])
+        if self.socket.selected_alpn_protocol() != "h2":
+            self.close()
+            raise APNSPushError("%s:%s does not speak HTTP/2" % self.address)
+        self._handshake()
+
+    def _handshake(self):
+        ## a silent server must not hang the sender
+        self.socket.settimeout(self.settings["HTTP2_READ_TIMEOUT"])
+        self.h2 = h2.connection.H2Connection(config=h2.config.H2Configuration(
+                client_side=True, header_encoding="utf-8"))
+        self.h2.initiate_connection()
+        self.socket.sendall(self.h2.data_to_send())
+
+        ## streams may only be opened once the server told us how many
+        ## of them it accepts concurrently
+        settings_received = False
+        while not settings_received:
+            try:
+                data = self.socket.recv(65535)
+            except socket.timeout:
+                self.close()
+                raise APNSPushError("%s:%s did not send its settings" %
+                        self.address)
+            if not data:
+                self.close()
+                raise APNSPushError("%s:%s closed the connection" % self.address)
+            for event in self.h2.receive_data(data):
+                if isinstance(event, h2.events.RemoteSettingsChanged):
+                    settings_received = True
+        self.socket.sendall(self.h2.data_to_send())
+        self.last_used = time.time()
+
+    def is_alive(self):
+        """
+        Unlike the binary protocol, the server legitimately writes to an
+        idle HTTP/2 connection (settings, pings), so pending data is
+        processed and the connection is only dead once it was closed or
+        sent a GOAWAY.
+        """
+
+        if not super(APNSHTTP2Connection, self).is_alive():
+            try:
+                return self._process_idle()
+            except (socket.error, ssl.SSLError, h2.exceptions.ProtocolError):
+                return False
+        return True
+
+    def _process_idle(self):
+        max_idle = self.settings.get("CONNECTION_MAX_IDLE")
+        if self.socket is None or (max_idle is not None
+                and time.time() - self.last_used > max_idle):
+            return False
+
+        data = _apns_recv(self.socket)
+        if data is None:
+            return True
+        if not data:
+            return False
+
+        for event in self.h2.receive_data(data):
+            if isinstance(event, h2.events.ConnectionTerminated):
+                return False
+        self.socket.sendall(self.h2.data_to_send())
+        return True
+
+    def send(self, notifications):
+        """
+        Sends an iterable of (token, payload, headers) tuples, keeping as
+        many streams open at once as the server allows. Returns a list
+        of (status, reason) tuples in the order of the notifications.
+        """
+
+        return APNSStreamMultiplexer(self, notifications, get_rate_limiter(
+            'APNS_SETTINGS', self.certfile, self.settings)).run()
+
+
+class APNSStreamMultiplexer(object):
+    """
+    Drives one batch of notifications over an HTTP/2 connection,
+    opening new streams as earlier ones complete and reconnecting to
+    resend any stream the server refused to process after a GOAWAY.
+    Notifications answered with 429 or 503 are resent after a backoff.
+    """
+
+    MAX_RECONNECTS = 3
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 1
+    MAX_BACKOFF = 60
+
+    def __init__(self, connection, notifications, rate_limiter=None):
+        self.connection = connection
+        self.rate_limiter = rate_limiter
+        self.notifications = iter(enumerate(notifications))
+        self.results = {}
+        self._retry = collections.deque()
+        ## (ready at, index, item) of the notifications waiting to be
+        ## resent after a backoff
+        self._delayed = []
+        self._attempts = {}
+        self._last_read = time.time()
+        self._in_flight = {}
+        self._blocked = collections.deque()
+        self._responses = {}
+        self._exhausted = False
+        self._reconnects = 0
+        self._bytes = 0
+        self._opened = {}
+
+    @property
+    def h2(self):
+        return self.connection.h2
+
+    def run(self):
+        while True:
+            self._open_streams()
+            self._flush()
+            if not self._in_flight:
+                if not self._delayed:
+                    break
+                time.sleep(max(0, self._delayed[0][0] - time.time()))
+                continue
+            self._receive()
+
+        metrics = get_metrics()
+        metrics.increment("apns.frames", len(self.results))
+        metrics.increment("apns.bytes", self._bytes)
+        return [self.results[index] for index in sorted(self.results)]
+
+    def _max_streams(self):
+        return min(self.connection.settings["MAX_CONCURRENT_STREAMS"],
+                self.h2.remote_settings.max_concurrent_streams)
+
+    def _next(self):
+        if self._retry:
+            return self._retry.popleft()
+        if self._delayed and self._delayed[0][0] <= time.time():
+            return heapq.heappop(self._delayed)[2]
+        if not self._exhausted:
+            try:
+                return next(self.notifications)
+            except StopIteration:
+                self._exhausted = True
+        return None
+
+    def _open_streams(self):
+        while len(self._in_flight) < self._max_streams():
+            if not self._reserve():
+                break
+
+            item = self._next()
+            if item is None:
+                break
+
+            index, (token, payload, headers) = item
+            stream_id = self.h2.get_next_available_stream_id()
+            self.h2.send_headers(stream_id, [
+                (":method", "POST"),
+                (":scheme", "https"),
+                (":path", "/3/device/%s" % token),
+                (":authority", self.connection.address[0]),
+            ] + list(headers))
+            self._in_flight[stream_id] = item
+            self._opened[stream_id] = self._last_read = time.time()
+            self._blocked.append((stream_id, payload))
+
+        self._send_blocked()
+
+    def _reserve(self):
+        """
+        Returns whether another stream may be opened under the rate
+        limit, waiting for it unless responses are pending
+        """
+
+        if self.rate_limiter is None or not self._waiting():
+            return True
+
+        while True:
+            wait = self.rate_limiter.reserve()
+            if not wait:
+                return True
+            if self._in_flight:
+                return False
+            time.sleep(wait)
+
+    def _send_blocked(self):
+        ## payloads wait here until the flow control window allows them
+        while self._blocked:
+            stream_id, payload = self._blocked[0]
+            if self.h2.local_flow_control_window(stream_id) < len(payload):
+                return
+            self.h2.send_data(stream_id, payload, end_stream=True)
+            self._bytes += len(payload)
+            self._blocked.popleft()
+
+    def _flush(self):
+        data = self.h2.data_to_send()
+        if data and self.connection.socket is not None:
+            self.connection.socket.sendall(data)
+
+    def _waiting(self):
+        """
+        Returns whether notifications are left to be sent
+        """
+        return bool(self._retry or self._delayed or not self._exhausted)
+
+    def _receive(self):
+        sock = self.connection.socket
+        if not sock.pending():
+            deadline = self._last_read + \
+                    self.connection.settings["HTTP2_READ_TIMEOUT"]
+            ## wakes up in time to resend the next delayed notification
+            wake = min([deadline] + [ready for ready, _, _ in self._delayed[:1]])
+            readable, _, _ = select.select([sock], [], [],
+                    max(0, wake - time.time()))
+            if not readable:
+                if time.time() >= deadline:
+                    return self._expire()
+                return
+
+        data = _apns_recv(sock)
+        if data is None:
+            return
+        if not data:
+            return self._reconnect()
+        self._last_read = time.time()
+
+        for event in self.h2.receive_data(data):
+            self._handle(event)
+
+        self._send_blocked()
+        self.connection.last_used = time.time()
+
+    def _handle(self, event):
+        if isinstance(event, h2.events.ResponseReceived):
+            self._responses[event.stream_id] = [dict(event.headers), b""]
+        elif isinstance(event, h2.events.DataReceived):
+            self._responses[event.stream_id][1] += event.data
+            self.h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            headers, body = self._responses.pop(event.stream_id)
+            item = self._in_flight.pop(event.stream_id)
+            get_metrics().timing("apns.http2.stream",
+                    time.time() - self._opened.pop(event.stream_id))
+            result = _apns_parse_response(headers, body)
+            self._reconnects = 0
+            if result[0] != 200:
+                get_metrics().increment("apns.http2.status.%d" % result[0])
+            if result[0] == TOO_MANY_REQUESTS:
+                self._throttled()
+            if result[0] not in RETRY_STATUSES or not self._delay(item,
+                    headers.get("retry-after")):
+                self.results[item[0]] = result
+        elif isinstance(event, h2.events.StreamReset):
+            get_metrics().increment("apns.http2.resets")
+            self._responses.pop(event.stream_id, None)
+            item = self._in_flight.pop(event.stream_id, None)
+            self._opened.pop(event.stream_id, None)
+            if item is not None:
+                self._retry.append(item)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self._terminated(event.last_stream_id)
+
+    def _delay(self, item, retry_after=None):
+        """
+        Queues a notification to be resent after a backoff, unless it was
+        retried MAX_RETRIES times already. Returns whether it was queued.
+        """
+
+        attempt = self._attempts.get(item[0], 0)
+        if attempt >= self.MAX_RETRIES:
+            return False
+        self._attempts[item[0]] = attempt + 1
+
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self.RETRY_BACKOFF * 2 ** attempt
+        delay = min(delay, self.MAX_BACKOFF)
+        heapq.heappush(self._delayed, (time.time() + delay, item[0], item))
+        get_metrics().increment("apns.http2.retried")
+        return True
+
+    def _terminated(self, last_stream_id):
+        """
+        Handles a GOAWAY. Streams above last_stream_id were not processed
+        and are resent; the others may have been, but their responses
+        can no longer be read on the closing connection.
+        """
+
+        self._abandon([stream_id for stream_id in self._in_flight
+            if stream_id <= last_stream_id])
+        self._reconnect()
+
+    def _expire(self):
+        """
+        Gives up on the open streams once nothing was read for
+        HTTP2_READ_TIMEOUT seconds, and on the connection with them
+        """
+
+        self._abandon(list(self._in_flight))
+        if not self._waiting():
+            self._blocked.clear()
+            self._responses.clear()
+            self.connection.close()
+        else:
+            self._reconnect()
+
+    def _abandon(self, stream_ids):
+        for stream_id in stream_ids:
+            index = self._in_flight.pop(stream_id)[0]
+            self._opened.pop(stream_id, None)
+            self._responses.pop(stream_id, None)
+            self.results[index] = (NO_RESPONSE, None)
+        get_metrics().increment("apns.http2.unanswered", len(stream_ids))
+
+    def _reconnect(self):
+        ## anything still in flight was not processed by the server
+        self._retry.extend(self._in_flight[stream_id]
+                for stream_id in sorted(self._in_flight))
+        self._in_flight.clear()
+        self._opened.clear()
+        self._blocked.clear()
+        self._responses.clear()
+
+        self._throttled()
+        self._reconnects += 1
+        if self._reconnects > self.MAX_RECONNECTS:
+            raise APNSPushError("Could not reconnect to APNS after %i "\
+                    "attempts" % self.MAX_RECONNECTS)
+        get_metrics().increment("apns.reconnects")
+        self.connection.connect()
+
+    def _throttled(self):
+        get_metrics().increment("apns.throttled")
+        if self.rate_limiter is not None:
+            self.rate_limiter.throttled()
+
+
+def _apns_recv(sock):
+    """
+    Reads from a socket select reported readable without blocking.
+    Returns None if it only held TLS records without data, such as the
+    session tickets of TLS 1.3.
+    """
+
+    saved_timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return sock.recv(65535)
+    except ssl.SSLWantReadError:
+        return None
+    finally:
+        sock.settimeout(saved_timeout)
+
+
+def _apns_parse_response(headers, body):
+    status = int(headers.get(":status", 0))
+    if status == 200:
+        return 200, None
+
+    reason = None
+    if body:
+        try:
+            reason = json.loads(body.decode("utf-8")).get("reason")
+        except ValueError:
+            pass
+    return status, reason
+
+
+def _apns_http2_headers(topic=None, expiration=None, priority=10,
+        collapse_id=None, **kwargs):
+    headers = [("apns-priority", str(priority))]
+
+    topic = topic or _apns_settings(kwargs.get("app_id")).get("TOPIC")
+    if topic:
+        headers.append(("apns-topic", topic))
+
+    if expiration is not None:
+        headers.append(("apns-expiration", str(expiration)))
+
+    if collapse_id:
+        headers.append(("apns-collapse-id", collapse_id))
+
+    return headers
+
+
+def _apns_http2_status(status, reason):
+    if status == 413:
+        reason = "PayloadTooLarge"
+    return REASON_STATUS.get(reason, UNKNOWN_STATUS)
+
+
+connection_pool = APNSConnectionPool(APNSHTTP2Connection)
+settings.on_reload(connection_pool.clear)
+
+
+def _apns_http2_connection(**kwargs):
+    app_id = kwargs.get("app_id")
+    app_settings = _apns_settings(app_id)
+
+    pool = connection_pool
+    if app_id is not None:
+        pool = get_app(app_id).apns_pool(APNSHTTP2Connection)
+    return pool.connection(
+            (app_settings["HTTP2_HOST"], app_settings["HTTP2_PORT"]),
+            _apns_get_certfile(**kwargs))
+
+
+def apns_http2_send_message(registration_id, alert, **kwargs):
+    """
+    Sends an APNS notification to a single registration_id through
+    the HTTP/2 provider API. Raises APNSServerError if the notification
+    is rejected.
+    """
+
+    token = normalize_apns_token(registration_id)
+    payload = _apns_build_payload(alert, **kwargs)
+    headers = _apns_http2_headers(**kwargs)
+
+    with _apns_http2_connection(**kwargs) as connection:
+        (status, reason), = connection.send([(token, payload, headers)])
+
+    if status == 200:
+        return
+
+    status = _apns_http2_status(status, reason)
+    if status == REASON_STATUS["PayloadTooLarge"]:
+        raise APNSDataOverflow("Notification body cannot exceed %i bytes" % (
+            _apns_settings(kwargs.get("app_id"))["MAX_SIZE"]))
+    raise APNSServerError(status, 0, reason)
+
+
+def apns_http2_send_bulk_message(registration_ids, alert, settled=None,
+        **kwargs):
+    """
+    Sends an APNS notification to one or more registration_ids through
+    the HTTP/2 provider API, multiplexing them over one connection.
+    Returns a dict of {registration_id: status} for the rejected
+    registration_ids, with statuses mapped onto the binary protocol's.
+    settled, if given, is called with the registration ids APNS answered
+    for, a page at a time.
+    """
+
+    payload = _apns_build_payload(alert, **kwargs)
+    headers = _apns_http2_headers(**kwargs)
+    failed = {}
+
+    def notifications():
+        for registration_id in registration_ids:
+            token = _apns_normalize_token(registration_id, failed)
+            if token is not None:
+                yield token, payload, headers
+
+    failed.update(_apns_http2_send_notifications(notifications(),
+        settled=settled, **kwargs))
+    return failed
+
+
+def apns_http2_send_personalized_message(registrations, alert, **kwargs):
+    """
+    Sends an APNS notification rendered for each device through the
+    HTTP/2 provider API. registrations is an iterable of
+    (registration_id, variables) tuples, see apns_send_personalized_message.
+    """
+
+    template = _apns_payload_template(alert, **kwargs)
+    headers = _apns_http2_headers(**kwargs)
+    failed = {}
+
+    def notifications():
+        for registration_id, variables in registrations:
+            token = _apns_normalize_token(registration_id, failed)
+            if token is None:
+                continue
+            try:
+                payload = _apns_render_payload(template, variables,
+                        kwargs.get("truncate"), kwargs.get("app_id"))
+            except APNSDataOverflow:
+                failed[token] = REASON_STATUS["PayloadTooLarge"]
+                continue
+            yield token, payload, headers
+
+    failed.update(_apns_http2_send_notifications(notifications(), **kwargs))
+    return failed
+
+
+def _apns_http2_send_notifications(notifications, settled=None, **kwargs):
+    """
+    Sends (registration_id, payload, headers) tuples multiplexed over one
+    connection and returns the rejected registration ids
+    """
+
+    notifications = iter(notifications)
+    failed = {}
+
+    with _apns_http2_connection(**kwargs) as connection:
+        ## notifications are consumed in pages so that iterators of any
+        ## size can be sent without holding every result in memory
+        while True:
+            page = list(itertools.islice(notifications, PAGE_SIZE))
+            if not page:
+                break
+
+            results = connection.send(page)
+            for notification, (status, reason) in zip(page, results):
+                if status != 200:
+                    failed[notification[0]] = _apns_http2_status(status, reason)
+            if settled is not None:
+                settled([notification[0] for notification in page])
+
+    return failed
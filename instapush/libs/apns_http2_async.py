@@ -0,0 +1,370 @@
+"""
+asyncio variants of the HTTP/2 APNS senders
+
+Requires the ``h2`` package. Every coroutine of an event loop shares
+one connection per certificate, each notification being a stream of
+its own, so a single loop keeps as many notifications in flight as
+APNS allows.
+"""
+
+import asyncio
+import ssl
+import time
+import weakref
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+from ..exceptions import (
+    APNSPushError,
+    APNSServerError,
+    APNSDataOverflow,
+)
+from ..metrics import get_metrics
+from ..ratelimit import get_rate_limiter
+from ..utils import normalize_apns_token
+from .apns import (
+    SETTINGS,
+    _apns_build_payload,
+    _apns_get_certfile,
+    _apns_normalize_token,
+    _apns_settings,
+    _apns_ssl_context,
+)
+from .apns_async import _acquire
+from .apns_http2 import (
+    REASON_STATUS,
+    TOO_MANY_REQUESTS,
+    _apns_http2_headers,
+    _apns_http2_status,
+    _apns_parse_response,
+)
+
+
+MAX_RECONNECTS = 3
+
+
+class StreamLost(Exception):
+    """
+    Raised for a stream the server did not process, because it reset
+    the stream or the connection went away. The notification can be
+    sent again safely.
+    """
+
+
+class AsyncAPNSHTTP2Connection(object):
+    """
+    An HTTP/2 connection to APNS shared by many coroutines. A reader
+    task feeds the responses of the connection to the coroutines
+    waiting on their streams.
+    """
+
+    def __init__(self, address_tuple, certfile, settings=None):
+        self.address = address_tuple
+        self.certfile = certfile
+        self.key = (address_tuple[0], address_tuple[1], certfile)
+        self.settings = SETTINGS if settings is None else settings
+        self.writer = None
+        self.h2 = None
+        self.terminated = False
+        self.last_used = None
+        self._streams = {}
+        self._changed = None
+        self._settings = None
+        self._reader = None
+
+    async def connect(self):
+        metrics = get_metrics()
+        with metrics.timer("apns.connect"):
+            await self._connect()
+        metrics.increment("apns.connections.opened")
+
+    async def _connect(self):
+        reader, self.writer = await asyncio.open_connection(
+                self.address[0], self.address[1],
+                ssl=_apns_ssl_context(self.certfile, ["h2"]),
+                server_hostname=self.address[0])
+
+        ssl_object = self.writer.get_extra_info("ssl_object")
+        if ssl_object.selected_alpn_protocol() != "h2":
+            self.close()
+            raise APNSPushError("%s:%s does not speak HTTP/2" % self.address)
+        await self._handshake(reader)
+
+    async def _handshake(self, reader):
+        loop = asyncio.get_running_loop()
+        self.h2 = h2.connection.H2Connection(config=h2.config.H2Configuration(
+                client_side=True, header_encoding="utf-8"))
+        self.h2.initiate_connection()
+        self._flush()
+
+        ## streams may only be opened once the server told us how many
+        ## of them it accepts concurrently
+        self._settings = loop.create_future()
+        self._reader = asyncio.ensure_future(self._read(reader))
+        await self._settings
+        self.last_used = time.time()
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self._lost()
+
+    def is_alive(self):
+        if self.writer is None or self.terminated or self._reader.done():
+            return False
+
+        max_idle = self.settings.get("CONNECTION_MAX_IDLE")
+        return bool(self._streams) or max_idle is None or \
+                time.time() - self.last_used <= max_idle
+
+    async def request(self, token, payload, headers):
+        """
+        Posts one notification and returns the (status, reason) of the
+        response. Raises StreamLost if the server did not process it.
+        """
+
+        while self.h2.open_outbound_streams >= self._max_streams():
+            await self._wait()
+        if self.terminated:
+            raise StreamLost()
+
+        stream_id = self.h2.get_next_available_stream_id()
+        self.h2.send_headers(stream_id, [
+            (":method", "POST"),
+            (":scheme", "https"),
+            (":path", "/3/device/%s" % token),
+            (":authority", self.address[0]),
+        ] + list(headers))
+        future = asyncio.get_running_loop().create_future()
+        self._streams[stream_id] = [future, None, b""]
+
+        try:
+            ## the payload waits until the flow control window allows it
+            while self.h2.local_flow_control_window(stream_id) < len(payload):
+                self._flush()
+                await self._wait()
+            self.h2.send_data(stream_id, payload, end_stream=True)
+            self._flush()
+            await self.writer.drain()
+            return await future
+        except (OSError, ssl.SSLError, h2.exceptions.StreamClosedError):
+            raise StreamLost()
+        finally:
+            self._streams.pop(stream_id, None)
+            self.last_used = time.time()
+
+    def _max_streams(self):
+        return min(self.settings["MAX_CONCURRENT_STREAMS"],
+                self.h2.remote_settings.max_concurrent_streams)
+
+    async def _wait(self):
+        """
+        Waits until a stream was closed or the flow control window grew
+        """
+
+        if self._changed is None or self._changed.done():
+            self._changed = asyncio.get_running_loop().create_future()
+        await self._changed
+
+    def _notify(self):
+        if self._changed is not None and not self._changed.done():
+            self._changed.set_result(None)
+
+    def _flush(self):
+        data = self.h2.data_to_send()
+        if data and self.writer is not None:
+            self.writer.write(data)
+
+    async def _read(self, reader):
+        try:
+            while True:
+                data = await reader.read(65535)
+                if not data:
+                    break
+                for event in self.h2.receive_data(data):
+                    self._handle(event)
+                self._flush()
+                self._notify()
+        except (OSError, ssl.SSLError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            self.terminated = True
+            self._lost()
+
+    def _handle(self, event):
+        if isinstance(event, h2.events.RemoteSettingsChanged):
+            if not self._settings.done():
+                self._settings.set_result(None)
+        elif isinstance(event, h2.events.ResponseReceived):
+            ## the caller of a stream may have been cancelled or timed
+            ## out before its response arrived, which is then ignored
+            stream = self._streams.get(event.stream_id)
+            if stream is not None:
+                stream[1] = dict(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            self.h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            stream = self._streams.get(event.stream_id)
+            if stream is not None:
+                stream[2] += event.data
+        elif isinstance(event, h2.events.StreamEnded):
+            stream = self._streams.get(event.stream_id)
+            if stream is not None and not stream[0].done():
+                stream[0].set_result(_apns_parse_response(stream[1],
+                    stream[2]))
+        elif isinstance(event, h2.events.StreamReset):
+            stream = self._streams.get(event.stream_id)
+            if stream is not None and not stream[0].done():
+                stream[0].set_exception(StreamLost())
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            ## streams above the last one processed will never be
+            ## answered, the others still are
+            self.terminated = True
+            for stream_id, stream in self._streams.items():
+                if stream_id > event.last_stream_id and not stream[0].done():
+                    stream[0].set_exception(StreamLost())
+
+    def _lost(self):
+        for future, headers, body in self._streams.values():
+            if not future.done():
+                future.set_exception(StreamLost())
+        for future in (self._settings, self._changed):
+            if future is not None and not future.done():
+                future.set_exception(StreamLost())
+
+
+## connections are bound to the loop they were opened in
+_connections = weakref.WeakKeyDictionary()
+
+
+async def get_connection(address_tuple, certfile, settings=None):
+    """
+    Returns the live connection of the running loop to the address
+    for the certificate, opening it with the APNS ``settings`` of its
+    app if needed
+    """
+
+    loop = asyncio.get_running_loop()
+    connections, locks = _connections.setdefault(loop, ({}, {}))
+    key = (address_tuple[0], address_tuple[1], certfile)
+
+    connection = connections.get(key)
+    if connection is not None and connection.is_alive():
+        return connection
+
+    lock = locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        connection = connections.get(key)
+        if connection is None or not connection.is_alive():
+            if connection is not None:
+                connection.close()
+            connection = AsyncAPNSHTTP2Connection(address_tuple, certfile,
+                    settings)
+            try:
+                await connection.connect()
+            except StreamLost:
+                raise APNSPushError("%s:%s closed the connection" % address_tuple)
+            connections[key] = connection
+    return connection
+
+
+async def _apns_http2_request(token, payload, headers, certfile, app_id=None):
+    app_settings = _apns_settings(app_id)
+    address_tuple = (app_settings["HTTP2_HOST"], app_settings["HTTP2_PORT"])
+    rate_limiter = get_rate_limiter('APNS_SETTINGS', certfile, app_settings)
+    metrics = get_metrics()
+
+    for attempt in range(MAX_RECONNECTS + 1):
+        if rate_limiter is not None:
+            await _acquire(rate_limiter)
+
+        connection = await get_connection(address_tuple, certfile,
+                app_settings)
+        try:
+            with metrics.timer("apns.http2.stream"):
+                response = await connection.request(token, payload, headers)
+        except StreamLost:
+            metrics.increment("apns.http2.resets")
+            if rate_limiter is not None:
+                rate_limiter.throttled()
+            continue
+
+        metrics.increment("apns.frames")
+        metrics.increment("apns.bytes", len(payload))
+        if response[0] != 200:
+            metrics.increment("apns.http2.status.%d" % response[0])
+        if rate_limiter is not None and response[0] == TOO_MANY_REQUESTS:
+            rate_limiter.throttled()
+        return response
+
+    raise APNSPushError("Could not reconnect to APNS after %i "\
+            "attempts" % MAX_RECONNECTS)
+
+
+async def apns_http2_send_message_async(registration_id, alert, **kwargs):
+    """
+    Sends an APNS notification to a single registration_id through
+    the HTTP/2 provider API from a coroutine. Raises APNSServerError if
+    the notification is rejected.
+    """
+
+    token = normalize_apns_token(registration_id)
+    payload = _apns_build_payload(alert, **kwargs)
+    headers = _apns_http2_headers(**kwargs)
+
+    status, reason = await _apns_http2_request(token, payload,
+            headers, _apns_get_certfile(**kwargs), kwargs.get("app_id"))
+    if status == 200:
+        return
+
+    status = _apns_http2_status(status, reason)
+    if status == REASON_STATUS["PayloadTooLarge"]:
+        raise APNSDataOverflow("Notification body cannot exceed %i bytes" % (
+            _apns_settings(kwargs.get("app_id"))["MAX_SIZE"]))
+    raise APNSServerError(status, 0, reason)
+
+
+async def apns_http2_send_bulk_message_async(registration_ids, alert,
+        concurrency=None, **kwargs):
+    """
+    Sends an APNS notification to one or more registration_ids through
+    the HTTP/2 provider API from a coroutine, with at most concurrency
+    notifications in flight. Returns a dict of {registration_id: status}
+    for the rejected registration_ids.
+    """
+
+    payload = _apns_build_payload(alert, **kwargs)
+    headers = _apns_http2_headers(**kwargs)
+    certfile = _apns_get_certfile(**kwargs)
+    app_id = kwargs.get("app_id")
+    concurrency = concurrency or SETTINGS["MAX_CONCURRENT_STREAMS"]
+
+    ## the workers share one iterator, so ids are consumed lazily and
+    ## no more than concurrency of them are held at once
+    registration_ids = iter(registration_ids)
+    failed = {}
+
+    async def worker():
+        for registration_id in registration_ids:
+            token = _apns_normalize_token(registration_id, failed)
+            if token is None:
+                continue
+            status, reason = await _apns_http2_request(token, payload,
+                    headers, certfile, app_id)
+            if status != 200:
+                failed[token] = _apns_http2_status(status, reason)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+
+    return failed
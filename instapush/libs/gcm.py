@@ -2,31 +2,194 @@
 A stand-alone library to send GCM push notifications
 """
 
+import collections
 import json
+import random
+import threading
+import time
+import zlib
+from email.utils import mktime_tz, parsedate_tz
+from concurrent.futures import ThreadPoolExecutor
 
 ## import urllib methods
 try:
-    from urllib.request import Request, urlopen
     from urllib.parse import urlencode
 except ImportError:
-    from urllib2 import Request, urlopen
     from urllib import urlencode
 
 from django.conf import settings as django_settings
 from django.core.exceptions import ImproperlyConfigured
 
-from ..exceptions import GCMPushError
+from ..credentials import get_app, get_provider_settings
+from ..dedup import fingerprint, get_deduplicator
+from ..exceptions import GCMPushError, GCMServerError
+from ..metrics import get_metrics, instrumented
+from ..payloads import compile_template
+from ..ratelimit import get_rate_limiter
 from ..settings import INSTAPUSH_SETTINGS as settings
+from ..signals import devices_unregistered
+
+
+UNREGISTERED_ERRORS = ("NotRegistered", "InvalidRegistration")
+RETRYABLE_ERRORS = ("Unavailable", "InternalServerError")
+## results GCM returns when it throttles a sender, retried once the
+## rate limit was lowered
+THROTTLED_ERRORS = ("DeviceMessageRateExceeded", "TopicsMessageRateExceeded",
+        "QuotaExceeded")
+THROTTLED_STATUSES = (429, 503)
+PLAIN_CONTENT_TYPE = "application/x-www-form-urlencoded;charset=UTF-8"
+JSON_CONTENT_TYPE = "application/json"
+TOPIC_PREFIX = "/topics/"
+## the instance id api accepts at most this many registration ids
+## per batch subscription request
+TOPIC_BATCH_SIZE = 1000
+## instance id errors of registration ids that no longer exist
+TOPIC_UNREGISTERED_ERRORS = ("NOT_FOUND",)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the process wide session used to talk to GCM. Its
+    connection pool keeps HTTPS connections alive across sends and
+    is safe to share between threads.
+    """
+
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session(
+                        settings.get('GCM_SETTINGS').get('POOL_SIZE'))
+    return _session
+
+
+@settings.on_reload
+def _reset_session():
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+
+def create_session(pool_size):
+    """
+    Returns a new session keeping up to pool_size connections per host
+    """
+
+    ## requests is only imported once gcm is first used
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    adapter = HTTPAdapter(pool_connections=pool_size,
+            pool_maxsize=pool_size, pool_block=True)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _topic_path(topic):
+    if topic.startswith(TOPIC_PREFIX):
+        return topic
+    return TOPIC_PREFIX + topic
+
+
+def _retry_after(response):
+    """
+    Returns the Retry-After header of a response in seconds, it may
+    either be a number of seconds or an http date.
+    """
+
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, mktime_tz(date) - time.time())
+
+
+def _unavailable_result(count):
+    """
+    Returns the response of a chunk of count registration ids GCM kept
+    answering with server errors, each of them marked Unavailable
+    """
+
+    return {"multicast_id": None, "success": 0, "failure": count,
+            "canonical_ids": 0,
+            "results": [{"error": "Unavailable"} for _ in range(count)]}
+
+
+class GCMBulkResult(list):
+    """
+    The per-chunk results of a bulk send in chunk order, along with
+    the counts, results, unregistered ids and {registration_id: error}
+    of the failed ids aggregated across chunks.
+    """
+
+    def __init__(self, chunks=(), results=()):
+        super(GCMBulkResult, self).__init__()
+
+        self.success = 0
+        self.failure = 0
+        self.canonical_ids = 0
+        self.results = []
+        self.unregistered = []
+        self.failed = {}
+
+        for chunk, result in zip(chunks, results):
+            self.add(chunk, result)
+
+    def add(self, chunk, result):
+        self.append(result)
+        self.success += result.get("success", 0)
+        self.failure += result.get("failure", 0)
+        self.canonical_ids += result.get("canonical_ids", 0)
+
+        for rid, item in zip(chunk, result.get("results", [])):
+            self.results.append(item)
+            if "error" in item:
+                self.failed[rid] = item["error"]
+            if item.get("error") in UNREGISTERED_ERRORS:
+                self.unregistered.append(rid)
+
+    def merge(self, other):
+        """
+        Adds the chunks of another bulk result after those of this one
+        """
+
+        self.extend(other)
+        self.success += other.success
+        self.failure += other.failure
+        self.canonical_ids += other.canonical_ids
+        self.results.extend(other.results)
+        self.unregistered.extend(other.unregistered)
+        self.failed.update(other.failed)
 
 
 class GCMMessenger(object):
 
-    def __init__(self, registration_id, data, encoding='utf-8', **kwargs):
+    def __init__(self, registration_id, data, encoding='utf-8', app_id=None,
+            **kwargs):
 
         self._registration_id = registration_id
         self._data = data
         self._kwargs = kwargs
         self.encoding = encoding
+        self.app_id = app_id
 
         for k,v in kwargs.items():
             setattr(self, k, v)
@@ -35,13 +198,13 @@ class GCMMessenger(object):
         self._prepare_settings()
 
     def _chunks(self):
-        for item in range(0, len(self.registration_id), self.max_recipients):
-            yield self.registration_id[item:item+self.max_recipients]
+        for item in range(0, len(self._registration_id), self.max_recipients):
+            yield self._registration_id[item:item+self.max_recipients]
 
     def _prepare_settings(self):
 
         cons = ['API_KEY',]
-        gcm_settings = settings.get('GCM_SETTINGS')
+        gcm_settings = self._settings()
 
         for x in cons:
             item = gcm_settings.get(x)
@@ -58,6 +221,11 @@ class GCMMessenger(object):
         Sends a text/plain GCM message
         """
 
+        self._acquire(1)
+        result = self._send(self._plain_body(), PLAIN_CONTENT_TYPE)
+        return self._plain_result(result)
+
+    def _plain_body(self):
         values = {"registration_id": self._registration_id}
 
         for key, val in self._data.items():
@@ -68,37 +236,121 @@ class GCMMessenger(object):
                 val = 1
                 values[key] = val
 
-        data = urlencode(sorted(values.items())).encode(self.encoding)
-        result = self._send(data, "application/x-www-form-urlencoded;charset=UTF-8")
+        return urlencode(sorted(values.items())).encode(self.encoding)
 
+    def _plain_result(self, result):
         if result.startswith("Error="):
+            get_metrics().increment("gcm.errors.%s" % result[len("Error="):])
             if result in ("Error=NotRegistered", "Error=InvalidRegistration"):
-                ## TODO: deactivate the unregistered device
+                self.deactivate_unregistered_devices([self._registration_id])
                 return result
 
             raise GCMPushError(result)
 
+        get_metrics().increment("gcm.success")
         return result
 
-    def send_json(self, ids=None):
+    def send_json(self, ids=None, body=None):
         """
-        Sends a json GCM message
+        Sends a json GCM message. Registration ids whose result is
+        Unavailable or InternalServerError are resent on their own with
+        exponential backoff, up to MAX_RETRIES times, and reported with
+        that error once the retries run out; a resend GCM answers with
+        server errors leaves them Unavailable. A prebuilt body must
+        address exactly ids and is resent as is.
         """
 
         items = ids or self._registration_id
-        values = {"registration_ids": items}
+        pending = list(range(len(items)))
+        result = None
+        attempt = 0
+        get_metrics().histogram("gcm.chunk_size", len(items))
+
+        while True:
+            self._acquire(len(pending))
+            try:
+                response = self._request(body or self._json_body(
+                    [items[index] for index in pending]), JSON_CONTENT_TYPE)
+            except GCMServerError:
+                if result is None:
+                    raise
+                ## the results of the earlier attempts are kept
+                result = self._merge_results(result, pending,
+                        _unavailable_result(len(pending)))
+                break
+            partial = json.loads(response.content.decode(self.encoding))
+            result = self._merge_results(result, pending, partial)
+
+            retry = self._retryable(pending, partial)
+            if not retry or attempt >= self.max_retries:
+                break
+
+            self._backoff(attempt, _retry_after(response))
+            pending = retry
+            attempt += 1
+
+        return self._json_result(items, result)
+
+    def _retryable(self, pending, partial):
+        """
+        Returns the indexes of the pending registration ids that GCM
+        asked to be resent
+        """
 
-        if self._data is not None:
-            values["data"] = self._data
+        retry = []
+        throttled = False
+        for position, item in enumerate(partial.get("results", [])):
+            error = item.get("error")
+            if error in THROTTLED_ERRORS:
+                throttled = True
+                retry.append(pending[position])
+            elif error in RETRYABLE_ERRORS:
+                retry.append(pending[position])
+
+        if throttled:
+            self._throttled()
+        if retry:
+            get_metrics().increment("gcm.retried", len(retry))
+        return retry
+
+    def _rate_limiter(self):
+        return get_rate_limiter('GCM_SETTINGS', self.api_key, self._settings())
+
+    def _acquire(self, count):
+        """
+        Blocks until count messages can be sent under the rate limit
+        """
 
-        for key, val in self._kwargs.items():
-            if val:
-                values[key] = val
+        rate_limiter = self._rate_limiter()
+        if rate_limiter is not None:
+            rate_limiter.acquire(count)
+
+    def _throttled(self):
+        get_metrics().increment("gcm.throttled")
+        rate_limiter = self._rate_limiter()
+        if rate_limiter is not None:
+            rate_limiter.throttled()
+
+    def _json_result(self, items, result):
+        """
+        Updates canonical ids, deactivates unregistered devices and
+        raises for any error of a json response that is neither an
+        unregistered id nor one left over from retries
+        """
 
-        data = json.dumps(values, separators=(",", ":"), sort_keys=True).encode(
-                self.encoding)
+        metrics = get_metrics()
+        metrics.increment("gcm.success", result.get("success", 0))
+        metrics.increment("gcm.failure", result.get("failure", 0))
 
-        result = json.loads(self._send(data, "application/json"))
+        canonical = []
+        for index, item in enumerate(result.get("results", [])):
+            if item.get("registration_id"):
+                canonical.append((items[index], item["registration_id"]))
+            if item.get("error"):
+                metrics.increment("gcm.errors.%s" % item["error"])
+        if canonical:
+            metrics.increment("gcm.canonical_ids", len(canonical))
+            self.update_canonical_ids(canonical)
 
         if ("failure" in result) and (result["failure"]):
             unregistered = []
@@ -106,9 +358,10 @@ class GCMMessenger(object):
 
             for index, error in enumerate(result.get("results", [])):
                 error = error.get("error", "")
-                if error in ("NotRegistered", "InvalidRegistration"):
+                if error in UNREGISTERED_ERRORS:
                     unregistered.append(items[index])
-                elif error != "":
+                elif error != "" and error not in RETRYABLE_ERRORS and \
+                        error not in THROTTLED_ERRORS:
                     throw_error = True
 
             self.deactivate_unregistered_devices(unregistered)
@@ -117,36 +370,408 @@ class GCMMessenger(object):
 
         return result
 
-    def send_bulk(self):
-        if len(self._registration_id) > self.max_recipients:
-            result = []
-            for chunk in self._chunks():
-                result.append(self.send_json(ids=chunk))
+    def _json_body(self, ids, target=None):
+        return json.dumps(self._json_values(ids, target), separators=(",", ":"),
+                sort_keys=True).encode(self.encoding)
+
+    def _json_values(self, ids, target=None):
+        ## a target ({"to": ...} or {"condition": ...}) replaces the ids
+        values = {"registration_ids": ids} if target is None else dict(target)
+
+        if self._data is not None:
+            values["data"] = self._data
+
+        for key, val in self._kwargs.items():
+            if val:
+                values[key] = val
+
+        return values
+
+    def _json_template(self):
+        """
+        Returns the compiled body of a personalized message, addressed
+        to the $registration_id variable
+        """
 
-            return result
+        return compile_template(self._json_values(["${registration_id}"]))
+
+    def _merge_results(self, result, pending, partial):
+        """
+        Folds the response of a retry into the result of the first
+        attempt and recomputes its counts.
+        """
+
+        if result is None:
+            return partial
+
+        results = result.get("results", [])
+        for position, item in enumerate(partial.get("results", [])):
+            results[pending[position]] = item
+
+        result["success"] = len([r for r in results if "error" not in r])
+        result["failure"] = len(results) - result["success"]
+        result["canonical_ids"] = len([r for r in results
+            if r.get("registration_id")])
+        return result
+
+    def _backoff(self, attempt, retry_after=None):
+        time.sleep(self._backoff_delay(attempt, retry_after))
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        delay = min(self.max_backoff, self.retry_backoff * (2 ** attempt))
+        delay = random.uniform(delay / 2.0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def send_bulk(self, concurrency=None):
+        """
+        Sends a json GCM message to every registration id, split into
+        chunks of MAX_RECIPIENTS. With a concurrency above 1, up to that
+        many chunks are in flight at once; results keep chunk order.
+        """
+
+        if len(self._registration_id) > self.max_recipients:
+            return self.send_chunks(self._chunks(), concurrency)
         return self.send_json()
 
+    def send_chunks(self, chunks, concurrency=None, sent=None):
+        """
+        Sends a json GCM message to each chunk of registration ids of an
+        iterable, which is consumed lazily: at most concurrency chunks
+        are held in memory and in flight at once. sent, if given, is
+        called with each chunk once it was answered.
+        """
+
+        return self._dispatch(((chunk, None) for chunk in chunks), concurrency,
+                sent)
+
+    def send_personalized(self, registrations, concurrency=None):
+        """
+        Sends the message rendered for each device of an iterable of
+        (registration_id, variables) tuples, one request per device.
+        The data and options may hold $name placeholders filled from
+        the variables of each device (see instapush.payloads).
+        """
+
+        template = self._json_template()
+
+        def requests():
+            for registration_id, variables in registrations:
+                variables = dict(variables, registration_id=registration_id)
+                yield [registration_id], template.render(variables)
+
+        return self._dispatch(requests(), concurrency)
+
+    def _dispatch(self, requests, concurrency=None, sent=None):
+        """
+        Sends a json GCM message for each (ids, body) pair of an
+        iterable, which is consumed lazily: at most concurrency requests
+        are held in memory and in flight at once. A body of None is
+        built from the ids. sent, if given, is called with the ids of
+        each request once it was answered. A request GCM kept answering
+        with server errors has its ids reported Unavailable rather than
+        losing the results of the others.
+        """
+
+        concurrency = concurrency or self.concurrency
+        result = GCMBulkResult()
+
+        def send(ids, body):
+            try:
+                return self.send_json(ids, body)
+            except GCMServerError:
+                get_metrics().increment("gcm.errors.Unavailable", len(ids))
+                return _unavailable_result(len(ids))
+
+        def add(ids, response):
+            result.add(ids, response)
+            if sent is not None:
+                sent(ids)
+
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                in_flight = collections.deque()
+                for ids, body in requests:
+                    in_flight.append((ids, executor.submit(send, ids, body)))
+                    if len(in_flight) >= concurrency:
+                        ids, future = in_flight.popleft()
+                        add(ids, future.result())
+
+                while in_flight:
+                    ids, future = in_flight.popleft()
+                    add(ids, future.result())
+        else:
+            for ids, body in requests:
+                add(ids, send(ids, body))
+
+        return result
+
+    def send_to_topic(self, topic=None, condition=None):
+        """
+        Sends a json GCM message to every device subscribed to topic, or
+        matching a condition of topics such as
+        "'news' in topics || 'sports' in topics", in a single request
+        """
+
+        if condition is not None:
+            return self._send_to({"condition": condition})
+        return self._send_to({"to": _topic_path(topic)})
+
+    def send_to_group(self, notification_key):
+        """
+        Sends a json GCM message to every device of a device group in a
+        single request
+        """
+
+        return self._send_to({"to": notification_key})
+
+    def _send_to(self, target):
+        body = self._json_body(None, target)
+        attempt = 0
+
+        while True:
+            self._acquire(1)
+            response = self._request(body, JSON_CONTENT_TYPE)
+            result = json.loads(response.content.decode(self.encoding))
+            if not self._retry_target(result) or attempt >= self.max_retries:
+                break
+
+            self._backoff(attempt, _retry_after(response))
+            attempt += 1
+
+        return self._target_result(result)
+
+    def _retry_target(self, result):
+        """
+        Returns whether GCM asked for a topic or group message to be
+        resent
+        """
+
+        error = result.get("error")
+        if error in THROTTLED_ERRORS:
+            self._throttled()
+        elif error not in RETRYABLE_ERRORS:
+            return False
+
+        get_metrics().increment("gcm.retried")
+        return True
+
+    def _target_result(self, result):
+        """
+        Raises for the error of a topic or group response. Device group
+        responses count the devices reached; their failed_registration_ids
+        are left to the caller.
+        """
+
+        metrics = get_metrics()
+        error = result.get("error")
+        if error:
+            metrics.increment("gcm.errors.%s" % error)
+            raise GCMPushError(result)
+
+        metrics.increment("gcm.success", result.get("success", 1))
+        metrics.increment("gcm.failure", result.get("failure", 0))
+        return result
+
+    def subscribe(self, topic):
+        """
+        Subscribes the registration ids to topic, in instance id batch
+        requests of TOPIC_BATCH_SIZE ids. Returns {registration_id: error}
+        for the ids that could not be subscribed.
+        """
+
+        return self._manage_topic("batchAdd", topic)
+
+    def unsubscribe(self, topic):
+        """
+        Unsubscribes the registration ids from topic, see subscribe
+        """
+
+        return self._manage_topic("batchRemove", topic)
+
+    def _manage_topic(self, operation, topic):
+        url = "%s:%s" % (self.iid_url, operation)
+        failed = {}
+
+        for offset in range(0, len(self._registration_id), TOPIC_BATCH_SIZE):
+            chunk = self._registration_id[offset:offset + TOPIC_BATCH_SIZE]
+            result = self._manage(url, {"to": _topic_path(topic),
+                "registration_tokens": chunk})
+
+            unregistered = []
+            for registration_id, item in zip(chunk, result.get("results", [])):
+                error = item.get("error")
+                if error:
+                    failed[registration_id] = error
+                if error in TOPIC_UNREGISTERED_ERRORS:
+                    unregistered.append(registration_id)
+            if unregistered:
+                self.deactivate_unregistered_devices(unregistered)
+
+        return failed
+
+    def create_group(self, name):
+        """
+        Creates a device group of the registration ids, named name, and
+        returns its notification key
+        """
+
+        return self._manage_group("create", name)
+
+    def add_to_group(self, name, notification_key):
+        """
+        Adds the registration ids to a device group
+        """
+
+        return self._manage_group("add", name, notification_key)
+
+    def remove_from_group(self, name, notification_key):
+        """
+        Removes the registration ids from a device group. GCM deletes
+        the group once its last device was removed.
+        """
+
+        return self._manage_group("remove", name, notification_key)
+
+    def _manage_group(self, operation, name, notification_key=None):
+        if not self.sender_id:
+            raise ImproperlyConfigured("Please add SENDER_ID to your "\
+                    "GCM_SETTINGS to manage gcm device groups")
+
+        values = {
+            "operation": operation,
+            "notification_key_name": name,
+            "registration_ids": list(self._registration_id),
+        }
+        if notification_key is not None:
+            values["notification_key"] = notification_key
+
+        result = self._manage(self.notification_key_url, values,
+                {"project_id": str(self.sender_id)})
+        return result["notification_key"]
+
+    def _manage(self, url, values, headers=None):
+        """
+        Posts a json request to one of the GCM management apis and
+        returns its response, raising GCMPushError with the error it
+        reported
+        """
+
+        from requests import HTTPError
+
+        body = json.dumps(values, separators=(",", ":"),
+                sort_keys=True).encode(self.encoding)
+        try:
+            response = self._request(body, JSON_CONTENT_TYPE, url, headers)
+        except HTTPError as e:
+            raise GCMPushError(e.response.content.decode(self.encoding))
+        return json.loads(response.content.decode(self.encoding))
+
     def deactivate_unregistered_devices(self, rids):
-        deactivate_callback = settings.get('GCM_SETTINGS').get(
-                'DEACTIVATE_UNREG_CALLBACK')
+        if rids:
+            get_metrics().increment("gcm.unregistered", len(rids))
+            devices_unregistered.send(sender="gcm", registration_ids=rids,
+                    app_id=self.app_id)
+        deactivate_callback = self._settings().get('DEACTIVATE_UNREG_CALLBACK')
         deactivate_callback(rids)
 
+    def update_canonical_ids(self, pairs):
+        canonical_callback = self._settings().get('CANONICAL_ID_CALLBACK')
+        canonical_callback(pairs)
+
+    def _settings(self):
+        return get_provider_settings('GCM_SETTINGS', self.app_id)
+
+    def _session(self):
+        if self.app_id is None:
+            return get_session()
+        return get_app(self.app_id).gcm_session
 
     def _send(self, data, content_type):
         """
         Sends a GCM message with the given content type
         """
 
+        return self._request(data, content_type).content.decode(self.encoding)
+
+    def _request(self, data, content_type, url=None, headers=None):
+        """
+        Posts to GCM, retrying 5xx responses with exponential backoff
+        and honoring their Retry-After header.
+        """
+
+        attempt = 0
+        while True:
+            try:
+                return self._post(data, content_type, url, headers)
+            except GCMServerError as e:
+                if e.status in THROTTLED_STATUSES:
+                    self._throttled()
+                if attempt >= self.max_retries:
+                    raise
+                self._backoff(attempt, e.retry_after)
+                attempt += 1
+
+    def _headers(self, data, content_type):
+        """
+        Returns the request body and headers of a post to GCM
+        """
+
         headers = {
             "Content-Type": content_type,
             "Authorization": "key=%s" % (self.api_key),
-            "Content-Length": str(len(data))
         }
 
-        request = Request(self.api_url, data, headers)
-        return urlopen(request).read().decode(self.encoding)
+        if self.gzip_requests:
+            data = _gzip(data)
+            headers["Content-Encoding"] = "gzip"
+
+        return data, headers
+
+    def _post(self, data, content_type, url=None, headers=None):
+
+        data, request_headers = self._headers(data, content_type)
+        if headers:
+            request_headers.update(headers)
+
+        metrics = get_metrics()
+        with metrics.timer("gcm.request"):
+            response = self._session().post(url or self.api_url, data=data,
+                    headers=request_headers, timeout=(self.connect_timeout,
+                        self.read_timeout))
+        metrics.increment("gcm.requests")
+        metrics.increment("gcm.bytes", len(data))
+
+        if response.status_code != 200:
+            metrics.increment("gcm.http_errors.%d" % response.status_code)
+        if response.status_code >= 500 or response.status_code in \
+                THROTTLED_STATUSES:
+            raise GCMServerError(response.status_code, _retry_after(response))
+        response.raise_for_status()
+        return response
+
+
+def _gcm_deduplicator(data, kwargs):
+    """
+    Returns the Deduplicator of a bulk send, identifying the message by
+    its collapse_key if it has one
+    """
+
+    notification = kwargs.get('collapse_key') or fingerprint(data,
+            dict((key, value) for key, value in kwargs.items()
+                if key not in ('app_id', 'concurrency')))
+    return get_deduplicator('GCM_SETTINGS', notification,
+            get_provider_settings('GCM_SETTINGS', kwargs.get('app_id')))
 
 
+def _gcm_forget_failed(deduplicator, result):
+    ## ids GCM could not deliver to for now may be sent to again
+    deduplicator.forget([rid for rid, error in result.failed.items()
+        if error not in UNREGISTERED_ERRORS])
+
+
+@instrumented("gcm")
 def gcm_send_message(registration_id, data, encoding='utf-8', **kwargs):
     """
     Standalone method to send a single gcm notification
@@ -156,10 +781,125 @@ def gcm_send_message(registration_id, data, encoding='utf-8', **kwargs):
     return messenger.send_plain()
 
 
-def gcm_send_bulk_message(registration_ids, data, encoding='utf-8', **kwargs):
+@instrumented("gcm")
+def gcm_send_bulk_message(registration_ids, data, encoding='utf-8',
+        concurrency=None, **kwargs):
     """
     Standalone method to send bulk gcm notifications
     """
 
-    messenger = GCMMessenger(registration_ids, data, encoding=encoding, **kwargs)
-    return messenger.send_bulk()
+    with _gcm_deduplicator(data, kwargs) as deduplicator:
+        messenger = GCMMessenger(list(registration_ids), data,
+                encoding=encoding, **kwargs)
+        ## the keys of each chunk are released once GCM answered it
+        result = messenger.send_chunks(deduplicator.filter_chunks(
+            messenger._chunks()), concurrency=concurrency,
+            sent=deduplicator.sent)
+        _gcm_forget_failed(deduplicator, result)
+
+    if len(messenger._registration_id) > messenger.max_recipients:
+        return result
+    ## a send to at most MAX_RECIPIENTS ids returns the response of its
+    ## chunk, which is left empty when every id was a duplicate
+    return result[0] if result else {"multicast_id": None, "success": 0,
+            "failure": 0, "canonical_ids": 0, "results": []}
+
+
+@instrumented("gcm")
+def gcm_send_chunked_message(chunks, data, encoding='utf-8',
+        concurrency=None, **kwargs):
+    """
+    Standalone method to send bulk gcm notifications to an iterable of
+    registration id chunks of at most MAX_RECIPIENTS ids each, e.g. the
+    pages of a queryset, without holding every id in memory
+    """
+
+    with _gcm_deduplicator(data, kwargs) as deduplicator:
+        messenger = GCMMessenger([], data, encoding=encoding, **kwargs)
+        result = messenger.send_chunks(deduplicator.filter_chunks(chunks),
+                concurrency=concurrency, sent=deduplicator.sent)
+        _gcm_forget_failed(deduplicator, result)
+        return result
+
+
+@instrumented("gcm")
+def gcm_send_personalized_message(registrations, data, encoding='utf-8',
+        concurrency=None, **kwargs):
+    """
+    Standalone method to send a gcm notification rendered for each
+    device of an iterable of (registration_id, variables) tuples
+    """
+
+    messenger = GCMMessenger([], data, encoding=encoding, **kwargs)
+    return messenger.send_personalized(registrations, concurrency=concurrency)
+
+
+@instrumented("gcm")
+def gcm_send_topic_message(topic, data, encoding='utf-8', condition=None,
+        **kwargs):
+    """
+    Standalone method to send a gcm notification to every device
+    subscribed to a topic, or matching a condition of topics, in a
+    single request
+    """
+
+    messenger = GCMMessenger(None, data, encoding=encoding, **kwargs)
+    return messenger.send_to_topic(topic, condition)
+
+
+@instrumented("gcm")
+def gcm_send_group_message(notification_key, data, encoding='utf-8',
+        **kwargs):
+    """
+    Standalone method to send a gcm notification to every device of a
+    device group in a single request
+    """
+
+    messenger = GCMMessenger(None, data, encoding=encoding, **kwargs)
+    return messenger.send_to_group(notification_key)
+
+
+def gcm_subscribe_topic(registration_ids, topic, **kwargs):
+    """
+    Standalone method to subscribe registration ids to a gcm topic.
+    Returns {registration_id: error} for those that failed.
+    """
+
+    return GCMMessenger(list(registration_ids), None, **kwargs).subscribe(topic)
+
+
+def gcm_unsubscribe_topic(registration_ids, topic, **kwargs):
+    """
+    Standalone method to unsubscribe registration ids from a gcm topic.
+    Returns {registration_id: error} for those that failed.
+    """
+
+    return GCMMessenger(list(registration_ids), None,
+            **kwargs).unsubscribe(topic)
+
+
+def gcm_create_group(name, registration_ids, **kwargs):
+    """
+    Standalone method to create a gcm device group and return its
+    notification key
+    """
+
+    return GCMMessenger(registration_ids, None, **kwargs).create_group(name)
+
+
+def gcm_add_to_group(name, notification_key, registration_ids, **kwargs):
+    """
+    Standalone method to add registration ids to a gcm device group
+    """
+
+    return GCMMessenger(registration_ids, None, **kwargs).add_to_group(name,
+            notification_key)
+
+
+def gcm_remove_from_group(name, notification_key, registration_ids, **kwargs):
+    """
+    Standalone method to remove registration ids from a gcm device group
+    """
+
+    return GCMMessenger(registration_ids, None,
+            **kwargs).remove_from_group(name, notification_key)
@@ -0,0 +1,285 @@
+"""
+asyncio variants of the GCM senders
+
+Requires the ``aiohttp`` package. Requests are made from the event
+loop over a keep-alive connection pool shared by every coroutine of
+the loop, so no thread is held while waiting on GCM. Callbacks that
+touch the database (deactivation, canonical ids) run in the default
+executor of the loop.
+"""
+
+import asyncio
+import collections
+import json
+import time
+import weakref
+from functools import partial
+
+import aiohttp
+
+from ..exceptions import GCMServerError
+from ..metrics import get_metrics, record_failed, record_sent
+from ..settings import INSTAPUSH_SETTINGS as settings
+from .gcm import (
+    JSON_CONTENT_TYPE,
+    PLAIN_CONTENT_TYPE,
+    THROTTLED_STATUSES,
+    GCMBulkResult,
+    GCMMessenger,
+    _retry_after,
+    _unavailable_result,
+)
+
+
+## aiohttp sessions are bound to the loop they were created in
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_session():
+    """
+    Returns the session of the running loop used to talk to GCM, with
+    at most POOL_SIZE connections open at once
+    """
+
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        pool_size = settings.get('GCM_SETTINGS').get('POOL_SIZE')
+        session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=pool_size))
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    """
+    Closes the session of the running loop. Call it before the loop
+    is closed to release its connections cleanly.
+    """
+
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class AsyncGCMMessenger(GCMMessenger):
+    """
+    A GCMMessenger whose send methods are coroutines
+    """
+
+    async def send_plain(self):
+        await self._acquire(1)
+        response = await self._request(self._plain_body(), PLAIN_CONTENT_TYPE)
+        result = response.body.decode(self.encoding)
+        return await self._run_sync(self._plain_result, result)
+
+    async def send_json(self, ids=None, body=None):
+        items = ids or self._registration_id
+        pending = list(range(len(items)))
+        result = None
+        attempt = 0
+
+        while True:
+            await self._acquire(len(pending))
+            try:
+                response = await self._request(body or self._json_body(
+                    [items[index] for index in pending]), JSON_CONTENT_TYPE)
+            except GCMServerError:
+                if result is None:
+                    raise
+                ## the results of the earlier attempts are kept
+                result = self._merge_results(result, pending,
+                        _unavailable_result(len(pending)))
+                break
+            partial_result = json.loads(response.body.decode(self.encoding))
+            result = self._merge_results(result, pending, partial_result)
+
+            retry = self._retryable(pending, partial_result)
+            if not retry or attempt >= self.max_retries:
+                break
+
+            await asyncio.sleep(self._backoff_delay(attempt,
+                _retry_after(response)))
+            pending = retry
+            attempt += 1
+
+        return await self._run_sync(self._json_result, items, result)
+
+    async def _send_to(self, target):
+        body = self._json_body(None, target)
+        attempt = 0
+
+        while True:
+            await self._acquire(1)
+            response = await self._request(body, JSON_CONTENT_TYPE)
+            result = json.loads(response.body.decode(self.encoding))
+            if not self._retry_target(result) or attempt >= self.max_retries:
+                break
+
+            await asyncio.sleep(self._backoff_delay(attempt,
+                _retry_after(response)))
+            attempt += 1
+
+        return self._target_result(result)
+
+    async def send_bulk(self, concurrency=None):
+        if len(self._registration_id) > self.max_recipients:
+            return await self.send_chunks(self._chunks(), concurrency)
+        return await self.send_json()
+
+    async def send_chunks(self, chunks, concurrency=None):
+        """
+        Sends a json GCM message to each chunk of registration ids of an
+        iterable with at most concurrency chunks in flight at once.
+        Results keep chunk order, a chunk GCM kept answering with server
+        errors has its ids reported Unavailable.
+        """
+
+        concurrency = concurrency or self.concurrency
+        result = GCMBulkResult()
+        in_flight = collections.deque()
+
+        async def send(chunk):
+            try:
+                return await self.send_json(chunk)
+            except GCMServerError:
+                get_metrics().increment("gcm.errors.Unavailable", len(chunk))
+                return _unavailable_result(len(chunk))
+
+        try:
+            for chunk in chunks:
+                in_flight.append((chunk, asyncio.ensure_future(send(chunk))))
+                if len(in_flight) >= concurrency:
+                    chunk, task = in_flight.popleft()
+                    result.add(chunk, await task)
+
+            while in_flight:
+                chunk, task = in_flight.popleft()
+                result.add(chunk, await task)
+        finally:
+            for chunk, task in in_flight:
+                task.cancel()
+
+        return result
+
+    async def _request(self, data, content_type):
+        attempt = 0
+        while True:
+            try:
+                return await self._post(data, content_type)
+            except GCMServerError as e:
+                if e.status in THROTTLED_STATUSES:
+                    self._throttled()
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff_delay(attempt, e.retry_after))
+                attempt += 1
+
+    async def _post(self, data, content_type):
+        data, headers = self._headers(data, content_type)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                sock_read=self.read_timeout)
+
+        metrics = get_metrics()
+        with metrics.timer("gcm.request"):
+            async with get_session().post(self.api_url, data=data,
+                    headers=headers, timeout=timeout) as response:
+                ## the body is read before the connection goes back to the pool
+                response.body = await response.read()
+        metrics.increment("gcm.requests")
+        metrics.increment("gcm.bytes", len(data))
+
+        if response.status != 200:
+            metrics.increment("gcm.http_errors.%d" % response.status)
+        if response.status >= 500 or response.status in THROTTLED_STATUSES:
+            raise GCMServerError(response.status, _retry_after(response))
+        response.raise_for_status()
+        return response
+
+    async def _acquire(self, count):
+        rate_limiter = self._rate_limiter()
+        while rate_limiter is not None:
+            wait = rate_limiter.reserve(count)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _run_sync(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(function, *args))
+
+
+async def _instrumented(awaitable, app_id=None):
+    """
+    Awaits a send, reporting its duration and sending push_sent or
+    push_failed
+    """
+
+    started = time.time()
+    try:
+        result = await awaitable
+    except Exception as e:
+        record_failed("gcm", e, started, app_id)
+        raise
+    record_sent("gcm", result, started, app_id)
+    return result
+
+
+async def gcm_send_message_async(registration_id, data, encoding='utf-8',
+        **kwargs):
+    """
+    Sends a single gcm notification from a coroutine
+    """
+
+    messenger = AsyncGCMMessenger(registration_id, data, encoding=encoding,
+            **kwargs)
+    return await _instrumented(messenger.send_plain(), messenger.app_id)
+
+
+async def gcm_send_bulk_message_async(registration_ids, data,
+        encoding='utf-8', concurrency=None, **kwargs):
+    """
+    Sends bulk gcm notifications from a coroutine, with up to
+    concurrency chunks in flight at once. Results keep chunk order.
+    """
+
+    messenger = AsyncGCMMessenger(registration_ids, data, encoding=encoding,
+            **kwargs)
+    return await _instrumented(messenger.send_bulk(concurrency=concurrency),
+            messenger.app_id)
+
+
+async def gcm_send_chunked_message_async(chunks, data, encoding='utf-8',
+        concurrency=None, **kwargs):
+    """
+    Sends bulk gcm notifications from a coroutine to an iterable of
+    registration id chunks of at most MAX_RECIPIENTS ids each
+    """
+
+    messenger = AsyncGCMMessenger([], data, encoding=encoding, **kwargs)
+    return await _instrumented(messenger.send_chunks(chunks,
+        concurrency=concurrency), messenger.app_id)
+
+
+async def gcm_send_topic_message_async(topic, data, encoding='utf-8',
+        condition=None, **kwargs):
+    """
+    Sends a gcm notification to every device subscribed to a topic, or
+    matching a condition of topics, from a coroutine
+    """
+
+    messenger = AsyncGCMMessenger(None, data, encoding=encoding, **kwargs)
+    return await _instrumented(messenger.send_to_topic(topic, condition),
+            messenger.app_id)
+
+
+async def gcm_send_group_message_async(notification_key, data,
+        encoding='utf-8', **kwargs):
+    """
+    Sends a gcm notification to every device of a device group from a
+    coroutine
+    """
+
+    messenger = AsyncGCMMessenger(None, data, encoding=encoding, **kwargs)
+    return await _instrumented(messenger.send_to_group(notification_key),
+            messenger.app_id)
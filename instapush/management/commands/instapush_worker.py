@@ -0,0 +1,44 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from ...queue.worker import Worker
+
+
+def _run_worker(burst):
+    Worker(burst=burst).run()
+
+
+class Command(BaseCommand):
+    help = "Runs workers sending the push notifications queued by instapush"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                help="Number of worker processes to run")
+        parser.add_argument('--burst', action='store_true', default=False,
+                help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+
+        if processes == 1:
+            return _run_worker(options['burst'])
+
+        ## database connections must not be shared with the children
+        connections.close_all()
+
+        workers = []
+        for _ in range(processes):
+            worker = multiprocessing.Process(target=_run_worker,
+                    args=(options['burst'],))
+            worker.start()
+            workers.append(worker)
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
@@ -0,0 +1,202 @@
+"""
+Metrics of the push senders. The senders report counters, timings and
+histograms to the backend configured in METRICS_BACKEND, which ignores
+them by default. Metric names are dotted and start with the provider,
+e.g. ``gcm.request`` or ``apns.errors.8``.
+"""
+
+import collections
+import functools
+import socket
+import threading
+import time
+
+from .settings import INSTAPUSH_SETTINGS as settings
+from .signals import push_failed, push_sent
+from .utils import get_model
+
+
+class Timer(object):
+    """
+    Reports the time spent in a with block as a timing
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.timing(self.name, time.time() - self.started)
+
+
+class NullMetrics(object):
+    """
+    Discards every metric. Backends override the methods they support.
+    """
+
+    def increment(self, name, value=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def histogram(self, name, value):
+        pass
+
+    def timer(self, name):
+        return Timer(self, name)
+
+
+class MemoryMetrics(NullMetrics):
+    """
+    Keeps counters and the last ``max_samples`` values of each timing
+    and histogram in memory, e.g. for tests or a debug view
+    """
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def timing(self, name, seconds):
+        self.histogram(name, seconds)
+
+    def histogram(self, name, value):
+        with self._lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = collections.deque(
+                        maxlen=self.max_samples)
+            samples.append(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.defaultdict(int)
+            self.samples = {}
+
+    def snapshot(self):
+        """
+        Returns the counters and the count, min, max, mean and
+        percentiles of the kept samples of each timing and histogram
+        """
+
+        with self._lock:
+            counters = dict(self.counters)
+            samples = dict((name, sorted(values))
+                    for name, values in self.samples.items())
+
+        summaries = {}
+        for name, values in samples.items():
+            if not values:
+                continue
+            summaries[name] = {
+                'count': len(values),
+                'min': values[0],
+                'max': values[-1],
+                'mean': sum(values) / float(len(values)),
+                'p50': values[int(len(values) * 0.5)],
+                'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+                'p99': values[min(len(values) - 1, int(len(values) * 0.99))],
+            }
+
+        return {'counters': counters, 'histograms': summaries}
+
+
+class StatsdMetrics(NullMetrics):
+    """
+    Sends metrics to a statsd server over UDP. Sends never block and
+    their errors are ignored.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='instapush'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def increment(self, name, value=1):
+        self._send(name, value, 'c')
+
+    def timing(self, name, seconds):
+        self._send(name, int(seconds * 1000), 'ms')
+
+    def histogram(self, name, value):
+        self._send(name, value, 'h')
+
+    def _send(self, name, value, kind):
+        data = "%s.%s:%s|%s" % (self.prefix, name, value, kind)
+        try:
+            self._socket.sendto(data.encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+@settings.on_reload
+def _reset_metrics():
+    global _metrics
+    _metrics = None
+
+
+def get_metrics():
+    """
+    Returns the backend configured in METRICS_BACKEND
+    """
+
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                backend_class = get_model(settings['METRICS_BACKEND'])
+                _metrics = backend_class(**settings['METRICS_OPTIONS'])
+    return _metrics
+
+
+def record_sent(provider, result, started, app_id=None):
+    duration = time.time() - started
+    get_metrics().timing("%s.send" % provider, duration)
+    push_sent.send(sender=provider, result=result, duration=duration,
+            app_id=app_id)
+
+
+def record_failed(provider, exception, started, app_id=None):
+    duration = time.time() - started
+    metrics = get_metrics()
+    metrics.timing("%s.send" % provider, duration)
+    metrics.increment("%s.send_errors.%s" % (provider,
+        exception.__class__.__name__))
+    push_failed.send(sender=provider, exception=exception, duration=duration,
+            app_id=app_id)
+
+
+def instrumented(provider):
+    """
+    Decorates a send function of provider to report its duration and
+    send push_sent or push_failed
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                record_failed(provider, e, started, kwargs.get('app_id'))
+                raise
+            record_sent(provider, result, started, kwargs.get('app_id'))
+            return result
+        return wrapper
+    return decorator
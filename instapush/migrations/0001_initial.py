@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+import instapush.models.fields
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.INSTAPUSH_DEVICE_OWNER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GCMDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=255, null=True, verbose_name='name')),
+                ('active', models.BooleanField(default=True, verbose_name='active')),
+                ('app_id', models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='app id')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('device_id', instapush.models.fields.HexIntegerField(blank=True, db_index=True, null=True, verbose_name='Device ID')),
+                ('registration_id', models.TextField(verbose_name='Registration ID')),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.INSTAPUSH_DEVICE_OWNER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'GCM Device',
+                'verbose_name_plural': 'GCM Devices',
+            },
+        ),
+        migrations.CreateModel(
+            name='APNSDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=255, null=True, verbose_name='name')),
+                ('active', models.BooleanField(default=True, verbose_name='active')),
+                ('app_id', models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='app id')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('device_id', models.UUIDField(blank=True, db_index=True, null=True, verbose_name='Device ID')),
+                ('registration_id', instapush.models.fields.APNSTokenField(max_length=64, unique=True, verbose_name='Registration ID')),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.INSTAPUSH_DEVICE_OWNER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'APNS Device',
+                'verbose_name_plural': 'APNS Devices',
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instapush', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=100, verbose_name='task')),
+                ('payload', models.TextField(verbose_name='payload')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('available_at', models.DateTimeField(verbose_name='available at')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='locked until')),
+                ('failed', models.BooleanField(default=False, verbose_name='failed')),
+                ('last_error', models.TextField(blank=True, null=True, verbose_name='last error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+            ],
+            options={
+                'verbose_name': 'Push Job',
+                'verbose_name_plural': 'Push Jobs',
+                'index_together': {('failed', 'available_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instapush', '0002_push_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GCMTopicSubscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(db_index=True, max_length=255, verbose_name='topic')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='topic_subscriptions', to='instapush.gcmdevice')),
+            ],
+            options={
+                'verbose_name': 'GCM Topic Subscription',
+                'verbose_name_plural': 'GCM Topic Subscriptions',
+                'unique_together': {('device', 'topic')},
+            },
+        ),
+        migrations.CreateModel(
+            name='GCMDeviceGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='name')),
+                ('notification_key', models.TextField(verbose_name='notification key')),
+                ('app_id', models.CharField(blank=True, max_length=64, null=True, verbose_name='app id')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('devices', models.ManyToManyField(blank=True, related_name='device_groups', to='instapush.gcmdevice')),
+            ],
+            options={
+                'verbose_name': 'GCM Device Group',
+                'verbose_name_plural': 'GCM Device Groups',
+                'unique_together': {('app_id', 'name')},
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instapush', '0003_gcm_topics_and_groups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=255, verbose_name='name')),
+                ('message', models.TextField(blank=True, null=True, verbose_name='message')),
+                ('app_id', models.CharField(blank=True, max_length=64, null=True, verbose_name='app id')),
+                ('extra', models.TextField(default='{}', verbose_name='extra')),
+                ('filters', models.TextField(default='{}', verbose_name='filters')),
+                ('options', models.TextField(default='{}', verbose_name='options')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+            ],
+            options={
+                'verbose_name': 'Campaign',
+                'verbose_name_plural': 'Campaigns',
+            },
+        ),
+        migrations.CreateModel(
+            name='CampaignShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform', models.CharField(max_length=10, verbose_name='platform')),
+                ('model', models.CharField(max_length=255, verbose_name='model')),
+                ('app_id', models.CharField(blank=True, max_length=64, null=True, verbose_name='app id')),
+                ('start_after', models.CharField(blank=True, max_length=64, null=True, verbose_name='start after')),
+                ('end', models.CharField(blank=True, max_length=64, null=True, verbose_name='end')),
+                ('checkpoint', models.CharField(blank=True, max_length=64, null=True, verbose_name='checkpoint')),
+                ('sent', models.PositiveIntegerField(default=0, verbose_name='sent')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='failed')),
+                ('done', models.BooleanField(default=False, verbose_name='done')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='instapush.campaign')),
+            ],
+            options={
+                'verbose_name': 'Campaign Shard',
+                'verbose_name_plural': 'Campaign Shards',
+                'index_together': {('campaign', 'done')},
+            },
+        ),
+    ]
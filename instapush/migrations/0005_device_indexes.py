@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+DEVICE_MODELS = ('GCMDevice', 'APNSDevice')
+
+## the sql, per database vendor, of the indexes django can not declare
+## on the models. Active devices are read by app in primary key order:
+## mysql has no partial indexes, but its secondary indexes end with the
+## primary key. GCM registration ids are only looked up by equality and
+## are text columns, which mysql only indexes a prefix of (191
+## characters fit its 767 bytes index limit in utf8mb4).
+ACTIVE_INDEX = {
+    'postgresql': "CREATE INDEX %(index)s ON %(table)s (app_id, id) "
+        "WHERE %(active)s",
+    'sqlite': "CREATE INDEX %(index)s ON %(table)s (app_id, id) "
+        "WHERE %(active)s",
+    'mysql': "CREATE INDEX %(index)s ON %(table)s (active, app_id)",
+}
+REGISTRATION_ID_INDEX = {
+    'postgresql': "CREATE INDEX %(index)s ON %(table)s "
+        "USING hash (registration_id)",
+    'sqlite': "CREATE INDEX %(index)s ON %(table)s (registration_id)",
+    'mysql': "CREATE INDEX %(index)s ON %(table)s (registration_id(191))",
+}
+DROP_INDEX = {
+    'mysql': "DROP INDEX %(index)s ON %(table)s",
+}
+
+
+def _indexes(apps):
+    for name in DEVICE_MODELS:
+        model = apps.get_model('instapush', name)
+        yield model, "%s_active_app" % model._meta.db_table, ACTIVE_INDEX
+    model = apps.get_model('instapush', 'GCMDevice')
+    yield model, "%s_registration_id" % model._meta.db_table, \
+            REGISTRATION_ID_INDEX
+
+
+def active_condition(model, schema_editor):
+    """
+    Returns the sql condition the ORM filters active devices with, e.g.
+    "active" = 1 on sqlite: sqlite only reads a partial index for the
+    queries whose condition is the index's own, and django versions do
+    not write it alike.
+    """
+
+    connection = schema_editor.connection
+    query = model._default_manager.filter(active=True).query
+    sql, params = query.where.as_sql(query.get_compiler(
+        connection=connection), connection)
+    sql = sql.replace("%s." % schema_editor.quote_name(model._meta.db_table),
+            "")
+    return sql % tuple(schema_editor.quote_value(param) for param in params)
+
+
+def create_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    quote = schema_editor.quote_name
+    for model, index, statements in _indexes(apps):
+        if vendor in statements:
+            schema_editor.execute(statements[vendor] % {
+                'index': quote(index), 'table': quote(model._meta.db_table),
+                'active': active_condition(model, schema_editor)})
+
+
+def drop_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    quote = schema_editor.quote_name
+    for model, index, statements in _indexes(apps):
+        if vendor in statements:
+            schema_editor.execute(DROP_INDEX.get(vendor,
+                "DROP INDEX %(index)s") % {'index': quote(index),
+                    'table': quote(model._meta.db_table)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('instapush', '0004_campaigns'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='gcmdevice',
+            index_together=set([('owner', 'active')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='apnsdevice',
+            index_together=set([('owner', 'active')]),
+        ),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
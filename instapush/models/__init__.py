@@ -0,0 +1,18 @@
+"""
+Registers the sql models of instapush with its app, so that its
+migrations match them. The owner of the sql devices refers to
+DEVICE_OWNER_MODEL, or to the user model when it is not a django model
+label ("app_label.Model"), through the INSTAPUSH_DEVICE_OWNER_MODEL
+setting, see instapush.utils.get_device_owner_label.
+"""
+
+from django.apps import apps
+
+
+## projects using the mongo documents, or their own models built on the
+## querysets, may not install the app
+if 'instapush' in apps.app_configs:
+    from .base import (APNSDevice, GCMDevice, GCMDeviceGroup,
+            GCMTopicSubscription)
+    from .campaign import Campaign, CampaignShard
+    from .queue import PushJob
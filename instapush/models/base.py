@@ -1,9 +1,11 @@
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
-from .fields import HexIntegerField
-from .managers import  APNSDeviceManager, GCMDeviceManager
+from ..utils import get_device_owner_label
+from .fields import APNSTokenField, HexIntegerField
+from .managers import  APNSDeviceManager, GCMDeviceGroupManager, GCMDeviceManager
 
 
 try:
@@ -12,6 +14,11 @@ except AttributeError:
     raise ImproperlyConfigured("Please include instapush settings dictionary "\
             "in your django settings")
 
+## the owner of the devices is swappable like the user model, and the
+## migrations refer to it through this setting
+if not hasattr(settings, 'INSTAPUSH_DEVICE_OWNER_MODEL'):
+    settings.INSTAPUSH_DEVICE_OWNER_MODEL = get_device_owner_label()
+
 
 class BaseDevice(models.Model):
     """
@@ -23,14 +30,21 @@ class BaseDevice(models.Model):
     name = models.CharField(_('name'), max_length=255, blank=True, null=True)
     active = models.BooleanField(_('active'), default=True)
 
+    ## id of the app, registered in INSTAPUSH_SETTINGS['APPS'], whose
+    ## credentials are used to push to this device. Devices without
+    ## one use the global GCM and APNS settings.
+    app_id = models.CharField(_('app id'), max_length=64, blank=True,
+            null=True, db_index=True)
+
     ## as a device can not only be related to a user
     ## but any other defined models. we let the push
     ## user decide which model should be the owner
     ## of a device object. For cases, where a device
     ## does not have to be related to any model this
     ## can be left empty and hence blank and null are
-    ## set to True
-    owner = models.ForeignKey(instapush_settings.get('DEVICE_OWNER_MODEL'),
+    ## set to True. Projects whose DEVICE_OWNER_MODEL is not a django
+    ## model (a mongo document) get the user model.
+    owner = models.ForeignKey(settings.INSTAPUSH_DEVICE_OWNER_MODEL,
             blank=True, null=True)
 
     created = models.DateTimeField(_('created'), auto_now_add=True)
@@ -38,6 +52,8 @@ class BaseDevice(models.Model):
 
     class Meta:
         abstract = True
+        ## sends to the devices of an owner filter on both
+        index_together = [('owner', 'active')]
 
 
     def __unicode__(self):
@@ -56,7 +72,7 @@ class GCMDevice(BaseDevice):
     ## Set custom manager
     objects = GCMDeviceManager()
 
-    class Meta:
+    class Meta(BaseDevice.Meta):
         verbose_name = _('GCM Device')
         verbose_name_plural = _('GCM Devices')
 
@@ -70,28 +86,165 @@ class GCMDevice(BaseDevice):
         if message is not None:
             data["message"] = message
 
+        kwargs.setdefault("app_id", self.app_id)
         return gcm_send_message(registration_id=self.registration_id,
                 data=data, **kwargs)
 
+    def enqueue_message(self, message, **kwargs):
+        """
+        Queues a push notification to this device to be sent by the
+        instapush worker
+        """
+
+        from ..queue import enqueue
+        data = kwargs.pop("extra", {})
+        if message is not None:
+            data["message"] = message
+
+        kwargs.setdefault("app_id", self.app_id)
+        return enqueue('gcm_send_message', registration_id=self.registration_id,
+                data=data, **kwargs)
+
+    def subscribe(self, topic, **kwargs):
+        """
+        Subscribes this device to a GCM topic
+        """
+        return self.__class__.objects.filter(pk=self.pk).subscribe(topic,
+                **kwargs)
+
+    def unsubscribe(self, topic, **kwargs):
+        """
+        Unsubscribes this device from a GCM topic
+        """
+        return self.__class__.objects.filter(pk=self.pk).unsubscribe(topic,
+                **kwargs)
+
+
+class GCMTopicSubscription(models.Model):
+    """
+    Records that a GCM device is subscribed to a topic
+    """
+
+    device = models.ForeignKey(GCMDevice, related_name='topic_subscriptions')
+    topic = models.CharField(_('topic'), max_length=255, db_index=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+
+    class Meta:
+        unique_together = (('device', 'topic'),)
+        verbose_name = _('GCM Topic Subscription')
+        verbose_name_plural = _('GCM Topic Subscriptions')
+
+
+class GCMDeviceGroup(models.Model):
+    """
+    Represents a GCM device group, addressed by the notification key
+    GCM created for it. Create groups with
+    ``GCMDeviceGroup.objects.create_group(name, devices)``.
+    """
+
+    name = models.CharField(_('name'), max_length=255)
+    notification_key = models.TextField(_('notification key'))
+    app_id = models.CharField(_('app id'), max_length=64, blank=True,
+            null=True)
+    devices = models.ManyToManyField(GCMDevice, related_name='device_groups',
+            blank=True)
+
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+
+    ## Set custom manager
+    objects = GCMDeviceGroupManager()
+
+    class Meta:
+        unique_together = (('app_id', 'name'),)
+        verbose_name = _('GCM Device Group')
+        verbose_name_plural = _('GCM Device Groups')
+
+    def __unicode__(self):
+        return self.name
+
+    def add_devices(self, devices):
+        """
+        Adds devices to this group on GCM and records them
+        """
+
+        from ..libs.gcm import gcm_add_to_group
+        devices = list(devices)
+        gcm_add_to_group(self.name, self.notification_key,
+                [device.registration_id for device in devices],
+                app_id=self.app_id)
+        self._add_members(devices)
+
+    def remove_devices(self, devices):
+        """
+        Removes devices from this group on GCM and records it
+        """
+
+        from ..libs.gcm import gcm_remove_from_group
+        devices = list(devices)
+        gcm_remove_from_group(self.name, self.notification_key,
+                [device.registration_id for device in devices],
+                app_id=self.app_id)
+        self.devices.remove(*devices)
+
+    def _add_members(self, devices):
+        self.devices.add(*devices)
+
+    def send_message(self, message, **kwargs):
+        """
+        Sends a push notification to every device of this group in a
+        single GCM request
+        """
+
+        from ..libs.gcm import gcm_send_group_message
+        data = kwargs.pop("extra", {})
+        if message is not None:
+            data["message"] = message
+
+        kwargs.setdefault("app_id", self.app_id)
+        return gcm_send_group_message(self.notification_key, data=data,
+                **kwargs)
+
+    def enqueue_message(self, message, **kwargs):
+        """
+        Queues a push notification to every device of this group to be
+        sent by the instapush worker
+        """
+
+        from ..queue import enqueue
+        data = kwargs.pop("extra", {})
+        if message is not None:
+            data["message"] = message
+
+        kwargs.setdefault("app_id", self.app_id)
+        return enqueue('gcm_send_group_message',
+                notification_key=self.notification_key, data=data, **kwargs)
+
 
 class APNSDevice(BaseDevice):
     """
     Represents an iOS device
     """
 
-    device_id = models.UUIField(_('Device ID'), blank=True, null=True,
+    device_id = models.UUIDField(_('Device ID'), blank=True, null=True,
             db_index=True)
-    registration_id = models.CharField(_('Registration ID'), max_length=64,
-            unique=True)
+    registration_id = APNSTokenField(_('Registration ID'), unique=True)
 
     ## Set custom manager
-    APNSDeviceManager()
+    objects = APNSDeviceManager()
 
-    class Meta:
+    class Meta(BaseDevice.Meta):
         verbose_name = _('APNS Device')
         verbose_name_plural = _('APNS Devices')
 
     def send_message(self, message, **kwargs):
         from ..libs.apns import apns_send_message
+        kwargs.setdefault("app_id", self.app_id)
         return apns_send_message(registration_id=self.registration_id,
                 alert=message, **kwargs)
+
+    def enqueue_message(self, message, **kwargs):
+        from ..queue import enqueue
+        kwargs.setdefault("app_id", self.app_id)
+        return enqueue('apns_send_message', registration_id=self.registration_id,
+                alert=message, **kwargs)
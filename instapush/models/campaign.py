@@ -0,0 +1,64 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class Campaign(models.Model):
+    """
+    Represents a message sent to every device matching filters through
+    the queue, split into CampaignShards. Used by instapush.campaigns.
+    """
+
+    name = models.CharField(_('name'), max_length=255, blank=True)
+    message = models.TextField(_('message'), blank=True, null=True)
+    ## the app whose credentials every device is sent with, if given
+    app_id = models.CharField(_('app id'), max_length=64, blank=True,
+            null=True)
+    ## json encoded extra data, device lookups and per platform options
+    extra = models.TextField(_('extra'), default='{}')
+    filters = models.TextField(_('filters'), default='{}')
+    options = models.TextField(_('options'), default='{}')
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    finished = models.DateTimeField(_('finished'), blank=True, null=True)
+
+    class Meta:
+        app_label = 'instapush'
+        verbose_name = _('Campaign')
+        verbose_name_plural = _('Campaigns')
+
+    def __unicode__(self):
+        return self.name or "Campaign #%s" % self.pk
+
+
+class CampaignShard(models.Model):
+    """
+    The devices of one platform and app of a campaign whose primary
+    keys are after start_after and at most end, either bound being
+    open when null. checkpoint is the pk of the last device sent to:
+    a shard that is run again resumes after it.
+    """
+
+    campaign = models.ForeignKey(Campaign, related_name='shards')
+    platform = models.CharField(_('platform'), max_length=10)
+    ## dotted path of the device model/document
+    model = models.CharField(_('model'), max_length=255)
+    app_id = models.CharField(_('app id'), max_length=64, blank=True,
+            null=True)
+    ## primary keys are stored as text, so that mongo ids fit as well
+    start_after = models.CharField(_('start after'), max_length=64,
+            blank=True, null=True)
+    end = models.CharField(_('end'), max_length=64, blank=True, null=True)
+    checkpoint = models.CharField(_('checkpoint'), max_length=64,
+            blank=True, null=True)
+    sent = models.PositiveIntegerField(_('sent'), default=0)
+    failed = models.PositiveIntegerField(_('failed'), default=0)
+    done = models.BooleanField(_('done'), default=False)
+    updated = models.DateTimeField(_('updated'), auto_now=True)
+
+    class Meta:
+        app_label = 'instapush'
+        verbose_name = _('Campaign Shard')
+        verbose_name_plural = _('Campaign Shards')
+        index_together = [('campaign', 'done')]
+
+    def __unicode__(self):
+        return "%s shard #%s" % (self.campaign, self.pk)
@@ -5,13 +5,16 @@ Code by jleclanche @ https://github.com/jleclanche/django-push-notifications/blo
 import re
 import struct
 from django import forms
+from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models, connection
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 
+from ..utils import APNS_TOKEN_SIZE, normalize_apns_token
 
-__all__ = ["HexadecimalField", "HexIntegerField"]
+
+__all__ = ["HexadecimalField", "HexIntegerField", "APNSTokenField"]
 
 
 hex_re = re.compile(r"^(([0-9A-f])|(0x[0-9A-f]))+$")
@@ -87,3 +90,41 @@ class HexIntegerField(six.with_metaclass(models.SubfieldBase, models.BigIntegerF
     def run_validators(self, value):
         # make sure validation is performed on integer value not string value
         return super(models.BigIntegerField, self).run_validators(self.get_prep_value(value))
+
+
+def validate_apns_token(value):
+    """
+    Returns the normalized form of an APNS device token, raising
+    ValidationError if it is invalid
+    """
+
+    try:
+        return normalize_apns_token(value)
+    except ValueError:
+        raise ValidationError(_("Enter a valid APNS device token"), "invalid")
+
+
+class APNSTokenField(models.CharField):
+    """
+    Stores an APNS device token as 64 lowercase hex digits. Tokens are
+    normalized (see instapush.utils.normalize_apns_token) when saved and
+    looked up, and saving or looking up an invalid token raises
+    ValidationError, so a bad token never reaches a bulk send.
+    """
+
+    default_validators = [validate_apns_token]
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("max_length", APNS_TOKEN_SIZE * 2)
+        super(APNSTokenField, self).__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        value = validate_apns_token(getattr(model_instance, self.attname))
+        setattr(model_instance, self.attname, value)
+        return value
+
+    def get_prep_value(self, value):
+        value = super(APNSTokenField, self).get_prep_value(value)
+        if value is None:
+            return value
+        return validate_apns_token(value)
@@ -1,5 +1,5 @@
 from django.db import models
-from .querysets import APNSQuerySet, GCMQuerySet
+from .querysets import APNSQuerySet, GCMDeviceGroupQuerySet, GCMQuerySet
 
 
 class GCMDeviceManager(models.Manager):
@@ -10,6 +10,18 @@ class GCMDeviceManager(models.Manager):
     def get_queryset(self):
         return GCMQuerySet(self.model)
 
+    def subscribed_to(self, topic):
+        return self.get_queryset().subscribed_to(topic)
+
+    def active(self):
+        return self.get_queryset().active()
+
+    def owned_by(self, owner):
+        return self.get_queryset().owned_by(owner)
+
+    def with_registration_ids(self, registration_ids):
+        return self.get_queryset().with_registration_ids(registration_ids)
+
 
 class APNSDeviceManager(models.Manager):
     """
@@ -17,4 +29,25 @@ class APNSDeviceManager(models.Manager):
     """
 
     def get_queryset(self):
-        APNSQuerySet(self.model)
+        return APNSQuerySet(self.model)
+
+    def active(self):
+        return self.get_queryset().active()
+
+    def owned_by(self, owner):
+        return self.get_queryset().owned_by(owner)
+
+    def with_registration_ids(self, registration_ids):
+        return self.get_queryset().with_registration_ids(registration_ids)
+
+
+class GCMDeviceGroupManager(models.Manager):
+    """
+    A manager to be used for GCM device groups
+    """
+
+    def get_queryset(self):
+        return GCMDeviceGroupQuerySet(self.model)
+
+    def create_group(self, name, devices, app_id=None):
+        return self.get_queryset().create_group(name, devices, app_id)
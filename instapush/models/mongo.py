@@ -1,17 +1,69 @@
 import mongoengine
+from mongoengine.queryset import QuerySet
 
 from django.conf import settings
-from django.utils import timezone
+from django.utils import six, timezone
 
-from .querysets import APNSMongoQuerySet, GCMMongoQuerySet
+from .querysets import (APNSMessageMixin, GCMDeviceGroupMixin,
+        GCMMessageMixin, MongoDeviceQuerySetMixin)
 from ..settings import INSTAPUSH_SETTINGS as instapush_settings
-from ..utils import get_model
+from ..utils import get_model, normalize_apns_token
+
+
+class GCMMongoQuerySet(GCMMessageMixin, MongoDeviceQuerySetMixin, QuerySet):
+    """
+    Defines additional methods to be used by GCM mongo query set
+    """
+
+    def subscribed_to(self, topic):
+        """
+        Returns the devices subscribed to a GCM topic
+        """
+        return self.filter(topics=topic)
+
+    def _add_topic(self, topic, pks):
+        self.filter(id__in=pks).update(add_to_set__topics=topic)
+
+    def _remove_topic(self, topic, pks):
+        self.filter(id__in=pks).update(pull__topics=topic)
+
+
+class APNSMongoQuerySet(APNSMessageMixin, MongoDeviceQuerySetMixin, QuerySet):
+    """
+    Defines additional methods to be used by APNS mongo query set
+    """
+    pass
+
+
+class GCMDeviceGroupMongoQuerySet(GCMDeviceGroupMixin, QuerySet):
+    """
+    Defines additional methods to be used by GCM device group mongo
+    query set
+    """
+    pass
 
 
 class BaseOwner(mongoengine.Document):
     pass
 
 
+class OwnerField(mongoengine.ReferenceField):
+    """
+    A reference to the DEVICE_OWNER_MODEL document, which is imported
+    the first time the field is used rather than when this module is
+    """
+
+    def __init__(self, **kwargs):
+        super(OwnerField, self).__init__('DEVICE_OWNER_MODEL', **kwargs)
+
+    @property
+    def document_type(self):
+        if isinstance(self.document_type_obj, six.string_types):
+            self.document_type_obj = get_model(instapush_settings.get(
+                'DEVICE_OWNER_MODEL'))
+        return self.document_type_obj
+
+
 class BaseDevice(mongoengine.Document):
     """
     A basic device document. This class defines the generic
@@ -21,11 +73,20 @@ class BaseDevice(mongoengine.Document):
 
     name = mongoengine.StringField()
     active = mongoengine.BooleanField(default=True)
-    owner = mongoengine.ReferenceField(get_model(instapush_settings.get(
-        'DEVICE_OWNER_MODEL')), required=False)
+    app_id = mongoengine.StringField()
+    owner = OwnerField(required=False)
     date_created = mongoengine.DateTimeField(default=timezone.now())
 
-    meta = {'collection': 'devices', 'allow_inheritance': True}
+    meta = {
+        'collection': 'devices',
+        'allow_inheritance': True,
+        ## inherited by both device documents, see owned_by and active
+        'indexes': [
+            ('owner', 'active'),
+            {'fields': ['app_id', 'id'],
+                'partialFilterExpression': {'active': True}},
+        ]
+    }
 
 
 class GCMDevice(BaseDevice):
@@ -37,10 +98,18 @@ class GCMDevice(BaseDevice):
 
     device_id = mongoengine.StringField()
     registration_id = mongoengine.StringField()
+    ## the GCM topics this device is subscribed to
+    topics = mongoengine.ListField(mongoengine.StringField())
 
     meta = {
         'queryset_class': GCMMongoQuerySet,
-        'indexes': [{'fields': ['device_id'], 'unique': True, 'sparse': True}]
+        'indexes': [
+            {'fields': ['device_id'], 'unique': True, 'sparse': True},
+            'topics',
+            ## registration ids are only looked up by equality; the
+            ## devices collection is shared, so APNS tokens use it too
+            {'fields': ['#registration_id'], 'cls': False},
+        ]
     }
 
     def send_message(self, data, **kwargs):
@@ -49,9 +118,85 @@ class GCMDevice(BaseDevice):
         extra_data = kwargs.pop("extra", {})
         data.update(extra_data)
 
+        kwargs.setdefault("app_id", self.app_id)
         return gcm_send_message(registration_id=self.registration_id,
                 data=data, **kwargs)
 
+    def enqueue_message(self, data, **kwargs):
+        from ..queue import enqueue
+
+        extra_data = kwargs.pop("extra", {})
+        data.update(extra_data)
+
+        kwargs.setdefault("app_id", self.app_id)
+        return enqueue('gcm_send_message', registration_id=self.registration_id,
+                data=data, **kwargs)
+
+    def subscribe(self, topic, **kwargs):
+        return GCMDevice.objects(id=self.id).subscribe(topic, **kwargs)
+
+    def unsubscribe(self, topic, **kwargs):
+        return GCMDevice.objects(id=self.id).unsubscribe(topic, **kwargs)
+
+
+class GCMDeviceGroup(mongoengine.Document):
+    """
+    This document represents a GCM device group, addressed by the
+    notification key GCM created for it. Create groups with
+    ``GCMDeviceGroup.objects.create_group(name, devices)``.
+    """
+
+    name = mongoengine.StringField(required=True)
+    notification_key = mongoengine.StringField()
+    app_id = mongoengine.StringField()
+    devices = mongoengine.ListField(mongoengine.ReferenceField(GCMDevice))
+    date_created = mongoengine.DateTimeField(default=timezone.now)
+
+    meta = {
+        'collection': 'device_groups',
+        'queryset_class': GCMDeviceGroupMongoQuerySet,
+        'indexes': [{'fields': ['app_id', 'name'], 'unique': True}]
+    }
+
+    def add_devices(self, devices):
+        from ..libs.gcm import gcm_add_to_group
+        devices = list(devices)
+        gcm_add_to_group(self.name, self.notification_key,
+                [device.registration_id for device in devices],
+                app_id=self.app_id)
+        self._add_members(devices)
+
+    def remove_devices(self, devices):
+        from ..libs.gcm import gcm_remove_from_group
+        devices = list(devices)
+        gcm_remove_from_group(self.name, self.notification_key,
+                [device.registration_id for device in devices],
+                app_id=self.app_id)
+        self.update(pull_all__devices=devices)
+
+    def _add_members(self, devices):
+        self.update(add_to_set__devices=devices)
+
+    def send_message(self, data, **kwargs):
+        from ..libs.gcm import gcm_send_group_message
+
+        extra_data = kwargs.pop("extra", {})
+        data.update(extra_data)
+
+        kwargs.setdefault("app_id", self.app_id)
+        return gcm_send_group_message(self.notification_key, data=data,
+                **kwargs)
+
+    def enqueue_message(self, data, **kwargs):
+        from ..queue import enqueue
+
+        extra_data = kwargs.pop("extra", {})
+        data.update(extra_data)
+
+        kwargs.setdefault("app_id", self.app_id)
+        return enqueue('gcm_send_group_message',
+                notification_key=self.notification_key, data=data, **kwargs)
+
 
 class APNSDevice(BaseDevice):
     """
@@ -67,7 +212,22 @@ class APNSDevice(BaseDevice):
         'indexes': [{'fields': ['device_id'], 'unique': True, 'sparse': True}]
     }
 
+    def clean(self):
+        ## stores tokens normalized and refuses invalid ones, so a bad
+        ## token never reaches a bulk send
+        try:
+            self.registration_id = normalize_apns_token(self.registration_id)
+        except ValueError as e:
+            raise mongoengine.ValidationError(str(e))
+
     def send_message(self, message, **kwargs):
         from ..libs.apns import apns_send_message
+        kwargs.setdefault("app_id", self.app_id)
         return apns_send_message(registration_id=self.registration_id,
                 alert=message, **kwargs)
+
+    def enqueue_message(self, message, **kwargs):
+        from ..queue import enqueue
+        kwargs.setdefault("app_id", self.app_id)
+        return enqueue('apns_send_message', registration_id=self.registration_id,
+                alert=message, **kwargs)
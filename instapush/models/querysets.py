@@ -1,52 +1,377 @@
+import itertools
+
 from django.db import models
-from mongoengine.queryset import QuerySet
+
+from ..settings import INSTAPUSH_SETTINGS as instapush_settings
+from ..utils import normalize_apns_token
+
+
+class MessageMixin(object):
+    def _split_by_app(self, kwargs):
+        """
+        Returns (app_id, queryset) tuples to send to every device with
+        the credentials of its app, unless an app_id is given
+        """
+
+        if 'app_id' in kwargs:
+            return [(kwargs.pop('app_id'), self)]
+        return self.group_by_app()
 
 
-class GCMMessageMixin(object):
+class GCMMessageMixin(MessageMixin):
     def send_message(self, message, **kwargs):
-        if self:
-            from instapush.libs.gcm import gcm_send_bulk_message
-            data = kwargs.pop("extra", {})
-            if message is not None:
-                data["message"] = message
+        """
+        Sends a GCM message to every device, fetching registration ids
+        a chunk of MAX_RECIPIENTS at a time as they are sent
+        """
+
+        from instapush.libs.gcm import GCMBulkResult, gcm_send_chunked_message
+        data = kwargs.pop("extra", {})
+        if message is not None:
+            data["message"] = message
+
+        page_size = instapush_settings['GCM_SETTINGS']['MAX_RECIPIENTS']
+        result = GCMBulkResult()
+        for app_id, devices in self._split_by_app(kwargs):
+            result.merge(gcm_send_chunked_message(
+                devices.iter_registration_id_pages(page_size), data=data,
+                app_id=app_id, **kwargs))
+
+        if len(result) > 1:
+            return result
+        if result:
+            return result[0]
+
+    def enqueue_message(self, message, **kwargs):
+        """
+        Queues a GCM message to every device, as one job per chunk of
+        MAX_RECIPIENTS registration ids, and returns the job ids
+        """
 
-            ids = [device.registration_id for device in self]
-            return gcm_send_bulk_message(registration_ids=ids,
-                    data=data, **kwargs)
+        from instapush.queue import enqueue
+        data = kwargs.pop("extra", {})
+        if message is not None:
+            data["message"] = message
 
-class APNSMessageMixin(object):
+        page_size = instapush_settings['GCM_SETTINGS']['MAX_RECIPIENTS']
+        return [enqueue('gcm_send_bulk_message', registration_ids=ids,
+                data=data, app_id=app_id, **kwargs)
+                for app_id, devices in self._split_by_app(kwargs)
+                for ids in devices.iter_registration_id_pages(page_size)]
+
+    def subscribe(self, topic, **kwargs):
+        """
+        Subscribes every device to a GCM topic, in batch requests of
+        TOPIC_BATCH_SIZE registration ids, and records the subscriptions
+        GCM accepted. Returns {registration_id: error} for the others.
+        """
+
+        from instapush.libs.gcm import gcm_subscribe_topic
+        return self._manage_topic(gcm_subscribe_topic, self._add_topic, topic,
+                kwargs)
+
+    def unsubscribe(self, topic, **kwargs):
+        """
+        Unsubscribes every device from a GCM topic, see subscribe
+        """
+
+        from instapush.libs.gcm import gcm_unsubscribe_topic
+        return self._manage_topic(gcm_unsubscribe_topic, self._remove_topic,
+                topic, kwargs)
+
+    def _manage_topic(self, manage, record, topic, kwargs):
+        from instapush.libs.gcm import TOPIC_BATCH_SIZE
+        failed = {}
+
+        for app_id, devices in self._split_by_app(kwargs):
+            for page in devices.iter_device_pages(TOPIC_BATCH_SIZE):
+                errors = manage([registration_id for _, registration_id
+                    in page], topic, app_id=app_id, **kwargs)
+                record(topic, [pk for pk, registration_id in page
+                    if registration_id not in errors])
+                failed.update(errors)
+
+        return failed
+
+class APNSMessageMixin(MessageMixin):
     def send_message(self, message, **kwargs):
+        """
+        Sends an APNS message to every device, streaming registration
+        ids page by page into the bulk sender
+        """
+
         from instapush.libs.apns import apns_send_bulk_message
-        ids = [device.registration_id for device in self]
+        failed = {}
+        for app_id, devices in self._split_by_app(kwargs):
+            ids = itertools.chain.from_iterable(
+                    devices.iter_registration_id_pages(
+                        instapush_settings['PAGE_SIZE']))
+            failed.update(apns_send_bulk_message(registration_ids=ids,
+                alert=message, app_id=app_id, **kwargs))
+
+        return failed
+
+    def enqueue_message(self, message, **kwargs):
+        """
+        Queues an APNS message to every device, as one job per page of
+        registration ids, and returns the job ids
+        """
+
+        from instapush.queue import enqueue
+        return [enqueue('apns_send_bulk_message', registration_ids=ids,
+                alert=message, app_id=app_id, **kwargs)
+                for app_id, devices in self._split_by_app(kwargs)
+                for ids in devices.iter_registration_id_pages(
+                    instapush_settings['PAGE_SIZE'])]
+
+
+class DeviceQuerySetMixin(object):
+    def active(self):
+        """
+        Returns the active devices, a condition the partial index on
+        the active devices of each app is defined with
+        """
+        return self.filter(active=True)
+
+    def owned_by(self, owner):
+        """
+        Returns the active devices of owner, which the index on (owner,
+        active) covers
+        """
+        return self.filter(owner=owner, active=True)
+
+    def with_registration_ids(self, registration_ids):
+        """
+        Returns the devices among registration_ids, which the index on
+        the registration id covers
+        """
+        return self.filter(registration_id__in=list(registration_ids))
+
+    def iter_registration_id_pages(self, page_size):
+        """
+        Yields the registration ids of this queryset in lists of
+        page_size, see iter_device_pages
+        """
+
+        for page in self.iter_device_pages(page_size):
+            yield [registration_id for _, registration_id in page]
+
+    def iter_device_pages(self, page_size, after=None):
+        """
+        Yields the (pk, registration_id) tuples of this queryset in lists
+        of page_size, in primary key order starting after the pk after.
+        Only those two fields are fetched, one page per query using
+        keyset pagination on the primary key, so no query holds more
+        than a page of rows.
+        """
+
+        queryset = self.order_by('pk').values_list('pk', 'registration_id')
+        last_pk = after
+
+        while True:
+            page = queryset
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+
+            page = list(page[:page_size])
+            if not page:
+                return
+
+            last_pk = page[-1][0]
+            yield page
+
+    def shard_bounds(self, shards):
+        """
+        Returns the pks splitting this queryset into at most shards
+        ranges of consecutive primary keys holding as many devices each
+        """
+
+        count = self.count()
+        if not count:
+            return []
+
+        size = -(-count // shards)
+        pks = self.order_by('pk').values_list('pk', flat=True)
+        return [pks[index - 1] for index in range(size, count, size)]
 
-        return apns_send_bulk_message(registration_ids=ids,
-                alert=message, **kwargs)
+    def group_by_app(self):
+        """
+        Yields (app_id, queryset) tuples splitting this queryset by the
+        app of its devices
+        """
 
+        app_ids = self.order_by().values_list('app_id', flat=True).distinct()
+        for app_id in list(app_ids):
+            yield app_id, self.filter(app_id=app_id)
 
-class GCMQuerySet(GCMMessageMixin, models.query.QuerySet):
+    def deactivate(self):
+        """
+        Marks every device in this queryset inactive in one update
+        """
+        return self.update(active=False)
+
+    def update_registration_id(self, registration_id):
+        return self.update(registration_id=registration_id)
+
+
+class MongoDeviceQuerySetMixin(object):
+    def active(self):
+        """
+        Returns the active devices, a condition the partial index on
+        the active devices of each app is defined with
+        """
+        return self.filter(active=True)
+
+    def owned_by(self, owner):
+        """
+        Returns the active devices of owner, which the index on (owner,
+        active) covers
+        """
+        return self.filter(owner=owner, active=True)
+
+    def with_registration_ids(self, registration_ids):
+        """
+        Returns the devices among registration_ids, which the hashed
+        index on the registration id covers
+        """
+        return self.filter(registration_id__in=list(registration_ids))
+
+    def iter_registration_id_pages(self, page_size):
+        """
+        Yields the registration ids of this queryset in lists of
+        page_size, see iter_device_pages
+        """
+
+        for page in self.iter_device_pages(page_size):
+            yield [registration_id for _, registration_id in page]
+
+    def iter_device_pages(self, page_size, after=None):
+        """
+        Yields the (id, registration_id) tuples of this queryset in lists
+        of page_size, in id order starting after the id after, fetched
+        through a single server side cursor that only returns those two
+        fields.
+        """
+
+        queryset = self
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+
+        page = []
+        cursor = queryset.no_cache().order_by('id').scalar('id',
+                'registration_id').batch_size(page_size)
+        for device in cursor:
+            page.append(device)
+            if len(page) >= page_size:
+                yield page
+                page = []
+
+        if page:
+            yield page
+
+    def shard_bounds(self, shards):
+        """
+        Returns the ids splitting this queryset into at most shards
+        ranges of consecutive ids holding as many devices each
+        """
+
+        count = self.count()
+        if not count:
+            return []
+
+        size = -(-count // shards)
+        ids = self.order_by('id').scalar('id')
+        return [ids[index - 1] for index in range(size, count, size)]
+
+    def group_by_app(self):
+        """
+        Yields (app_id, queryset) tuples splitting this queryset by the
+        app of its devices
+        """
+
+        ## distinct skips documents without an app_id
+        app_ids = self.distinct('app_id')
+        if None not in app_ids and self.filter(app_id=None).only('id').first():
+            app_ids.append(None)
+
+        for app_id in app_ids:
+            yield app_id, self.filter(app_id=app_id)
+
+    def deactivate(self):
+        """
+        Marks every device in this queryset inactive in one update
+        """
+        return self.update(set__active=False)
+
+    def update_registration_id(self, registration_id):
+        return self.update(set__registration_id=registration_id)
+
+
+class GCMQuerySet(GCMMessageMixin, DeviceQuerySetMixin, models.query.QuerySet):
     """
     Implements additional methods to be used by this queryset.
     """
-    pass
 
+    def subscribed_to(self, topic):
+        """
+        Returns the devices subscribed to a GCM topic
+        """
+        return self.filter(topic_subscriptions__topic=topic)
+
+    def _add_topic(self, topic, pks):
+        from .base import GCMTopicSubscription
+        existing = set(GCMTopicSubscription.objects.filter(topic=topic,
+            device__in=pks).values_list('device_id', flat=True))
+        GCMTopicSubscription.objects.bulk_create([GCMTopicSubscription(
+            device_id=pk, topic=topic) for pk in pks if pk not in existing])
 
-class APNSQuerySet(APNSMessageMixin, models.query.QuerySet):
+    def _remove_topic(self, topic, pks):
+        from .base import GCMTopicSubscription
+        GCMTopicSubscription.objects.filter(topic=topic,
+                device__in=pks).delete()
+
+
+class APNSQuerySet(APNSMessageMixin, DeviceQuerySetMixin, models.query.QuerySet):
     """
     Implements additional methods to be used by this queryset.
     """
-    pass
 
+    def with_registration_ids(self, registration_ids):
+        """
+        Returns the devices among registration_ids. Invalid tokens, e.g.
+        those a send reported as such, are left out since no device
+        can have them and looking them up raises ValidationError.
+        """
 
-class GCMMongoQuerySet(GCMMessageMixin, QuerySet):
-    """
-    Defines additional methods to be used by GCM mongo query set
-    """
-    pass
+        tokens = []
+        for registration_id in registration_ids:
+            try:
+                tokens.append(normalize_apns_token(registration_id))
+            except ValueError:
+                pass
+        return super(APNSQuerySet, self).with_registration_ids(tokens)
+
+
+class GCMDeviceGroupMixin(object):
+    def create_group(self, name, devices, app_id=None):
+        """
+        Creates a GCM device group of devices named name and returns it,
+        with the notification key GCM created for it
+        """
 
+        from instapush.libs.gcm import gcm_create_group
+        devices = list(devices)
+        notification_key = gcm_create_group(name, [device.registration_id
+            for device in devices], app_id=app_id)
 
-class APNSMongoQuerySet(APNSMessageMixin, QuerySet):
+        group = self.create(name=name, notification_key=notification_key,
+                app_id=app_id)
+        group._add_members(devices)
+        return group
+
+
+class GCMDeviceGroupQuerySet(GCMDeviceGroupMixin, models.query.QuerySet):
     """
-    Defines additional methods to be used by APNS mongo query set
+    Implements additional methods to be used by this queryset.
     """
     pass
-
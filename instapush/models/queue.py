@@ -0,0 +1,28 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class PushJob(models.Model):
+    """
+    Represents a send queued for the instapush worker. Used by the
+    database queue backend.
+    """
+
+    task = models.CharField(_('task'), max_length=100)
+    payload = models.TextField(_('payload'))
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    available_at = models.DateTimeField(_('available at'))
+    locked_until = models.DateTimeField(_('locked until'), blank=True,
+            null=True)
+    failed = models.BooleanField(_('failed'), default=False)
+    last_error = models.TextField(_('last error'), blank=True, null=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+
+    class Meta:
+        app_label = 'instapush'
+        verbose_name = _('Push Job')
+        verbose_name_plural = _('Push Jobs')
+        index_together = [('failed', 'available_at')]
+
+    def __unicode__(self):
+        return "%s #%s" % (self.task, self.pk)
@@ -0,0 +1,176 @@
+"""
+Payload templates for personalized notifications. A template is a
+payload whose strings may hold ``$name`` or ``${name}`` placeholders,
+as in string.Template; ``$$`` is a literal dollar sign. It is encoded
+to JSON once, and rendering only splices the JSON of each device's
+variables between the precomputed bytes.
+"""
+
+import collections
+import json
+import re
+import string
+import threading
+
+from django.utils import six
+
+from .settings import INSTAPUSH_SETTINGS as settings
+
+
+## placeholders are swapped for these markers before the payload is
+## encoded, json escapes them to \u0000<index>\u0000
+MARKER = u"\x00%d\x00"
+ENCODED_MARKER = re.compile(br'"\\u0000(\d+)\\u0000"|\\u0000(\d+)\\u0000')
+
+
+class PayloadTemplate(object):
+    """
+    A compiled payload. A placeholder making up a whole string is
+    replaced by the JSON of its variable, so it may render as any
+    JSON type; a placeholder within a string is replaced by the text
+    of its variable.
+    """
+
+    def __init__(self, payload, max_size=None, overflow_error=ValueError):
+        self.payload = payload
+        self.max_size = max_size
+        self.overflow_error = overflow_error
+
+        slots = []
+        encoded = json.dumps(_mark(payload, slots), separators=(",", ":"),
+                sort_keys=True).encode("utf-8")
+
+        ## chunks of static bytes around the (name, whole) slots, in the
+        ## order the slots appear in the encoded payload
+        self.chunks = []
+        self.slots = []
+        offset = 0
+        for match in ENCODED_MARKER.finditer(encoded):
+            self.chunks.append(encoded[offset:match.start()])
+            self.slots.append(slots[int(match.group(1) or match.group(2))])
+            offset = match.end()
+        self.chunks.append(encoded[offset:])
+
+        self.static_size = sum(len(chunk) for chunk in self.chunks)
+        self._check_size(self.static_size)
+
+    def render(self, variables=None):
+        """
+        Returns the payload bytes for a dict of variables
+        """
+
+        if not self.slots:
+            return self.chunks[0]
+
+        parts = [self.chunks[0]]
+        for (name, whole), chunk in zip(self.slots, self.chunks[1:]):
+            value = variables[name]
+            if whole:
+                parts.append(json.dumps(value, separators=(",", ":"),
+                    sort_keys=True).encode("utf-8"))
+            else:
+                parts.append(json.dumps(six.text_type(value))[1:-1].encode(
+                    "utf-8"))
+            parts.append(chunk)
+
+        payload = b"".join(parts)
+        self._check_size(len(payload))
+        return payload
+
+    def fill(self, variables=None):
+        """
+        Returns a copy of the payload with its placeholders replaced by
+        the variables, for callers that need to rework it before it is
+        encoded
+        """
+
+        return _fill(self.payload, variables or {})
+
+    def _check_size(self, size):
+        if self.max_size is not None and size > self.max_size:
+            raise self.overflow_error("Notification body cannot exceed %i "\
+                    "bytes" % self.max_size)
+
+
+def _mark(value, slots):
+    """
+    Returns a copy of value with placeholders replaced by markers,
+    appending a (name, whole) tuple to slots for each of them
+    """
+
+    if isinstance(value, dict):
+        return dict((key, _mark(item, slots)) for key, item in value.items())
+
+    if isinstance(value, (list, tuple)):
+        return [_mark(item, slots) for item in value]
+
+    if not isinstance(value, six.string_types) or "$" not in value:
+        return value
+
+    parts = []
+    offset = 0
+    for match in string.Template.pattern.finditer(value):
+        parts.append(value[offset:match.start()])
+        offset = match.end()
+
+        if match.group("escaped") is not None:
+            parts.append("$")
+            continue
+
+        name = match.group("named") or match.group("braced")
+        if name is None:
+            raise ValueError("Invalid placeholder in %r" % value)
+
+        whole = match.start() == 0 and match.end() == len(value)
+        parts.append(MARKER % len(slots))
+        slots.append((name, whole))
+    parts.append(value[offset:])
+
+    return u"".join(parts)
+
+
+def _fill(value, variables):
+    if isinstance(value, dict):
+        return dict((key, _fill(item, variables)) for key, item in value.items())
+
+    if isinstance(value, (list, tuple)):
+        return [_fill(item, variables) for item in value]
+
+    if not isinstance(value, six.string_types) or "$" not in value:
+        return value
+
+    match = string.Template.pattern.match(value)
+    if match is not None and match.end() == len(value):
+        name = match.group("named") or match.group("braced")
+        if name is not None:
+            return variables[name]
+
+    return string.Template(value).substitute(variables)
+
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compile_template(payload, max_size=None, overflow_error=ValueError):
+    """
+    Returns the PayloadTemplate of a payload, reusing one compiled
+    before for an equal payload. The TEMPLATE_CACHE_SIZE most recently
+    used templates are kept.
+    """
+
+    key = (json.dumps(payload, sort_keys=True), max_size, overflow_error)
+
+    with _cache_lock:
+        template = _cache.pop(key, None)
+        if template is not None:
+            _cache[key] = template
+            return template
+
+    template = PayloadTemplate(payload, max_size, overflow_error)
+
+    with _cache_lock:
+        _cache[key] = template
+        while len(_cache) > settings['TEMPLATE_CACHE_SIZE']:
+            _cache.popitem(last=False)
+    return template
@@ -0,0 +1,74 @@
+"""
+A durable queue to send push notifications outside of the request
+cycle. Jobs are persisted by a pluggable backend and executed by the
+``instapush_worker`` management command with at-least-once semantics.
+"""
+
+import json
+import threading
+
+from ..settings import INSTAPUSH_SETTINGS as settings
+from ..utils import get_model
+
+
+## only registered tasks can be run by a worker, so a job row can
+## never be used to call arbitrary code
+TASKS = {
+    'gcm_send_message': 'instapush.libs.gcm.gcm_send_message',
+    'gcm_send_bulk_message': 'instapush.libs.gcm.gcm_send_bulk_message',
+    'gcm_send_topic_message': 'instapush.libs.gcm.gcm_send_topic_message',
+    'gcm_send_group_message': 'instapush.libs.gcm.gcm_send_group_message',
+    'apns_send_message': 'instapush.libs.apns.apns_send_message',
+    'apns_send_bulk_message': 'instapush.libs.apns.apns_send_bulk_message',
+    'campaign_send_shard': 'instapush.campaigns.send_shard',
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+@settings.on_reload
+def _reset_backend():
+    global _backend
+    _backend = None
+
+
+def register_task(name, location):
+    """
+    Registers the function at the dotted path ``location`` to be run
+    for jobs enqueued as ``name``
+    """
+
+    TASKS[name] = location
+
+
+def get_backend():
+    """
+    Returns the queue backend configured in QUEUE_SETTINGS
+    """
+
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                queue_settings = settings.get('QUEUE_SETTINGS')
+                backend_class = get_model(queue_settings['BACKEND'])
+                _backend = backend_class(**queue_settings['OPTIONS'])
+    return _backend
+
+
+def enqueue(task, **kwargs):
+    """
+    Persists a job running ``task`` with the given keyword arguments,
+    which must be json serializable, and returns immediately.
+    """
+
+    if task not in TASKS:
+        raise ValueError("'%s' is not a registered instapush task" % task)
+
+    return get_backend().push(task, json.dumps(kwargs))
+
+
+def run_task(task, payload):
+    function = get_model(TASKS[task])
+    return function(**json.loads(payload))
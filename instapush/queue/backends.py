@@ -0,0 +1,215 @@
+"""
+Storage backends for the send queue. A backend persists jobs and hands
+them out to workers under a lease: a claimed job that is neither
+acknowledged nor retried before its lease expires is handed out again.
+"""
+
+import collections
+import os
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+
+Job = collections.namedtuple('Job', ['id', 'task', 'payload', 'attempts'])
+
+
+class BaseBackend(object):
+    """
+    Defines the methods every queue backend implements
+    """
+
+    def push(self, task, payload):
+        """
+        Persists a new job and returns its id
+        """
+        raise NotImplementedError
+
+    def claim(self, lease):
+        """
+        Leases the oldest available job for ``lease`` seconds and
+        returns it, or returns None if there is no job available
+        """
+        raise NotImplementedError
+
+    def extend(self, job, lease):
+        """
+        Leases a claimed job for another ``lease`` seconds from now and
+        returns whether it was still held by the worker that claimed it
+        """
+        raise NotImplementedError
+
+    def ack(self, job):
+        """
+        Removes a job that completed
+        """
+        raise NotImplementedError
+
+    def retry(self, job, delay, error):
+        """
+        Makes a failed job available again after ``delay`` seconds
+        """
+        raise NotImplementedError
+
+    def bury(self, job, error):
+        """
+        Keeps a job that failed too many times without running it again
+        """
+        raise NotImplementedError
+
+
+class SQLiteBackend(BaseBackend):
+    """
+    Stores jobs in a local sqlite database. It is safe to share between
+    the processes of a single host and is meant for tests and small
+    deployments.
+    """
+
+    def __init__(self, path='instapush_queue.sqlite3'):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        ## sqlite connections must not cross threads nor forks
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30,
+                    isolation_level=None)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS instapush_job ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "task TEXT NOT NULL, "
+                "payload TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "available_at REAL NOT NULL, "
+                "locked_until REAL, "
+                "failed INTEGER NOT NULL DEFAULT 0, "
+                "last_error TEXT)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS instapush_job_available "
+                "ON instapush_job (failed, available_at)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def push(self, task, payload):
+        cursor = self._connection().execute(
+            "INSERT INTO instapush_job (task, payload, available_at) "
+            "VALUES (?, ?, ?)", (task, payload, time.time()))
+        return cursor.lastrowid
+
+    def claim(self, lease):
+        connection = self._connection()
+        now = time.time()
+
+        ## an immediate transaction takes the write lock up front, so no
+        ## two processes can claim the same job
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT id, task, payload, attempts FROM instapush_job "
+                "WHERE failed = 0 AND available_at <= ? AND "
+                "(locked_until IS NULL OR locked_until <= ?) "
+                "ORDER BY id LIMIT 1", (now, now)).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE instapush_job SET locked_until = ?, "
+                    "attempts = attempts + 1 WHERE id = ?",
+                    (now + lease, row[0]))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        return Job(row[0], row[1], row[2], row[3] + 1)
+
+    def extend(self, job, lease):
+        ## a job claimed again after its lease expired has more attempts
+        cursor = self._connection().execute(
+            "UPDATE instapush_job SET locked_until = ? WHERE id = ? AND "
+            "attempts = ? AND locked_until IS NOT NULL",
+            (time.time() + lease, job.id, job.attempts))
+        return cursor.rowcount > 0
+
+    def ack(self, job):
+        self._connection().execute(
+            "DELETE FROM instapush_job WHERE id = ?", (job.id,))
+
+    def retry(self, job, delay, error):
+        self._connection().execute(
+            "UPDATE instapush_job SET locked_until = NULL, available_at = ?, "
+            "last_error = ? WHERE id = ?", (time.time() + delay, error, job.id))
+
+    def bury(self, job, error):
+        self._connection().execute(
+            "UPDATE instapush_job SET locked_until = NULL, failed = 1, "
+            "last_error = ? WHERE id = ?", (error, job.id))
+
+
+class DatabaseBackend(BaseBackend):
+    """
+    Stores jobs in the PushJob table of the default django database.
+    Jobs are claimed with a conditional update, so any number of
+    workers on any number of hosts can share the table.
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+
+    @property
+    def model(self):
+        from ..models.queue import PushJob
+        return PushJob
+
+    def _jobs(self):
+        return self.model.objects.using(self.using)
+
+    def push(self, task, payload):
+        job = self._jobs().create(task=task, payload=payload,
+                available_at=timezone.now())
+        return job.pk
+
+    def claim(self, lease):
+        now = timezone.now()
+        locked_until = now + timedelta(seconds=lease)
+        available = self._jobs().filter(
+            Q(locked_until__isnull=True) | Q(locked_until__lte=now),
+            failed=False, available_at__lte=now).order_by('pk')
+
+        ## another worker may claim a candidate first, in which case the
+        ## update below matches no row and the next candidate is tried
+        for candidate in available.values('pk', 'locked_until', 'attempts')[:10]:
+            claimed = self._jobs().filter(pk=candidate['pk'],
+                    locked_until=candidate['locked_until'],
+                    attempts=candidate['attempts']).update(
+                    locked_until=locked_until,
+                    attempts=candidate['attempts'] + 1)
+            if claimed:
+                job = self._jobs().get(pk=candidate['pk'])
+                return Job(job.pk, job.task, job.payload, job.attempts)
+
+        return None
+
+    def extend(self, job, lease):
+        ## a job claimed again after its lease expired has more attempts
+        return bool(self._jobs().filter(pk=job.id, attempts=job.attempts,
+                locked_until__isnull=False).update(
+                locked_until=timezone.now() + timedelta(seconds=lease)))
+
+    def ack(self, job):
+        self._jobs().filter(pk=job.id).delete()
+
+    def retry(self, job, delay, error):
+        self._jobs().filter(pk=job.id).update(locked_until=None,
+                available_at=timezone.now() + timedelta(seconds=delay),
+                last_error=error)
+
+    def bury(self, job, error):
+        self._jobs().filter(pk=job.id).update(locked_until=None, failed=True,
+                last_error=error)
@@ -0,0 +1,115 @@
+"""
+Runs queued jobs
+"""
+
+import logging
+import signal
+import threading
+import time
+import traceback
+
+from django.db import connections
+
+from ..settings import INSTAPUSH_SETTINGS as settings
+from . import get_backend, run_task
+
+
+logger = logging.getLogger(__name__)
+
+
+class Worker(object):
+    """
+    Claims jobs from the queue backend and runs them. A job is only
+    acknowledged once its task returned; a job whose task raised is
+    retried with exponential backoff and buried after MAX_ATTEMPTS.
+    The lease of a job is extended every third of the lease while its
+    task runs, so that long sends are not handed out again. A worker
+    that dies mid-job leaves it locked until its lease expires, after
+    which another worker runs it again.
+    """
+
+    def __init__(self, backend=None, lease=None, poll_interval=None,
+            max_attempts=None, burst=False):
+        queue_settings = settings.get('QUEUE_SETTINGS')
+
+        self.backend = backend or get_backend()
+        self.lease = lease or queue_settings['LEASE']
+        self.poll_interval = poll_interval or queue_settings['POLL_INTERVAL']
+        self.max_attempts = max_attempts or queue_settings['MAX_ATTEMPTS']
+        self.burst = burst
+        self._stopping = False
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def run(self):
+        """
+        Runs jobs until stopped, or until the queue is empty in burst
+        mode. SIGTERM and SIGINT stop the worker after its current job.
+        """
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        while not self._stopping:
+            job = self.backend.claim(self.lease)
+            if job is None:
+                if self.burst:
+                    return
+                time.sleep(self.poll_interval)
+                continue
+
+            self.process(job)
+
+    def process(self, job):
+        try:
+            with _Heartbeat(self.backend, job, self.lease):
+                run_task(job.task, job.payload)
+        except Exception:
+            error = traceback.format_exc()
+            if job.attempts >= self.max_attempts:
+                logger.error("Burying job %s after %s attempts:\n%s",
+                        job.id, job.attempts, error)
+                self.backend.bury(job, error)
+            else:
+                logger.warning("Job %s failed, retrying:\n%s", job.id, error)
+                self.backend.retry(job, min(300, 2 ** job.attempts), error)
+        else:
+            self.backend.ack(job)
+
+
+class _Heartbeat(object):
+    """
+    Extends the lease of a job from a thread of its own for the duration
+    of a with block
+    """
+
+    def __init__(self, backend, job, lease):
+        self.backend = backend
+        self.job = job
+        self.lease = lease
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._done.wait(self.lease / 3.0):
+                if not self.backend.extend(self.job, self.lease):
+                    logger.warning("Job %s is no longer held by this worker",
+                            self.job.id)
+                    return
+        except Exception:
+            logger.exception("Could not extend the lease of job %s",
+                    self.job.id)
+        finally:
+            ## the database connections of this thread
+            connections.close_all()
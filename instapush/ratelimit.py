@@ -0,0 +1,204 @@
+"""
+Rate limits the notifications sent to GCM and APNS. Limits are kept
+per provider and credential in a shared-state backend, and lowered
+for a while whenever the provider starts throttling.
+"""
+
+import hashlib
+import threading
+import time
+
+from .settings import INSTAPUSH_SETTINGS as settings
+from .utils import get_model
+
+
+class LocalBackend(object):
+    """
+    Keeps the token buckets in memory, limiting each process on its own
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, count, rate):
+        """
+        Takes ``count`` tokens from the bucket ``key``, refilled at
+        ``rate`` tokens per second and holding at most one second worth
+        of them. Returns 0 if the tokens were taken, or how many seconds
+        to wait before trying again.
+        """
+
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (rate, now))
+            tokens = min(max(rate, count), tokens + (now - updated) * rate)
+            if tokens >= count:
+                self._buckets[key] = (tokens - count, now)
+                return 0
+
+            self._buckets[key] = (tokens, now)
+            return (count - tokens) / float(rate)
+
+
+class CacheBackend(object):
+    """
+    Counts the tokens taken in each one second window in a django cache,
+    so that every process sharing the cache shares the limit. The cache
+    must support atomic increments, e.g. memcached or redis.
+    """
+
+    def __init__(self, alias='default', prefix='instapush:ratelimit'):
+        self.alias = alias
+        self.prefix = prefix
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def take(self, key, count, rate):
+        now = time.time()
+        window = int(now)
+        cache_key = "%s:%s:%d" % (self.prefix, key, window)
+
+        self.cache.add(cache_key, 0, 2)
+        taken = self.cache.incr(cache_key, count)
+        if taken <= rate:
+            return 0
+
+        ## the refused tokens are given back so that smaller takes may
+        ## still fit in the window
+        self.cache.decr(cache_key, count)
+        return window + 1 - now
+
+
+class RateLimiter(object):
+    """
+    Limits sends to ``rate`` messages per second. ``throttled`` halves
+    the rate, down to ``min_rate``, at most once per ``COOLDOWN``
+    seconds; the rate then grows back by ``RECOVERY`` of the configured
+    rate per second. Tokens are taken from the backend in blocks of a
+    tenth of a second worth, so acquiring single messages is cheap, and
+    of at most one second worth, so that larger counts are taken over
+    several seconds.
+    """
+
+    COOLDOWN = 1.0
+    RECOVERY = 0.05
+
+    def __init__(self, key, rate, backend=None, min_rate=None):
+        self.key = key
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate or max(1, rate / 100.0))
+        self.rate = self.max_rate
+        self.backend = backend or get_rate_limit_backend()
+        self._available = 0
+        self._updated = time.time()
+        self._throttled = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """
+        Blocks until ``count`` messages can be sent
+        """
+
+        while True:
+            wait = self.reserve(count)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def reserve(self, count=1):
+        """
+        Takes ``count`` messages if they can be sent right away and
+        returns 0, otherwise returns how many seconds to wait
+        """
+
+        with self._lock:
+            self._recover()
+            while self._available < count:
+                block = min(max(count - self._available, int(self.rate / 10)),
+                        max(1, int(self.rate)))
+                wait = self.backend.take(self.key, block, self.rate)
+                if wait:
+                    return wait
+                self._available += block
+
+            self._available -= count
+            return 0
+
+    def throttled(self):
+        """
+        Lowers the rate after the provider throttled a send
+        """
+
+        now = time.time()
+        with self._lock:
+            self._recover()
+            if now - self._throttled >= self.COOLDOWN:
+                self._throttled = now
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._available = 0
+
+    def _recover(self):
+        now = time.time()
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate +
+                    self.max_rate * self.RECOVERY * (now - self._updated))
+        self._updated = now
+
+
+_backend = None
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+@settings.on_reload
+def _reset_rate_limits():
+    global _backend
+    with _limiters_lock:
+        _backend = None
+        _limiters.clear()
+
+
+def get_rate_limit_backend():
+    """
+    Returns the backend configured in RATE_LIMIT_BACKEND
+    """
+
+    global _backend
+    with _limiters_lock:
+        if _backend is None:
+            backend_class = get_model(settings['RATE_LIMIT_BACKEND'])
+            _backend = backend_class(**settings['RATE_LIMIT_OPTIONS'])
+    return _backend
+
+
+def get_rate_limiter(provider, credential, provider_settings=None):
+    """
+    Returns the process wide rate limiter of a credential (a GCM api key
+    or APNS certificate) of ``provider``, 'GCM_SETTINGS' or
+    'APNS_SETTINGS', or None if its RATE_LIMIT is not set.
+    ``provider_settings`` are the settings of the app the credential
+    belongs to, the global ones by default.
+    """
+
+    if provider_settings is None:
+        provider_settings = settings[provider]
+    rate = provider_settings.get('RATE_LIMIT')
+    if not rate:
+        return None
+
+    ## credentials are hashed so that api keys never end up in caches
+    key = "%s:%s" % (provider.split('_')[0].lower(),
+            hashlib.sha1(str(credential).encode('utf-8')).hexdigest()[:16])
+
+    limiter = _limiters.get(key)
+    if limiter is None or limiter.max_rate != rate:
+        backend = get_rate_limit_backend()
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None or limiter.max_rate != rate:
+                limiter = _limiters[key] = RateLimiter(key, rate, backend)
+    return limiter
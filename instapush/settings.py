@@ -1,33 +1,231 @@
+"""
+The instapush settings: the INSTAPUSH_SETTINGS dictionary of the django
+settings, with defaults for every missing key. Nothing is read from the
+django settings until a setting is first used.
+"""
+
+import threading
+
 from django.conf import settings
 
+from .utils import get_model
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # django < 1.8
+    from django.test.signals import setting_changed
+
 
 def gcm_deactivate(rids):
-    pass
+    from .deactivation import gcm_deactivator
+    gcm_deactivator.add(rids)
+
+
+def apns_deactivate(rids):
+    from .deactivation import apns_deactivator
+    apns_deactivator.add(rids)
+
+
+def gcm_update_canonical_ids(pairs):
+    """
+    Replaces old registration ids by the canonical ids GCM returned
+    for them on GCM_SETTINGS['DEVICE_MODEL'], if one is configured.
+    """
+
+    model = GCM_SETTINGS.get('DEVICE_MODEL')
+    if not model:
+        return
+
+    model = get_model(model)
+    for old_id, canonical_id in pairs:
+        model.objects.filter(registration_id=old_id).update_registration_id(
+                canonical_id)
+
+
+def _load(instapush_settings, debug):
+    """
+    Returns a copy of instapush_settings, and of its provider settings,
+    with the defaults of every missing key filled in
+    """
+
+    values = dict(instapush_settings)
+    values.setdefault('DEACTIVATE_BATCH_SIZE', 1000)
+    values.setdefault('DEACTIVATE_FLUSH_INTERVAL', 5)
+    values.setdefault('PAGE_SIZE', 1000)
+    values.setdefault('RATE_LIMIT_BACKEND', 'instapush.ratelimit.LocalBackend')
+    values.setdefault('RATE_LIMIT_OPTIONS', {})
+    values.setdefault('APPS', {})
+    values.setdefault('MAX_CACHED_APPS', 32)
+    values.setdefault('TEMPLATE_CACHE_SIZE', 256)
+    values.setdefault('METRICS_BACKEND', 'instapush.metrics.NullMetrics')
+    values.setdefault('METRICS_OPTIONS', {})
+    values.setdefault('DEDUP_BACKEND', 'instapush.dedup.LocalBackend')
+    values.setdefault('DEDUP_OPTIONS', {})
+
+    ## GCM Settings
+    gcm_settings = dict(values.get('GCM_SETTINGS', {}))
+    gcm_settings.setdefault('API_URL', 'https://android.googleapis.com/gcm/send')
+    gcm_settings.setdefault('MAX_RECIPIENTS', 1000)
+    gcm_settings.setdefault('DEACTIVATE_UNREG_CALLBACK', gcm_deactivate)
+    gcm_settings.setdefault('POOL_SIZE', 10)
+    gcm_settings.setdefault('CONNECT_TIMEOUT', 5)
+    gcm_settings.setdefault('READ_TIMEOUT', 30)
+    gcm_settings.setdefault('GZIP_REQUESTS', False)
+    gcm_settings.setdefault('CONCURRENCY', 1)
+    gcm_settings.setdefault('MAX_RETRIES', 3)
+    gcm_settings.setdefault('RETRY_BACKOFF', 1)
+    gcm_settings.setdefault('MAX_BACKOFF', 60)
+    gcm_settings.setdefault('DEVICE_MODEL', None)
+    gcm_settings.setdefault('CANONICAL_ID_CALLBACK', gcm_update_canonical_ids)
+    gcm_settings.setdefault('RATE_LIMIT', None)
+    gcm_settings.setdefault('IID_URL', 'https://iid.googleapis.com/iid/v1')
+    gcm_settings.setdefault('NOTIFICATION_KEY_URL', 'https://android.googleapis.com/gcm/notification')
+    gcm_settings.setdefault('SENDER_ID', None)
+    gcm_settings.setdefault('DEDUP_TTL', None)
+
+
+    ## APNS Settings
+    apns_settings = dict(values.get('APNS_SETTINGS', {}))
+    apns_settings.setdefault('PORT', 2195)
+    apns_settings.setdefault('FEEDBACK_PORT', 2196)
+    apns_settings.setdefault('FEEDBACK_TIMEOUT', 10)
+    apns_settings.setdefault('ERROR_TIMEOUT', None)
+    apns_settings.setdefault('MAX_SIZE', 2048)
+    apns_settings.setdefault('POOL_SIZE', 4)
+    apns_settings.setdefault('CONNECTION_MAX_IDLE', 300)
+    apns_settings.setdefault('RESEND_BUFFER_SIZE', 10000)
+    apns_settings.setdefault('BACKEND', 'binary')
+    apns_settings.setdefault('HTTP2_PORT', 443)
+    apns_settings.setdefault('TOPIC', None)
+    apns_settings.setdefault('MAX_CONCURRENT_STREAMS', 1000)
+    apns_settings.setdefault('HTTP2_READ_TIMEOUT', 30)
+    apns_settings.setdefault('CONNECT_TIMEOUT', 10)
+    apns_settings.setdefault('DEVICE_MODEL', None)
+    apns_settings.setdefault('DEACTIVATE_UNREG_CALLBACK', apns_deactivate)
+    apns_settings.setdefault('RATE_LIMIT', None)
+    apns_settings.setdefault('MAX_CONNECTIONS', None)
+    apns_settings.setdefault('TRUNCATE_ALERT', False)
+    apns_settings.setdefault('DEDUP_TTL', None)
+
+    ## Add host urls based on environment
+    if debug:
+        apns_settings.setdefault('HOST', 'gateway.sandbox.push.apple.com')
+        apns_settings.setdefault('FEEDBACK_HOST', 'feedback.sandbox.push.apple.com')
+        apns_settings.setdefault('HTTP2_HOST', 'api.sandbox.push.apple.com')
+    else:
+        apns_settings.setdefault('HOST', 'gateway.push.apple.com')
+        apns_settings.setdefault('FEEDBACK_HOST', 'feedback.push.apple.com')
+        apns_settings.setdefault('HTTP2_HOST', 'api.push.apple.com')
+
+
+    ## Queue Settings
+    queue_settings = dict(values.get('QUEUE_SETTINGS', {}))
+    queue_settings.setdefault('BACKEND', 'instapush.queue.backends.DatabaseBackend')
+    queue_settings.setdefault('OPTIONS', {})
+    queue_settings.setdefault('LEASE', 300)
+    queue_settings.setdefault('POLL_INTERVAL', 1)
+    queue_settings.setdefault('MAX_ATTEMPTS', 5)
+
+
+    values['GCM_SETTINGS'] = gcm_settings
+    values['APNS_SETTINGS'] = apns_settings
+    values['QUEUE_SETTINGS'] = queue_settings
+    return values
+
+
+class _DictProxy(object):
+    """
+    Forwards the dict protocol to the dict returned by calling get
+    """
+
+    def __init__(self, get):
+        self._get = get
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __setitem__(self, key, value):
+        self._get()[key] = value
+
+    def __contains__(self, key):
+        return key in self._get()
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def __repr__(self):
+        return repr(self._get())
+
+    def __getattr__(self, name):
+        ## get, setdefault, update, items...
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get(), name)
+
+
+class Settings(_DictProxy):
+    """
+    The INSTAPUSH_SETTINGS of the django settings with defaults filled
+    in, loaded on first access rather than at import. reload() makes
+    the next access load them again and runs the callbacks registered
+    with on_reload, which drop whatever was built from the previous
+    values (sessions, connection pools, backends). Django's
+    setting_changed signal reloads them, e.g. under override_settings.
+    """
+
+    def __init__(self):
+        super(Settings, self).__init__(self._current)
+        self._values = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def _current(self):
+        values = self._values
+        if values is None:
+            with self._lock:
+                if self._values is None:
+                    self._values = _load(getattr(settings,
+                        'INSTAPUSH_SETTINGS', {}), settings.DEBUG)
+                values = self._values
+        return values
+
+    def section(self, name):
+        """
+        Returns a lazy view of the provider settings under name
+        """
+        return SettingsSection(self, name)
+
+    def on_reload(self, callback):
+        self._callbacks.append(callback)
+        return callback
+
+    def reload(self):
+        with self._lock:
+            self._values = None
+        for callback in self._callbacks:
+            callback()
+
 
-INSTAPUSH_SETTINGS = getattr(settings, 'INSTAPUSH_SETTINGS', {})
+class SettingsSection(_DictProxy):
+    """
+    A lazy view of one of the provider settings dicts, e.g. GCM_SETTINGS
+    """
 
-## GCM Settings
-GCM_SETTINGS = INSTAPUSH_SETTINGS.get('GCM_SETTINGS', {})
-GCM_SETTINGS.setdefault('API_URL', 'https://android.googleapis.com/gcm/send')
-GCM_SETTINGS.setdefault('MAX_RECIPIENTS', 1000)
-GCM_SETTINGS.setdefault('DEACTIVATE_UNREG_CALLBACK', gcm_deactivate)
+    def __init__(self, settings, name):
+        super(SettingsSection, self).__init__(lambda: settings[name])
 
 
-## APNS Settings
-APNS_SETTINGS = INSTAPUSH_SETTINGS.get('APNS_SETTINGS', {})
-APNS_SETTINGS.setdefault('PORT', 2195)
-APNS_SETTINGS.setdefault('FEEDBACK_PORT', 2196)
-APNS_SETTINGS.setdefault('ERROR_TIMEOUT', None)
-APNS_SETTINGS.setdefault('MAX_SIZE', 2048)
+INSTAPUSH_SETTINGS = Settings()
+GCM_SETTINGS = INSTAPUSH_SETTINGS.section('GCM_SETTINGS')
+APNS_SETTINGS = INSTAPUSH_SETTINGS.section('APNS_SETTINGS')
+QUEUE_SETTINGS = INSTAPUSH_SETTINGS.section('QUEUE_SETTINGS')
 
-## Add host urls based on environment
-if settings.DEBUG:
-    APNS_SETTINGS.setdefault('HOST', 'gateway.sandbox.push.apple.com')
-    APNS_SETTINGS.setdefault('FEEDBACK_HOST', 'feedback.sandbox.push.apple.com')
-else:
-    APNS_SETTINGS.setdefault('HOST', 'gateway.push.apple.com')
-    APNS_SETTINGS.setdefault('FEEDBACK_HOST', 'feedback.push.apple.com')
 
+def _setting_changed(setting, **kwargs):
+    if setting in ('INSTAPUSH_SETTINGS', 'DEBUG'):
+        INSTAPUSH_SETTINGS.reload()
 
-INSTAPUSH_SETTINGS.setdefault('GCM_SETTINGS', GCM_SETTINGS)
-INSTAPUSH_SETTINGS.setdefault('APNS_SETTINGS', APNS_SETTINGS)
+setting_changed.connect(_setting_changed)
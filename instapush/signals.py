@@ -0,0 +1,19 @@
+"""
+Signals sent by the push senders. The sender of each signal is the
+provider, "gcm" or "apns".
+"""
+
+from django.dispatch import Signal
+
+
+## sent once a send function returned, with the ``result`` it returned,
+## its ``duration`` in seconds and the ``app_id`` it sent for
+push_sent = Signal()
+
+## sent when a send function raised, with the ``exception``, the
+## ``duration`` in seconds and the ``app_id``
+push_failed = Signal()
+
+## sent with the ``registration_ids`` the provider reported as no longer
+## registered, right before they are deactivated, and the ``app_id``
+devices_unregistered = Signal()
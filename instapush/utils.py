@@ -1,12 +1,49 @@
+import binascii
 import importlib
 
+from django.utils import six
+
+
+## size in bytes of an APNS device token
+APNS_TOKEN_SIZE = 32
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def is_model_label(value):
+    """
+    Returns whether value is the label of a model of an installed app,
+    e.g. "auth.User", rather than the dotted path of a class
+    """
+
+    from django.apps import apps
+
+    if not isinstance(value, six.string_types) or value.count(".") != 1:
+        return False
+    return value.split(".")[0] in apps.app_configs
+
+
+def get_device_owner_label():
+    """
+    Returns the label of the model the owner of the sql devices refers
+    to: DEVICE_OWNER_MODEL when it is a model label, the user model
+    otherwise, e.g. when the project keeps its devices in mongo
+    """
+
+    from django.conf import settings
+
+    owner = getattr(settings, 'INSTAPUSH_SETTINGS', {}).get(
+            'DEVICE_OWNER_MODEL')
+    if is_model_label(owner):
+        return owner
+    return settings.AUTH_USER_MODEL
+
 
 def get_model(module_location):
     """
     Returns the instance of the given module location.
     """
 
-    if not isinstance(module_location, (str, unicode)):
+    if not isinstance(module_location, six.string_types):
         raise ValueError("The value provided should either be a string or "\
                 "unicode instance. The value '%s' provided was %s "\
                 "rather." % (module_location, type(module_location)))
@@ -28,3 +65,25 @@ def get_model(module_location):
 
     except AttributeError:
         pass
+
+
+def normalize_apns_token(token):
+    """
+    Returns the lowercase hex form of an APNS device token given in hex,
+    with or without the spaces and angle brackets of its description on
+    iOS, or as its 32 bytes. Raises ValueError for an invalid token.
+    """
+
+    if isinstance(token, six.binary_type):
+        if len(token) == APNS_TOKEN_SIZE:
+            return binascii.hexlify(token).decode("ascii")
+        token = token.decode("ascii")
+
+    if not isinstance(token, six.string_types):
+        raise ValueError("%r is not a valid APNS device token" % (token,))
+
+    normalized = token.strip().strip("<>").replace(" ", "").lower()
+    if len(normalized) != APNS_TOKEN_SIZE * 2 or \
+            not HEX_DIGITS.issuperset(normalized):
+        raise ValueError("%r is not a valid APNS device token" % (token,))
+    return normalized
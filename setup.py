@@ -18,6 +18,11 @@ setup(
     zip_safe=False,
     install_requires=[
         'requests>=2.8.1',
-        'requests-toolbelt>=0.4.0'
-    ]
+        'requests-toolbelt>=0.4.0',
+        'futures>=3.0; python_version < "3"',
+    ],
+    extras_require={
+        'http2': ['h2>=3.0'],
+        'async': ['aiohttp>=3.0'],
+    }
 )
@@ -0,0 +1,28 @@
+"""
+Sets django up for the tests and creates their database with the
+migrations of instapush
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+
+def pytest_configure(config):
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    config._instapush_db = connection.creation.create_test_db(verbosity=0)
+
+
+def pytest_unconfigure(config):
+    from django.db import connection
+    from django.test.utils import teardown_test_environment
+
+    connection.creation.destroy_test_db(config._instapush_db, verbosity=0)
+    teardown_test_environment()
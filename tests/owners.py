@@ -0,0 +1,9 @@
+"""
+A device owner document, imported only through DEVICE_OWNER_MODEL
+"""
+
+import mongoengine
+
+
+class Owner(mongoengine.Document):
+    name = mongoengine.StringField()
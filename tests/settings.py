@@ -0,0 +1,41 @@
+"""
+Django settings of the tests
+"""
+
+SECRET_KEY = "tests"
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "instapush",
+]
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+
+USE_TZ = True
+
+INSTAPUSH_SETTINGS = {
+    "DEVICE_OWNER_MODEL": "auth.User",
+    ## devices are deactivated when the tests flush them
+    "DEACTIVATE_FLUSH_INTERVAL": 0,
+    "METRICS_BACKEND": "instapush.metrics.MemoryMetrics",
+    "GCM_SETTINGS": {
+        "API_KEY": "tests",
+    },
+    "APNS_SETTINGS": {
+        "HOST": "localhost",
+        "FEEDBACK_HOST": "localhost",
+        "HTTP2_HOST": "localhost",
+    },
+}
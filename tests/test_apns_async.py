@@ -0,0 +1,113 @@
+import asyncio
+import time
+from binascii import unhexlify
+
+from django.test import SimpleTestCase
+
+from instapush.exceptions import APNSServerError
+from instapush.libs.apns_async import (
+    AsyncAPNSConnection,
+    AsyncAPNSConnectionPool,
+    apns_send_bulk_message_async,
+    apns_send_message_async,
+)
+from instapush.libs.apns_http2_async import AsyncAPNSHTTP2Connection
+
+from .utils import FakeGateway, FakeHTTP2Gateway, mock, override_instapush
+
+
+TOKENS = ["%064x" % index for index in range(5)]
+SLOW = "%064x" % 99
+
+
+def patch_apns_async(gateway):
+    """
+    Returns a patch of the binary asyncio senders connecting to gateway
+    """
+
+    class GatewayConnection(AsyncAPNSConnection):
+        async def connect(self):
+            self.close()
+            reader, self.writer = await asyncio.open_connection(
+                    sock=gateway.connect())
+            self._listener = asyncio.ensure_future(self._listen(reader))
+            self.last_used = time.time()
+
+    return mock.patch("instapush.libs.apns_async.get_connection_pool",
+            return_value=AsyncAPNSConnectionPool(GatewayConnection))
+
+
+class AsyncAPNSTest(SimpleTestCase):
+
+    def setUp(self):
+        override = override_instapush(APNS_SETTINGS={
+            'APNS_CERTIFICATE': 'cert.pem', 'ERROR_TIMEOUT': 0.5})
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_bulk_send_reports_rejected_tokens(self):
+        gateway = FakeGateway(reject=[TOKENS[2]])
+
+        with patch_apns_async(gateway):
+            failed = asyncio.run(apns_send_bulk_message_async(TOKENS, "hi"))
+
+        self.assertEqual(failed, {TOKENS[2]: 8})
+        self.assertEqual([token for _, token in gateway.frames],
+                TOKENS[:2] + TOKENS[3:])
+
+    def test_rejected_token_given_as_bytes_raises(self):
+        gateway = FakeGateway(reject=[TOKENS[1]])
+
+        with patch_apns_async(gateway):
+            with self.assertRaises(APNSServerError) as raised:
+                asyncio.run(apns_send_message_async(unhexlify(TOKENS[1]),
+                    "hi"))
+
+        self.assertEqual(raised.exception.status, 8)
+
+
+class AsyncAPNSHTTP2ConnectionTest(SimpleTestCase):
+
+    def connect(self, gateway):
+        class GatewayConnection(AsyncAPNSHTTP2Connection):
+            async def _connect(self):
+                reader, self.writer = await asyncio.open_connection(
+                        sock=gateway.connect())
+                await self._handshake(reader)
+
+        connection = GatewayConnection(('localhost', 443), 'cert.pem')
+        return connection
+
+    def test_responses_of_cancelled_requests_are_ignored(self):
+        delays = dict((token, 0.1) for token in TOKENS)
+        delays[SLOW] = 0.3
+        gateway = FakeHTTP2Gateway(responses={TOKENS[3]: (400,
+            "BadDeviceToken")}, delays=delays)
+        connection = self.connect(gateway)
+
+        async def send():
+            await connection.connect()
+            slow = asyncio.ensure_future(connection.request(SLOW, b"{}", []))
+            others = [asyncio.ensure_future(connection.request(token, b"{}",
+                [])) for token in TOKENS]
+
+            ## the caller of the slow stream gives up while the others
+            ## are still in flight
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(slow, 0.05)
+            results = await asyncio.gather(*others)
+
+            ## its response arrives on a connection that goes on working
+            await asyncio.sleep(0.3)
+            alive = connection.is_alive()
+            gateway.delays.clear()
+            results.append(await connection.request(TOKENS[0], b"{}", []))
+            connection.close()
+            return alive, results
+
+        alive, results = asyncio.run(send())
+
+        self.assertTrue(alive)
+        self.assertEqual(results, [(200, None)] * 3 +
+                [(400, "BadDeviceToken"), (200, None), (200, None)])
+        self.assertEqual(gateway.connections, 1)
@@ -0,0 +1,79 @@
+import socket
+import struct
+import threading
+import time
+from contextlib import closing
+
+from django.test import TestCase
+
+from instapush.libs import apns
+from instapush.libs.apns import (
+    _apns_iter_feedback,
+    apns_deactivate_inactive_devices,
+)
+from instapush.models import APNSDevice
+
+from .utils import FakeSocket, mock
+
+
+TOKENS = ["%064x" % index for index in range(5)]
+
+
+def feedback(tokens, timestamp=1000):
+    return b"".join(struct.pack("!LH32s", timestamp, 32,
+        bytearray.fromhex(token)) for token in tokens)
+
+
+def serve(data, chunk_size, close=True):
+    """
+    Returns a socket the feedback data is written to in chunks of
+    chunk_size bytes, closing it afterwards unless close is False
+    """
+
+    sock, peer = socket.socketpair()
+
+    def write():
+        for offset in range(0, len(data), chunk_size):
+            peer.sendall(data[offset:offset + chunk_size])
+            time.sleep(0.001)
+        if close:
+            peer.close()
+
+    thread = threading.Thread(target=write)
+    thread.daemon = True
+    thread.start()
+    sock = FakeSocket(fileno=sock.detach())
+    sock.peer = peer
+    return sock
+
+
+class APNSFeedbackTest(TestCase):
+
+    def test_tuples_split_across_reads_are_reassembled(self):
+        with closing(serve(feedback(TOKENS), 7)) as sock:
+            tuples = list(_apns_iter_feedback(sock, 5))
+
+        self.assertEqual(tuples, [(1000, bytes(bytearray.fromhex(token)))
+            for token in TOKENS])
+
+    def test_iteration_stops_once_nothing_arrives(self):
+        sock = serve(feedback(TOKENS[:2]), 100, close=False)
+        with closing(sock), closing(sock.peer):
+            started = time.time()
+            tuples = list(_apns_iter_feedback(sock, 0.1))
+
+        self.assertEqual(len(tuples), 2)
+        self.assertLess(time.time() - started, 5)
+
+    def test_inactive_devices_are_deactivated(self):
+        for token in TOKENS:
+            APNSDevice.objects.create(registration_id=token)
+
+        sock = serve(feedback(TOKENS[1:3]), 13)
+        with mock.patch.object(apns, "_apns_create_socket_to_feedback",
+                return_value=sock):
+            count = apns_deactivate_inactive_devices(batch_size=1)
+
+        self.assertEqual(count, 2)
+        self.assertEqual(sorted(APNSDevice.objects.filter(active=False)
+            .values_list("registration_id", flat=True)), TOKENS[1:3])
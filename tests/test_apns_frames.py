@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import struct
+from binascii import unhexlify
+
+from django.test import SimpleTestCase
+
+from instapush.libs import apns
+from instapush.libs.apns import APNSFrameTemplate, apns_send_bulk_message
+
+from .utils import FakeGateway, mock, override_instapush, patch_apns
+
+
+TOKEN = "%064x" % 42
+
+
+def pack_frame(token, payload, identifier, expiration, priority):
+    ## a frame built item by item, as before frames were templated
+    frame_fmt = "!BIBH%dsBH%dsBHIBHIBHB" % (len(token), len(payload))
+    return struct.pack(frame_fmt,
+        2, 3 * 5 + len(token) + len(payload) + 4 + 4 + 1,
+        1, len(token), token,
+        2, len(payload), payload,
+        3, 4, identifier,
+        4, 4, expiration,
+        5, 1, priority)
+
+
+class APNSFrameTemplateTest(SimpleTestCase):
+
+    def test_pack_matches_a_frame_built_item_by_item(self):
+        payload = b'{"aps":{"alert":"hello"}}'
+        template = APNSFrameTemplate(payload, 1234, 5)
+
+        self.assertEqual(template.pack(unhexlify(TOKEN), 7),
+                pack_frame(unhexlify(TOKEN), payload, 7, 1234, 5))
+
+    def test_pack_payload_replaces_the_shared_payload(self):
+        payload = u'{"aps":{"alert":"héllo"}}'.encode("utf-8")
+        template = APNSFrameTemplate(b"", 1234, 10)
+
+        self.assertEqual(template.pack_payload(unhexlify(TOKEN), 7, payload),
+                pack_frame(unhexlify(TOKEN), payload, 7, 1234, 10))
+
+    def test_bulk_send_encodes_the_payload_once(self):
+        gateway = FakeGateway()
+        tokens = ["%064x" % index for index in range(100)]
+
+        with mock.patch.object(apns, "_apns_encode_payload",
+                wraps=apns._apns_encode_payload) as encode:
+            ## waiting for late errors lets the gateway read every frame
+            with patch_apns(gateway), override_instapush(
+                    APNS_SETTINGS={'ERROR_TIMEOUT': 0.2}):
+                failed = apns_send_bulk_message(tokens, "hello")
+
+        self.assertEqual(failed, {})
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(gateway.frames, list(enumerate(tokens)))
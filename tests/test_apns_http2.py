@@ -0,0 +1,127 @@
+import socket
+import ssl
+from contextlib import closing
+
+from django.test import SimpleTestCase
+
+from instapush.exceptions import APNSPushError
+from instapush.libs import apns, apns_http2
+from instapush.libs.apns_http2 import (
+    APNSHTTP2Connection,
+    APNSStreamMultiplexer,
+    UNKNOWN_STATUS,
+    _apns_http2_send_notifications,
+    apns_http2_send_bulk_message,
+)
+
+from .utils import FakeHTTP2Gateway, mock, override_instapush, patch_apns_http2
+
+
+TOKENS = ["%064x" % index for index in range(6)]
+
+
+class APNSStreamMultiplexerTest(SimpleTestCase):
+
+    def send(self, gateway, tokens=TOKENS, **settings):
+        with patch_apns_http2(gateway), override_instapush(
+                APNS_SETTINGS=settings):
+            return apns_http2_send_bulk_message(tokens, "hello")
+
+    def test_every_notification_is_sent_once(self):
+        gateway = FakeHTTP2Gateway()
+
+        self.assertEqual(self.send(gateway), {})
+        self.assertEqual(sorted(token for _, _, token in gateway.streams),
+                TOKENS)
+        self.assertEqual(gateway.connections, 1)
+
+    def test_rejected_notifications_are_reported(self):
+        gateway = FakeHTTP2Gateway(responses={
+            TOKENS[1]: (400, "BadDeviceToken"),
+            TOKENS[4]: (413, None),
+        })
+
+        self.assertEqual(self.send(gateway), {TOKENS[1]: 8, TOKENS[4]: 7})
+
+    def test_streams_are_capped_at_max_concurrent_streams(self):
+        gateway = FakeHTTP2Gateway()
+
+        self.assertEqual(self.send(gateway, MAX_CONCURRENT_STREAMS=2), {})
+        self.assertEqual(len(gateway.streams), len(TOKENS))
+
+    def test_goaway_resends_only_the_streams_it_did_not_process(self):
+        ## streams 1 to 11 are in flight, the server processed up to 5
+        gateway = FakeHTTP2Gateway(goaway=(len(TOKENS), 5))
+
+        failed = self.send(gateway)
+
+        self.assertEqual(failed, dict((token, UNKNOWN_STATUS)
+            for token in TOKENS[:3]))
+        self.assertEqual([token for connection, _, token in gateway.streams
+            if connection == 2], TOKENS[3:])
+
+    def test_unanswered_streams_expire(self):
+        gateway = FakeHTTP2Gateway(responses={TOKENS[2]: None})
+
+        with patch_apns_http2(gateway), override_instapush(
+                APNS_SETTINGS={'HTTP2_READ_TIMEOUT': 0.2}):
+            results = _apns_http2_send_notifications(
+                    (token, b"{}", []) for token in TOKENS)
+
+        self.assertEqual(results, {TOKENS[2]: UNKNOWN_STATUS})
+        self.assertEqual(gateway.connections, 1)
+
+    def test_throttled_notifications_are_resent_after_a_backoff(self):
+        gateway = FakeHTTP2Gateway(responses={
+            TOKENS[1]: [(429, "TooManyRequests"), (200, None)],
+            TOKENS[3]: [(503, "ServiceUnavailable")],
+        })
+
+        with mock.patch.object(APNSStreamMultiplexer, "RETRY_BACKOFF", 0.01):
+            failed = self.send(gateway)
+
+        ## 503 is reported as the binary shutdown status
+        self.assertEqual(failed, {TOKENS[3]: 10})
+        sent = [token for _, _, token in gateway.streams]
+        self.assertEqual(sent.count(TOKENS[1]), 2)
+        self.assertEqual(sent.count(TOKENS[3]),
+                APNSStreamMultiplexer.MAX_RETRIES + 1)
+
+
+class APNSHTTP2ConnectionTest(SimpleTestCase):
+
+    def test_handshake_times_out_on_a_silent_server(self):
+        sock, peer = socket.socketpair()
+        with closing(peer):
+            connection = APNSHTTP2Connection(("localhost", 443), "cert.pem",
+                    settings={"HTTP2_READ_TIMEOUT": 0.1})
+            connection.socket = sock
+
+            with self.assertRaises(APNSPushError):
+                connection._handshake()
+
+        self.assertIsNone(connection.socket)
+
+    def test_ssl_context_verifies_the_server(self):
+        with mock.patch.object(apns, "_apns_load_certificate"), \
+                mock.patch.object(ssl.SSLContext, "load_cert_chain"):
+            context = apns._apns_ssl_context("cert.pem")
+
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertTrue(context.check_hostname)
+
+    def test_idle_read_without_data_does_not_block(self):
+        gateway = FakeHTTP2Gateway()
+        with patch_apns_http2(gateway):
+            with apns_http2._apns_http2_connection() as connection:
+                timeouts = []
+
+                def recv(size):
+                    timeouts.append(connection.socket.gettimeout())
+                    raise ssl.SSLWantReadError()
+
+                with mock.patch.object(connection.socket, "recv", recv):
+                    self.assertTrue(connection._process_idle())
+
+        ## a session ticket leaves nothing to read, the read must not wait
+        self.assertEqual(timeouts, [0.0])
@@ -0,0 +1,122 @@
+import socket
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from instapush.libs.apns import APNSConnection, APNSConnectionPool
+
+from .utils import FakeSocket, override_instapush
+
+
+ADDRESS = ('localhost', 2195)
+
+
+class FakeConnection(APNSConnection):
+    """
+    An APNSConnection to the other end of a socket pair, playing the
+    gateway, instead of APNS
+    """
+
+    opened = 0
+
+    def connect(self):
+        FakeConnection.opened += 1
+        sock, self.peer = socket.socketpair()
+        self.socket = FakeSocket(fileno=sock.detach())
+        self.last_used = time.time()
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.peer.close()
+        self.socket = None
+
+
+class APNSConnectionPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        FakeConnection.opened = 0
+        self.pool = APNSConnectionPool(FakeConnection)
+
+    def tearDown(self):
+        self.pool.clear()
+
+    def test_released_connection_is_reused(self):
+        with self.pool.connection(ADDRESS, 'cert.pem') as first:
+            pass
+        with self.pool.connection(ADDRESS, 'cert.pem') as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(FakeConnection.opened, 1)
+
+    def test_connections_are_kept_per_certificate(self):
+        with self.pool.connection(ADDRESS, 'cert.pem') as first:
+            pass
+        with self.pool.connection(ADDRESS, 'other.pem') as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertEqual(second.key, ('localhost', 2195, 'other.pem'))
+
+    def test_connection_apns_wrote_to_is_replaced(self):
+        ## APNS only writes an error response right before closing
+        with self.pool.connection(ADDRESS, 'cert.pem') as first:
+            first.peer.sendall(b'\x08\x08\x00\x00\x00\x00')
+        with self.pool.connection(ADDRESS, 'cert.pem') as second:
+            pass
+
+        self.assertIsNot(first, second)
+        self.assertIsNone(first.socket)
+        self.assertEqual(FakeConnection.opened, 2)
+
+    def test_idle_connection_expires(self):
+        with override_instapush(APNS_SETTINGS={'CONNECTION_MAX_IDLE': 60}):
+            connection = FakeConnection(ADDRESS, 'cert.pem')
+            connection.connect()
+            connection.last_used -= 61
+            self.assertFalse(connection.is_alive())
+
+    def test_connection_is_closed_when_the_block_raises(self):
+        with self.assertRaises(ValueError):
+            with self.pool.connection(ADDRESS, 'cert.pem') as connection:
+                raise ValueError()
+
+        self.assertIsNone(connection.socket)
+        self.assertEqual(self.pool._idle, {})
+
+    def test_at_most_pool_size_connections_are_kept(self):
+        with override_instapush(APNS_SETTINGS={'POOL_SIZE': 1}):
+            first = self.pool.acquire(ADDRESS, 'cert.pem')
+            second = self.pool.acquire(ADDRESS, 'cert.pem')
+            self.pool.release(first)
+            self.pool.release(second)
+
+        self.assertEqual(self.pool._idle[first.key], [first])
+        self.assertIsNone(second.socket)
+
+    def test_max_connections_blocks_further_checkouts(self):
+        checked_out = []
+
+        def send():
+            with self.pool.connection(ADDRESS, 'cert.pem') as connection:
+                checked_out.append(connection)
+
+        with override_instapush(APNS_SETTINGS={'MAX_CONNECTIONS': 1}):
+            with self.pool.connection(ADDRESS, 'cert.pem'):
+                thread = threading.Thread(target=send)
+                thread.start()
+                thread.join(0.2)
+                self.assertEqual(checked_out, [])
+            thread.join(5)
+
+        self.assertEqual(len(checked_out), 1)
+
+    def test_clear_closes_idle_connections(self):
+        with self.pool.connection(ADDRESS, 'cert.pem') as connection:
+            pass
+        self.pool.clear()
+
+        self.assertIsNone(connection.socket)
+        self.assertEqual(self.pool._idle, {})
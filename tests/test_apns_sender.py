@@ -0,0 +1,111 @@
+from django.test import SimpleTestCase
+
+from instapush.libs.apns import APNSBulkSender, _apns_frame_template
+from instapush.metrics import get_metrics
+
+from .utils import FakeAPNSConnection, FakeGateway
+
+
+TOKENS = ["%064x" % index for index in range(10)]
+
+
+class APNSBulkSenderTest(SimpleTestCase):
+
+    def setUp(self):
+        get_metrics().reset()
+
+    def send(self, gateway, tokens=TOKENS, **kwargs):
+        connection = FakeAPNSConnection(gateway)
+        connection.connect()
+        template = _apns_frame_template(b'{"aps":{}}')
+        sender = APNSBulkSender(connection, **kwargs)
+        try:
+            for identifier, token in enumerate(tokens):
+                sender.send(identifier, token, template.pack(
+                    bytearray.fromhex(token), identifier))
+            return sender.finish(0.5)
+        finally:
+            connection.close()
+
+    def test_every_frame_is_written_once(self):
+        gateway = FakeGateway()
+
+        self.assertEqual(self.send(gateway), {})
+        self.assertEqual(gateway.frames, list(enumerate(TOKENS)))
+        self.assertEqual(gateway.connections, 1)
+
+    def test_frames_after_a_rejected_one_are_resent(self):
+        gateway = FakeGateway(reject=[TOKENS[3], TOKENS[7]])
+
+        self.assertEqual(self.send(gateway), {TOKENS[3]: 8, TOKENS[7]: 8})
+        self.assertEqual(gateway.frames, [(index, token) for index, token
+            in enumerate(TOKENS) if index not in (3, 7)])
+        self.assertEqual(gateway.connections, 3)
+        self.assertEqual(get_metrics().counters["apns.resent"], 6 + 2)
+
+    def test_shutdown_resends_the_frames_it_did_not_accept(self):
+        gateway = FakeGateway(shutdown_after=4)
+
+        self.assertEqual(self.send(gateway), {})
+        self.assertEqual(gateway.frames, list(enumerate(TOKENS)))
+        self.assertEqual(get_metrics().counters["apns.throttled"], 1)
+
+    def test_frames_no_longer_buffered_are_counted_as_lost(self):
+        gateway = FakeGateway(reject=[TOKENS[2]], latency=0.2)
+
+        failed = self.send(gateway, write_size=1, buffer_size=2)
+
+        ## the rejected frame left the buffer before its error was read
+        self.assertEqual(failed, {})
+        self.assertEqual(get_metrics().counters["apns.lost"], 5)
+        self.assertEqual(gateway.frames[-2:], [(8, TOKENS[8]), (9, TOKENS[9])])
+
+    def test_frames_are_settled_once_written_and_out_of_the_buffer(self):
+        settled = []
+
+        self.send(FakeGateway(), write_size=1, buffer_size=3,
+                settled=settled.extend)
+
+        ## the last three frames are still buffered when the send ends
+        self.assertEqual(settled, TOKENS[:-3])
+
+
+class APNSRewindTest(SimpleTestCase):
+
+    def setUp(self):
+        get_metrics().reset()
+        self.connection = FakeAPNSConnection(FakeGateway())
+        self.connection.connect()
+        self.template = _apns_frame_template(b'{"aps":{}}')
+
+    def tearDown(self):
+        self.connection.close()
+
+    def send(self, sender, identifiers):
+        for identifier in identifiers:
+            sender.send(identifier, TOKENS[identifier], self.template.pack(
+                bytearray.fromhex(TOKENS[identifier]), identifier))
+
+    def test_frames_not_written_yet_are_kept(self):
+        sender = APNSBulkSender(self.connection, write_size=1, buffer_size=3)
+        self.send(sender, range(5))
+        sender.write_size = 10 ** 6
+        ## only 7, 8 and 9 are still buffered, none of 5 to 9 was written
+        self.send(sender, range(5, 10))
+
+        sender._rewind(8, 2)
+
+        self.assertEqual([entry[0] for entry in sender._pending],
+                list(range(5, 10)))
+        self.assertEqual(get_metrics().counters["apns.resent"], 0)
+        self.assertEqual(get_metrics().counters["apns.lost"], 2)
+
+    def test_lost_frames_are_counted_from_the_written_ones(self):
+        sender = APNSBulkSender(self.connection, write_size=1, buffer_size=2)
+        ## 2 was an invalid token, so its identifier was never written
+        self.send(sender, [0, 1, 3, 4, 5])
+
+        sender._rewind(8, 1)
+
+        self.assertEqual([entry[0] for entry in sender._pending], [4, 5])
+        self.assertEqual(get_metrics().counters["apns.lost"], 1)
@@ -0,0 +1,41 @@
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from instapush.models import APNSDevice
+
+
+TOKEN = "%064x" % 0xabc
+DESCRIPTION = "<%s>" % " ".join(TOKEN.upper()[index:index + 8]
+        for index in range(0, 64, 8))
+
+
+class APNSTokenFieldTest(TestCase):
+
+    def test_token_is_stored_normalized(self):
+        device = APNSDevice.objects.create(registration_id=DESCRIPTION)
+
+        self.assertEqual(device.registration_id, TOKEN)
+        self.assertEqual(APNSDevice.objects.values_list("registration_id",
+            flat=True).get(), TOKEN)
+
+    def test_invalid_token_is_refused(self):
+        with self.assertRaises(ValidationError):
+            APNSDevice.objects.create(registration_id="not a token")
+        with self.assertRaises(ValidationError):
+            APNSDevice(registration_id=TOKEN[:-2]).full_clean()
+
+    def test_lookups_are_normalized(self):
+        device = APNSDevice.objects.create(registration_id=TOKEN)
+
+        self.assertEqual(APNSDevice.objects.get(registration_id=DESCRIPTION),
+                device)
+        with self.assertRaises(ValidationError):
+            APNSDevice.objects.filter(registration_id="bad").exists()
+
+    def test_invalid_tokens_are_left_out_of_id_lookups(self):
+        device = APNSDevice.objects.create(registration_id=TOKEN)
+
+        devices = APNSDevice.objects.with_registration_ids(["bad", None,
+            DESCRIPTION])
+
+        self.assertEqual(list(devices), [device])
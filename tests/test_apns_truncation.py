@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.test import SimpleTestCase
+
+from instapush.libs.apns import (APNSDataOverflow, _apns_build_payload,
+        _truncate_escaped, apns_fit_payload)
+from instapush.metrics import get_metrics
+
+from .utils import override_instapush
+
+
+class APNSTruncationTest(SimpleTestCase):
+
+    def setUp(self):
+        get_metrics().reset()
+
+    def fit(self, alert, max_size=100, **kwargs):
+        with override_instapush(APNS_SETTINGS={'MAX_SIZE': max_size}):
+            return apns_fit_payload(alert, **kwargs)
+
+    def test_payload_that_fits_is_left_alone(self):
+        payload, cut = self.fit("Hi")
+
+        self.assertEqual(cut, 0)
+        self.assertEqual(json.loads(payload.decode("utf-8"))["aps"]["alert"], "Hi")
+
+    def test_ascii_alert_is_cut_to_fit_exactly(self):
+        payload, cut = self.fit("x" * 200)
+        alert = json.loads(payload.decode("utf-8"))["aps"]["alert"]
+
+        self.assertEqual(len(payload), 100)
+        self.assertEqual(alert, "x" * (200 - cut) + u"…")
+
+    def test_escaped_and_multibyte_characters_are_counted_encoded(self):
+        for max_size in range(80, 140):
+            payload, cut = self.fit(u"é\"😀\\x" * 40, max_size)
+            alert = json.loads(payload.decode("utf-8"))["aps"]["alert"]
+
+            self.assertLessEqual(len(payload), max_size)
+            ## one more character, the largest escaped one, does not fit
+            self.assertGreater(len(payload) + 12, max_size)
+            self.assertTrue((u"é\"😀\\x" * 40).startswith(alert[:-1]))
+            self.assertEqual(len(alert) - 1, 40 * 5 - cut)
+
+    def test_body_of_a_localized_alert_is_truncated(self):
+        payload, cut = self.fit("y" * 200, 150, loc_key="GREETING")
+        alert = json.loads(payload.decode("utf-8"))["aps"]["alert"]
+
+        self.assertEqual(alert["loc-key"], "GREETING")
+        self.assertTrue(alert["body"].endswith(u"…"))
+        self.assertEqual(len(payload), 150)
+
+    def test_payload_too_large_without_its_alert_overflows(self):
+        with self.assertRaises(APNSDataOverflow):
+            self.fit("Hi", extra={"blob": "z" * 200})
+
+    def test_build_payload_truncates_only_when_asked(self):
+        with override_instapush(APNS_SETTINGS={'MAX_SIZE': 100}):
+            with self.assertRaises(APNSDataOverflow):
+                _apns_build_payload("x" * 200, truncate=False)
+            self.assertEqual(len(_apns_build_payload("x" * 200, truncate=True)), 100)
+            self.assertEqual(get_metrics().counters["apns.truncated"], 1)
+
+    def test_settings_of_the_app_are_used(self):
+        with override_instapush(APPS={'small': {'APNS_SETTINGS': {
+                'MAX_SIZE': 100, 'TRUNCATE_ALERT': True}}}):
+            self.assertEqual(len(_apns_build_payload("x" * 200,
+                app_id='small')), 100)
+            self.assertEqual(len(apns_fit_payload("x" * 200,
+                app_id='small')[0]), 100)
+            with self.assertRaises(APNSDataOverflow):
+                _apns_build_payload("x" * 3000)
+
+    def test_surrogate_pairs_are_not_split(self):
+        text, cut = _truncate_escaped(u"😀" * 3, 6 + 12 + 6)
+
+        self.assertEqual(text, u"😀…")
+        self.assertEqual(cut, len(u"😀" * 3) - len(u"😀"))
@@ -0,0 +1,43 @@
+from django.test import SimpleTestCase
+
+from benchmarks.servers import FakeGCMServer, Throttle, is_rejected
+from instapush.libs.gcm import gcm_send_bulk_message
+
+from .utils import override_instapush
+
+
+IDS = ["id%d" % index for index in range(50)]
+
+
+class FakeGCMServerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = FakeGCMServer(error_rate=0.2)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_bulk_send_through_the_fake_server(self):
+        rejected = [id_ for id_ in IDS if is_rejected(id_, 0.2)]
+
+        with override_instapush(GCM_SETTINGS={'MAX_RECIPIENTS': 20,
+                'API_URL': 'http://127.0.0.1:%d/send' % self.server.port}):
+            result = gcm_send_bulk_message(IDS, {"message": "hi"})
+
+        self.assertTrue(rejected)
+        self.assertEqual(sorted(result.unregistered), sorted(rejected))
+        self.assertEqual(result.success, len(IDS) - len(rejected))
+        self.assertEqual(self.server.stats.counters,
+                {"requests": 3, "messages": 50})
+
+
+class ThrottleTest(SimpleTestCase):
+
+    def test_admits_at_most_rate_messages(self):
+        throttle = Throttle(10)
+
+        self.assertTrue(throttle.admit(8))
+        self.assertFalse(throttle.admit(8))
+        self.assertTrue(Throttle().admit(10 ** 6))
@@ -0,0 +1,76 @@
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from requests import HTTPError
+
+from instapush.broadcast import broadcast
+from instapush.models import APNSDevice, GCMDevice
+
+from .utils import (FakeGCM, FakeGateway, FakeResponse, override_instapush,
+        patch_apns)
+
+
+TOKENS = ["%064x" % index for index in range(4)]
+
+
+class BroadcastTest(TransactionTestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create(username="owner")
+        other = User.objects.create(username="other")
+        for index in range(3):
+            GCMDevice.objects.create(registration_id="id%d" % index,
+                    owner=self.owner)
+        GCMDevice.objects.create(registration_id="id3", owner=other)
+        GCMDevice.objects.create(registration_id="id4", owner=self.owner,
+                active=False)
+        for token in TOKENS[:2]:
+            APNSDevice.objects.create(registration_id=token, owner=self.owner)
+        APNSDevice.objects.create(registration_id=TOKENS[2], owner=other)
+
+    def broadcast(self, gcm, gateway, **kwargs):
+        with gcm.patch(), patch_apns(gateway), override_instapush(
+                APNS_SETTINGS={'APNS_CERTIFICATE': 'cert.pem',
+                    'ERROR_TIMEOUT': 0.2},
+                GCM_SETTINGS={'MAX_RETRIES': 0}):
+            return broadcast("hi", owner=self.owner, **kwargs)
+
+    def test_active_devices_of_both_platforms_matching_the_filter(self):
+        gcm, gateway = FakeGCM(), FakeGateway()
+
+        result = self.broadcast(gcm, gateway, extra={"kind": "news"})
+
+        self.assertEqual((result["gcm"].devices, result["apns"].devices), (3, 2))
+        self.assertEqual((result.success, result.failure), (5, 0))
+        self.assertEqual(gcm.requests[0][1]["registration_ids"],
+                ["id0", "id1", "id2"])
+        self.assertEqual(gcm.requests[0][1]["data"],
+                {"message": "hi", "kind": "news"})
+        self.assertEqual([token for _, token in gateway.frames], TOKENS[:2])
+
+    def test_failing_platform_does_not_stop_the_other(self):
+        gcm = FakeGCM(lambda url, values: FakeResponse(401, b""))
+        gateway = FakeGateway(reject=[TOKENS[1]])
+
+        result = self.broadcast(gcm, gateway)
+
+        self.assertIsInstance(result.errors["gcm"], HTTPError)
+        self.assertEqual(list(result.errors), ["gcm"])
+        self.assertEqual(result["apns"].failed, {TOKENS[1]: 8})
+        self.assertEqual(result["apns"].success, 1)
+
+    def test_only_the_given_platforms_are_sent(self):
+        gcm, gateway = FakeGCM(), FakeGateway()
+
+        result = self.broadcast(gcm, gateway, platforms=("apns",))
+
+        self.assertEqual(list(result), ["apns"])
+        self.assertEqual(gcm.requests, [])
+
+    def test_ids_gcm_kept_failing_for_are_reported_unavailable(self):
+        gcm = FakeGCM(lambda url, values: FakeResponse(500, b""))
+
+        result = self.broadcast(gcm, FakeGateway())
+
+        self.assertEqual(result.errors, {})
+        self.assertEqual(result["gcm"].failed, dict(("id%d" % index,
+            "Unavailable") for index in range(3)))
@@ -0,0 +1,108 @@
+from django.test import TestCase
+
+from instapush import campaigns
+from instapush.models.base import GCMDevice
+from instapush.models.campaign import CampaignShard
+from instapush.models.queue import PushJob
+
+from .utils import mock, override_instapush
+
+
+class FakeSender(object):
+    """
+    Records the pages of registration ids sent, raising on the page
+    whose index is fail_on
+    """
+
+    def __init__(self, fail_on=None, on_send=None):
+        self.pages = []
+        self.fail_on = fail_on
+        self.on_send = on_send
+
+    def __call__(self, ids, message, extra, app_id, options):
+        if len(self.pages) == self.fail_on:
+            raise IOError("connection lost")
+        self.pages.append(list(ids))
+        if self.on_send is not None:
+            self.on_send()
+        return {}
+
+    @property
+    def ids(self):
+        return [registration_id for page in self.pages
+                for registration_id in page]
+
+
+@override_instapush(GCM_SETTINGS={'MAX_RECIPIENTS': 2})
+class CampaignTest(TestCase):
+    def setUp(self):
+        self.ids = ['r%d' % index for index in range(10)]
+        for registration_id in self.ids:
+            GCMDevice.objects.create(registration_id=registration_id)
+        GCMDevice.objects.create(registration_id='inactive', active=False)
+
+    def start(self, shards=3):
+        return campaigns.start_campaign("hello", platforms=('gcm',),
+                shards=shards)
+
+    def send(self, sender, shard, **kwargs):
+        with mock.patch.dict(campaigns.SENDERS, {'gcm': sender}):
+            campaigns.send_shard(shard.pk, **kwargs)
+
+    def test_start_campaign_queues_a_job_per_shard(self):
+        campaign = self.start()
+        shards = list(campaign.shards.all())
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(PushJob.objects.filter(
+            task='campaign_send_shard').count(), 3)
+
+    def test_shards_send_every_active_device_once(self):
+        campaign = self.start()
+        sender = FakeSender()
+        for shard in campaign.shards.all():
+            self.send(sender, shard)
+
+        self.assertEqual(sorted(sender.ids), sorted(self.ids))
+        progress = campaigns.campaign_progress(campaign)
+        self.assertEqual((progress['done'], progress['sent']), (3, 10))
+        campaign.refresh_from_db()
+        self.assertIsNotNone(campaign.finished)
+
+    def test_resumes_from_checkpoint_after_a_crash(self):
+        shard = self.start(shards=1).shards.get()
+        crashing = FakeSender(fail_on=2)
+        self.assertRaises(IOError, self.send, crashing, shard)
+
+        shard.refresh_from_db()
+        self.assertEqual(shard.sent, 4)
+        self.assertFalse(shard.done)
+
+        resumed = FakeSender()
+        self.send(resumed, shard)
+        self.assertEqual(crashing.ids + resumed.ids, self.ids)
+        shard.refresh_from_db()
+        self.assertTrue(shard.done)
+
+    def test_time_limit_queues_the_shard_again(self):
+        shard = self.start(shards=1).shards.get()
+        jobs = PushJob.objects.count()
+        sender = FakeSender()
+        self.send(sender, shard, time_limit=0)
+
+        self.assertEqual(len(sender.pages), 1)
+        self.assertEqual(PushJob.objects.count(), jobs + 1)
+        shard.refresh_from_db()
+        self.assertFalse(shard.done)
+
+    def test_worker_that_lost_the_shard_stops(self):
+        shard = self.start(shards=1).shards.get()
+
+        def advance():
+            ## another worker checkpoints the shard meanwhile
+            CampaignShard.objects.filter(pk=shard.pk).update(checkpoint='x')
+
+        sender = FakeSender(on_send=advance)
+        self.send(sender, shard)
+        self.assertEqual(len(sender.pages), 1)
+        shard.refresh_from_db()
+        self.assertEqual(shard.checkpoint, 'x')
@@ -0,0 +1,52 @@
+from django.test import SimpleTestCase
+
+from instapush.credentials import CredentialRegistry
+from instapush.ratelimit import get_rate_limiter
+
+from .test_apns_pool import ADDRESS, FakeConnection
+
+
+class CredentialRegistryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.registry = CredentialRegistry(max_size=1)
+        self.registry.register('small', apns_settings={
+            'POOL_SIZE': 1, 'ERROR_TIMEOUT': 0.1, 'RATE_LIMIT': 100})
+        self.registry.register('other')
+
+    def tearDown(self):
+        self.registry.clear()
+
+    def test_rate_limit_of_the_app_is_used(self):
+        app = self.registry.get('small')
+
+        self.assertIsNone(get_rate_limiter('APNS_SETTINGS', 'small.pem'))
+        limiter = get_rate_limiter('APNS_SETTINGS', 'small.pem',
+                app.apns_settings)
+        self.assertEqual(limiter.rate, 100)
+
+    def test_pool_is_sized_by_the_settings_of_the_app(self):
+        pool = self.registry.get('small').apns_pool(FakeConnection)
+        first = pool.acquire(ADDRESS, 'cert.pem')
+        second = pool.acquire(ADDRESS, 'cert.pem')
+        pool.release(first)
+        pool.release(second)
+
+        self.assertEqual(first.settings['ERROR_TIMEOUT'], 0.1)
+        self.assertEqual(pool._idle[first.key], [first])
+        self.assertIsNone(second.socket)
+
+    def test_evicted_app_closes_connections_once_released(self):
+        pool = self.registry.get('small').apns_pool(FakeConnection)
+        idle = pool.acquire(ADDRESS, 'cert.pem')
+        pool.release(idle)
+        connection = pool.acquire(ADDRESS, 'other.pem')
+
+        ## the least recently used app is evicted
+        self.registry.get('other')
+
+        self.assertIsNone(idle.socket)
+        self.assertIsNotNone(connection.socket)
+        pool.release(connection)
+        self.assertIsNone(connection.socket)
+        self.assertFalse(pool._idle[connection.key])
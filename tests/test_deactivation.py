@@ -0,0 +1,100 @@
+import time
+
+from django.apps import apps
+from django.test import TestCase, TransactionTestCase
+
+from instapush.deactivation import DeactivationBuffer, gcm_deactivator
+from instapush.libs.gcm import gcm_send_bulk_message
+from instapush.models import GCMDevice
+
+from .utils import FakeGCM, mock, override_instapush
+
+
+class DeactivationBufferTest(TestCase):
+
+    def setUp(self):
+        ## drops the ids other tests' sends left buffered
+        gcm_deactivator.flush()
+        for index in range(5):
+            GCMDevice.objects.create(registration_id="id%d" % index)
+
+    def inactive(self):
+        return sorted(GCMDevice.objects.filter(active=False)
+                .values_list("registration_id", flat=True))
+
+    def test_full_batches_are_deactivated_one_update_per_batch(self):
+        buffer = DeactivationBuffer(GCMDevice, batch_size=3, flush_interval=0)
+
+        buffer.add(["id0", "id1"])
+        self.assertEqual(self.inactive(), [])
+        with self.assertNumQueries(2):
+            buffer.add(["id1", "id2", "id3"])
+
+        self.assertEqual(self.inactive(), ["id0", "id1", "id2", "id3"])
+
+    def test_repeated_ids_are_buffered_once(self):
+        buffer = DeactivationBuffer(GCMDevice, batch_size=10, flush_interval=0)
+
+        buffer.add(["id0", "id1", "id0"])
+        buffer.add(["id1"])
+
+        self.assertEqual(buffer.flush(), 2)
+
+    def test_model_defaults_to_the_device_model_setting(self):
+        buffer = DeactivationBuffer(provider='GCM_SETTINGS', flush_interval=0)
+
+        with override_instapush(GCM_SETTINGS={
+                'DEVICE_MODEL': 'instapush.models.base.GCMDevice'}):
+            buffer.add(["id4"])
+            self.assertEqual(buffer.flush(), 1)
+
+        self.assertEqual(self.inactive(), ["id4"])
+
+    def test_model_defaults_to_the_sql_model(self):
+        buffer = DeactivationBuffer(provider='GCM_SETTINGS', flush_interval=0)
+
+        buffer.add(["id4"])
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(self.inactive(), ["id4"])
+
+    def test_ids_are_kept_without_a_model(self):
+        buffer = DeactivationBuffer(provider='GCM_SETTINGS', flush_interval=0)
+        buffer.add(["id4"])
+
+        with mock.patch.object(apps, "is_installed", return_value=False):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(self.inactive(), [])
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(self.inactive(), ["id4"])
+
+    def test_unregistered_ids_of_a_send_are_deactivated(self):
+        def respond(url, values):
+            return {"multicast_id": 1, "success": 1, "failure": 2,
+                    "canonical_ids": 0, "results": [
+                        {"error": "NotRegistered"}, {"message_id": "1"},
+                        {"error": "InvalidRegistration"}]}
+
+        with FakeGCM(respond).patch(), override_instapush(GCM_SETTINGS={
+                'DEVICE_MODEL': 'instapush.models.base.GCMDevice'}):
+            gcm_send_bulk_message(["id0", "id1", "id2"], {"message": "hi"})
+            gcm_deactivator.flush()
+
+        self.assertEqual(self.inactive(), ["id0", "id2"])
+
+
+class DeactivationIntervalTest(TransactionTestCase):
+
+    def test_partial_batches_are_flushed_after_the_interval(self):
+        GCMDevice.objects.create(registration_id="id0")
+        buffer = DeactivationBuffer(GCMDevice, batch_size=10,
+                flush_interval=0.05)
+
+        buffer.add(["id0"])
+        deadline = time.time() + 5
+        while GCMDevice.objects.filter(active=True).exists() and \
+                time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertFalse(GCMDevice.objects.filter(active=True).exists())
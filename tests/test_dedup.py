@@ -0,0 +1,133 @@
+from binascii import unhexlify
+
+from django.test import SimpleTestCase
+from requests import HTTPError
+
+from instapush.dedup import Deduplicator, LocalBackend
+from instapush.libs.apns import apns_send_bulk_message
+from instapush.libs.gcm import gcm_send_bulk_message, gcm_send_chunked_message
+
+from .utils import (FakeGCM, FakeGateway, FakeResponse, override_instapush,
+        patch_apns)
+
+
+TOKEN = "%064x" % 7
+
+
+class DeduplicatorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.backend = LocalBackend()
+
+    def deduplicator(self, provider='GCM_SETTINGS'):
+        return Deduplicator(provider, "note", 60, self.backend)
+
+    def test_ids_sent_or_repeated_are_dropped(self):
+        with self.deduplicator() as deduplicator:
+            self.assertEqual(deduplicator.filter(["a", "b", "a"]), ["a", "b"])
+        with self.deduplicator() as deduplicator:
+            self.assertEqual(deduplicator.filter(["b", "c"]), ["c"])
+
+        self.assertEqual(deduplicator.duplicates, 1)
+
+    def test_ids_key_the_same_in_any_form(self):
+        gcm = self.deduplicator()
+        apns = self.deduplicator('APNS_SETTINGS')
+
+        self.assertEqual(gcm._key(b"abc"), gcm._key(u"abc"))
+        self.assertEqual(gcm._key(b"\xff"), gcm._key(u"ff"))
+        self.assertEqual(apns._key(unhexlify(TOKEN)), apns._key(TOKEN.upper()))
+
+    def test_keys_are_held_until_their_ids_are_sent(self):
+        with self.deduplicator() as deduplicator:
+            kept = list(deduplicator.iter_filter(["id%d" % index
+                for index in range(7)], batch_size=2))
+            self.assertEqual(len(deduplicator._pending), 7)
+
+            deduplicator.sent(kept[:5])
+            self.assertEqual(len(deduplicator._pending), 2)
+
+    def test_failed_ids_are_forgotten(self):
+        with self.deduplicator() as deduplicator:
+            deduplicator.sent(deduplicator.filter(["a", "b"]))
+            deduplicator.forget(["b"])
+
+        with self.deduplicator() as deduplicator:
+            self.assertEqual(deduplicator.filter(["a", "b"]), ["b"])
+
+    def test_only_unsent_chunks_are_forgotten_when_the_send_raises(self):
+        with self.assertRaises(ValueError):
+            with self.deduplicator() as deduplicator:
+                first = deduplicator.filter(["a", "b"])
+                deduplicator.sent(first)
+                deduplicator.filter(["c"])
+                raise ValueError()
+
+        with self.deduplicator() as deduplicator:
+            self.assertEqual(deduplicator.filter(["a", "b", "c"]), ["c"])
+
+
+class GCMDeduplicationTest(SimpleTestCase):
+
+    def test_deduplicated_bulk_send_returns_an_empty_response(self):
+        with FakeGCM().patch(), override_instapush(GCM_SETTINGS={
+                'DEDUP_TTL': 60}):
+            first = gcm_send_bulk_message(["id0", "id1"], {"message": "hi"})
+            second = gcm_send_bulk_message(["id1", "id0"], {"message": "hi"})
+
+        self.assertEqual(first["success"], 2)
+        self.assertEqual(second, {"multicast_id": None, "success": 0,
+            "failure": 0, "canonical_ids": 0, "results": []})
+
+    def test_bulk_retry_resends_only_the_chunks_that_failed(self):
+        gcm = FakeGCM(lambda url, values: FakeResponse(401, b"")
+                if "id2" in values["registration_ids"]
+                else FakeGCM.accept(url, values))
+        ids = ["id0", "id1", "id2", "id3"]
+        with gcm.patch(), override_instapush(GCM_SETTINGS={'DEDUP_TTL': 60,
+                'MAX_RETRIES': 0, 'MAX_RECIPIENTS': 2}):
+            with self.assertRaises(HTTPError):
+                gcm_send_bulk_message(ids, {"message": "hi"}, concurrency=1)
+            with self.assertRaises(HTTPError):
+                gcm_send_bulk_message(ids, {"message": "hi"}, concurrency=1)
+
+        self.assertEqual([values["registration_ids"] for _, values
+            in gcm.requests], [["id0", "id1"], ["id2", "id3"], ["id2", "id3"]])
+
+    def test_retry_resends_only_the_chunks_that_failed(self):
+        ## the second chunk fails the first time it is sent
+        failures = [FakeResponse(500, b"")]
+
+        def respond(url, values):
+            if "id2" in values["registration_ids"] and failures:
+                return failures.pop()
+            return FakeGCM.accept(url, values)
+
+        gcm = FakeGCM(respond)
+        chunks = [["id0", "id1"], ["id2", "id3"]]
+        with gcm.patch(), override_instapush(GCM_SETTINGS={'DEDUP_TTL': 60,
+                'MAX_RETRIES': 0}):
+            first = gcm_send_chunked_message(chunks, {"message": "hi"},
+                    concurrency=1)
+            result = gcm_send_chunked_message(chunks, {"message": "hi"},
+                    concurrency=1)
+
+        self.assertEqual(first.failed, {"id2": "Unavailable",
+            "id3": "Unavailable"})
+        self.assertEqual(result.success, 2)
+        self.assertEqual(gcm.requests[-1][1]["registration_ids"], ["id2", "id3"])
+
+
+class APNSDeduplicationTest(SimpleTestCase):
+
+    def test_rejected_tokens_are_not_deduplicated(self):
+        gateway = FakeGateway(reject=[TOKEN])
+        tokens = [TOKEN, "%064x" % 8]
+
+        with patch_apns(gateway), override_instapush(APNS_SETTINGS={
+                'APNS_CERTIFICATE': 'cert.pem', 'ERROR_TIMEOUT': 0.2,
+                'DEDUP_TTL': 60}):
+            self.assertEqual(apns_send_bulk_message(tokens, "hi"), {TOKEN: 8})
+            self.assertEqual(apns_send_bulk_message(tokens, "hi"), {TOKEN: 8})
+
+        self.assertEqual(gateway.frames, [(1, tokens[1])])
@@ -0,0 +1,75 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from instapush.libs.gcm import gcm_send_bulk_message, gcm_send_chunked_message
+
+from .utils import FakeGCM, override_instapush
+
+
+IDS = ["id%d" % index for index in range(10)]
+
+
+class GCMConcurrentChunksTest(SimpleTestCase):
+
+    def test_results_keep_chunk_order(self):
+        answered = []
+
+        def respond(url, values):
+            ids = values["registration_ids"]
+            ## later chunks are answered first
+            time.sleep(0.05 / (int(ids[0][2:]) + 1))
+            answered.append(ids[0])
+            return {"multicast_id": 1, "success": len(ids), "failure": 0,
+                    "canonical_ids": 0, "results": [{"message_id": id_}
+                        for id_ in ids]}
+
+        with FakeGCM(respond).patch(), override_instapush(
+                GCM_SETTINGS={'MAX_RECIPIENTS': 2}):
+            result = gcm_send_bulk_message(IDS, {"message": "hi"},
+                    concurrency=4)
+
+        self.assertEqual(len(result), 5)
+        self.assertEqual(result.success, 10)
+        self.assertEqual([item["message_id"] for item in result.results], IDS)
+        self.assertNotEqual(answered, IDS[::2])
+
+    def test_failed_ids_are_aggregated_across_chunks(self):
+        def respond(url, values):
+            ids = values["registration_ids"]
+            return {"multicast_id": 1, "success": 0, "failure": len(ids),
+                    "canonical_ids": 0, "results": [{"error": "NotRegistered"}
+                        for _ in ids]} if "id3" in ids else \
+                    FakeGCM.accept(url, values)
+
+        with FakeGCM(respond).patch(), override_instapush(
+                GCM_SETTINGS={'MAX_RECIPIENTS': 2}):
+            result = gcm_send_bulk_message(IDS, {"message": "hi"},
+                    concurrency=3)
+
+        self.assertEqual(result.failed, {"id2": "NotRegistered",
+            "id3": "NotRegistered"})
+        self.assertEqual(result.unregistered, ["id2", "id3"])
+        self.assertEqual((result.success, result.failure), (8, 2))
+
+    def test_at_most_concurrency_chunks_are_in_flight(self):
+        lock = threading.Lock()
+        state = {"in_flight": 0, "peak": 0}
+
+        def respond(url, values):
+            with lock:
+                state["in_flight"] += 1
+                state["peak"] = max(state["peak"], state["in_flight"])
+            time.sleep(0.02)
+            with lock:
+                state["in_flight"] -= 1
+            return FakeGCM.accept(url, values)
+
+        chunks = ([id_] for id_ in IDS)
+        with FakeGCM(respond).patch():
+            result = gcm_send_chunked_message(chunks, {"message": "hi"},
+                    concurrency=3)
+
+        self.assertEqual(len(result), 10)
+        self.assertEqual(state["peak"], 3)
@@ -0,0 +1,90 @@
+from django.test import SimpleTestCase
+
+from instapush.exceptions import GCMServerError
+from instapush.libs.gcm import GCMMessenger, gcm_send_bulk_message
+
+from .utils import FakeGCM, FakeResponse, mock, override_instapush
+
+
+def results(ids, errors):
+    items = [{"error": errors[id_]} if id_ in errors else {"message_id": id_}
+            for id_ in ids]
+    failure = len([item for item in items if "error" in item])
+    return {"multicast_id": 1, "success": len(ids) - failure,
+            "failure": failure, "canonical_ids": 0, "results": items}
+
+
+class GCMRetryTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("instapush.libs.gcm.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_unavailable_ids_are_resent(self):
+        attempts = []
+
+        def respond(url, values):
+            ids = values["registration_ids"]
+            attempts.append(ids)
+            if len(attempts) == 1:
+                return results(ids, {"b": "Unavailable",
+                    "c": "InternalServerError"})
+            return results(ids, {})
+
+        with FakeGCM(respond).patch():
+            result = gcm_send_bulk_message(["a", "b", "c"], {"message": "hi"})
+
+        self.assertEqual(attempts, [["a", "b", "c"], ["b", "c"]])
+        self.assertEqual((result["success"], result["failure"]), (3, 0))
+        self.assertEqual([item["message_id"] for item in result["results"]],
+                ["a", "b", "c"])
+
+    def test_server_errors_are_retried_after_retry_after(self):
+        responses = [FakeResponse(503, b"", {"Retry-After": "7"}),
+                results(["a"], {})]
+
+        with FakeGCM(lambda url, values: responses.pop(0)).patch():
+            result = gcm_send_bulk_message(["a"], {"message": "hi"})
+
+        self.assertEqual(result["success"], 1)
+        self.assertGreaterEqual(self.sleep.call_args[0][0], 7)
+
+    def test_retries_stop_after_max_retries(self):
+        session = FakeGCM(lambda url, values: FakeResponse(500, b""))
+
+        with session.patch(), override_instapush(GCM_SETTINGS={'MAX_RETRIES': 2}):
+            with self.assertRaises(GCMServerError) as raised:
+                GCMMessenger(["a"], {"message": "hi"}).send_json()
+
+        self.assertEqual(raised.exception.status, 500)
+        self.assertEqual(len(session.requests), 3)
+
+    def test_ids_still_failing_after_the_retries_are_unavailable(self):
+        ## b is resent on its own, then GCM only answers with errors
+        def respond(url, values):
+            ids = values["registration_ids"]
+            if ids == ["a", "b", "c"]:
+                return results(ids, {"b": "Unavailable"})
+            return FakeResponse(500, b"")
+
+        with FakeGCM(respond).patch(), override_instapush(GCM_SETTINGS={
+                'MAX_RETRIES': 1, 'MAX_RECIPIENTS': 3}):
+            result = gcm_send_bulk_message(["a", "b", "c", "d", "e"],
+                    {"message": "hi"}, concurrency=1)
+
+        self.assertEqual(result.success, 2)
+        self.assertEqual(result.failed, dict((id_, "Unavailable")
+            for id_ in "bde"))
+        self.assertEqual(result[0]["results"][0], {"message_id": "a"})
+
+    def test_backoff_grows_exponentially_up_to_max_backoff(self):
+        with override_instapush(GCM_SETTINGS={'RETRY_BACKOFF': 1,
+                'MAX_BACKOFF': 6}):
+            messenger = GCMMessenger(["a"], {})
+            with mock.patch("instapush.libs.gcm.random.uniform",
+                    lambda low, high: high):
+                delays = [messenger._backoff_delay(attempt)
+                        for attempt in range(5)]
+
+        self.assertEqual(delays, [1, 2, 4, 6, 6])
@@ -0,0 +1,52 @@
+import zlib
+
+from django.test import SimpleTestCase
+
+from instapush.libs import gcm
+from instapush.libs.gcm import GCMMessenger, create_session, get_session
+
+from .utils import FakeGCM, mock, override_instapush
+
+
+class GCMSessionTest(SimpleTestCase):
+
+    def test_the_session_is_shared(self):
+        self.assertIs(get_session(), get_session())
+
+    def test_connections_are_pooled_up_to_pool_size(self):
+        adapter = create_session(3).get_adapter("https://android.googleapis.com")
+
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertTrue(adapter._pool_block)
+
+    def test_reloading_the_settings_closes_the_session(self):
+        session = get_session()
+        with mock.patch.object(session, "close") as close, \
+                override_instapush(GCM_SETTINGS={'POOL_SIZE': 2}):
+            close.assert_called_once_with()
+            self.assertIsNot(get_session(), session)
+            self.assertEqual(get_session().get_adapter(
+                "https://android.googleapis.com")._pool_maxsize, 2)
+
+
+class GCMRequestTest(SimpleTestCase):
+
+    def test_requests_are_gzipped_when_enabled(self):
+        with override_instapush(GCM_SETTINGS={'GZIP_REQUESTS': True}):
+            body, headers = GCMMessenger(["id"], {"message": "hello"})._headers(
+                    b'{"registration_ids":["id"]}', gcm.JSON_CONTENT_TYPE)
+
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(zlib.decompress(body, zlib.MAX_WBITS | 16),
+                b'{"registration_ids":["id"]}')
+
+    def test_bulk_sends_post_through_the_session(self):
+        session = FakeGCM()
+        with session.patch(), override_instapush(
+                GCM_SETTINGS={'GZIP_REQUESTS': True}):
+            result = gcm.gcm_send_bulk_message(["a", "b"], {"message": "hi"})
+
+        self.assertEqual(result["success"], 2)
+        self.assertEqual(session.requests, [("https://android.googleapis.com"
+            "/gcm/send", {"registration_ids": ["a", "b"],
+                "data": {"message": "hi"}})])
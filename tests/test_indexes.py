@@ -0,0 +1,73 @@
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.utils.six import StringIO
+
+from instapush.models.base import APNSDevice, GCMDevice
+
+
+TOKEN = "%064x"
+
+
+def index_names(model):
+    with connection.cursor() as cursor:
+        return set(connection.introspection.get_constraints(cursor,
+            model._meta.db_table))
+
+
+def query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return " ".join(row[-1] for row in cursor.fetchall())
+
+
+class MigrationsTest(TestCase):
+    def test_models_match_migrations(self):
+        call_command('makemigrations', 'instapush', check=True,
+                dry_run=True, stdout=StringIO())
+
+    def test_device_indexes(self):
+        self.assertIn('instapush_gcmdevice_active_app', index_names(GCMDevice))
+        self.assertIn('instapush_gcmdevice_registration_id',
+                index_names(GCMDevice))
+        self.assertIn('instapush_apnsdevice_active_app',
+                index_names(APNSDevice))
+
+    @skipUnless(connection.vendor == 'sqlite', "sqlite query plans")
+    def test_active_devices_use_partial_index(self):
+        plan = query_plan(GCMDevice.objects.active().filter(app_id='a'
+            ).order_by('pk'))
+        self.assertIn('instapush_gcmdevice_active_app', plan)
+
+    @skipUnless(connection.vendor == 'sqlite', "sqlite query plans")
+    def test_registration_ids_use_index(self):
+        plan = query_plan(GCMDevice.objects.with_registration_ids(['a', 'b']))
+        self.assertIn('instapush_gcmdevice_registration_id', plan)
+
+
+class DeviceHelpersTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        other = User.objects.create(username='other')
+        self.owned = APNSDevice.objects.create(registration_id=TOKEN % 1,
+                owner=self.user)
+        APNSDevice.objects.create(registration_id=TOKEN % 2, owner=self.user,
+                active=False)
+        APNSDevice.objects.create(registration_id=TOKEN % 3, owner=other)
+
+    def test_owned_by_returns_active_devices_of_owner(self):
+        self.assertEqual(list(APNSDevice.objects.owned_by(self.user)),
+                [self.owned])
+
+    def test_active(self):
+        self.assertEqual(APNSDevice.objects.active().count(), 2)
+
+    def test_with_registration_ids(self):
+        GCMDevice.objects.create(registration_id='a')
+        GCMDevice.objects.create(registration_id='b')
+        devices = GCMDevice.objects.with_registration_ids(iter(['a', 'c']))
+        self.assertEqual([device.registration_id for device in devices], ['a'])
@@ -0,0 +1,110 @@
+import socket
+from contextlib import closing, contextmanager
+
+from django.test import SimpleTestCase
+
+from instapush.exceptions import GCMServerError
+from instapush.libs.gcm import gcm_send_bulk_message, gcm_send_message
+from instapush.metrics import MemoryMetrics, StatsdMetrics, get_metrics
+from instapush.signals import devices_unregistered, push_failed, push_sent
+
+from .utils import FakeGCM, FakeResponse, override_instapush
+
+
+@contextmanager
+def receive(signal):
+    received = []
+
+    def receiver(sender, **kwargs):
+        received.append(dict(kwargs, sender=sender))
+
+    signal.connect(receiver)
+    try:
+        yield received
+    finally:
+        signal.disconnect(receiver)
+
+
+class MetricsBackendTest(SimpleTestCase):
+
+    def test_memory_metrics_summarize_samples(self):
+        metrics = MemoryMetrics(max_samples=100)
+        metrics.increment("gcm.requests")
+        metrics.increment("gcm.requests", 2)
+        for value in range(1, 201):
+            metrics.histogram("gcm.chunk_size", value)
+
+        snapshot = metrics.snapshot()
+
+        self.assertEqual(snapshot["counters"], {"gcm.requests": 3})
+        self.assertEqual(snapshot["histograms"]["gcm.chunk_size"], {
+            "count": 100, "min": 101, "max": 200, "mean": 150.5,
+            "p50": 151, "p95": 196, "p99": 200})
+
+    def test_timer_reports_a_timing(self):
+        metrics = MemoryMetrics()
+        with metrics.timer("apns.connect"):
+            pass
+
+        self.assertEqual(len(metrics.samples["apns.connect"]), 1)
+
+    def test_statsd_metrics_are_sent_over_udp(self):
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as server:
+            server.bind(("127.0.0.1", 0))
+            server.settimeout(1)
+            metrics = StatsdMetrics("127.0.0.1", server.getsockname()[1])
+
+            metrics.increment("gcm.requests")
+            metrics.timing("gcm.request", 0.25)
+
+            self.assertEqual(server.recv(512), b"instapush.gcm.requests:1|c")
+            self.assertEqual(server.recv(512), b"instapush.gcm.request:250|ms")
+
+    def test_backend_is_configurable(self):
+        with override_instapush(
+                METRICS_BACKEND="instapush.metrics.NullMetrics"):
+            self.assertEqual(type(get_metrics()).__name__, "NullMetrics")
+        self.assertIsInstance(get_metrics(), MemoryMetrics)
+
+
+class SendInstrumentationTest(SimpleTestCase):
+
+    def setUp(self):
+        get_metrics().reset()
+
+    def test_send_is_timed_and_signalled(self):
+        with FakeGCM().patch(), receive(push_sent) as received:
+            result = gcm_send_bulk_message(["id1", "id2"], {"message": "hi"})
+
+        counters = get_metrics().counters
+        self.assertEqual(counters["gcm.requests"], 1)
+        self.assertEqual(counters["gcm.success"], 2)
+        self.assertGreater(counters["gcm.bytes"], 0)
+        self.assertEqual(len(get_metrics().samples["gcm.send"]), 1)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0]["sender"], "gcm")
+        self.assertIs(received[0]["result"], result)
+        self.assertIsNone(received[0]["app_id"])
+
+    def test_failed_send_is_signalled(self):
+        gcm = FakeGCM(lambda url, values: FakeResponse(500, b""))
+        with gcm.patch(), receive(push_failed) as received, override_instapush(
+                GCM_SETTINGS={"MAX_RETRIES": 0}):
+            with self.assertRaises(GCMServerError):
+                gcm_send_message("id1", {"message": "hi"})
+
+            self.assertEqual(get_metrics().counters[
+                "gcm.send_errors.GCMServerError"], 1)
+        self.assertIsInstance(received[0]["exception"], GCMServerError)
+
+    def test_unregistered_ids_are_signalled(self):
+        def respond(url, values):
+            return {"multicast_id": 1, "success": 1, "failure": 1,
+                    "canonical_ids": 0, "results": [{"message_id": "1"},
+                        {"error": "NotRegistered"}]}
+
+        with FakeGCM(respond).patch(), receive(devices_unregistered) as received:
+            gcm_send_bulk_message(["id1", "id2"], {"message": "hi"})
+
+        self.assertEqual(received[0]["registration_ids"], ["id2"])
+        self.assertEqual(get_metrics().counters["gcm.unregistered"], 1)
@@ -0,0 +1,26 @@
+import sys
+
+from django.test import SimpleTestCase
+
+from instapush.models.mongo import APNSDevice, OwnerField
+
+from .utils import override_instapush
+
+
+class OwnerFieldTest(SimpleTestCase):
+
+    def test_owner_document_is_imported_on_first_use(self):
+        field = OwnerField()
+
+        with override_instapush(DEVICE_OWNER_MODEL='tests.owners.Owner'):
+            self.assertNotIn('tests.owners', sys.modules)
+            document_type = field.document_type
+
+        from .owners import Owner
+        self.assertIs(document_type, Owner)
+        self.assertIs(field.document_type, Owner)
+
+    def test_devices_refer_to_their_owner_lazily(self):
+        ## importing the documents did not need DEVICE_OWNER_MODEL, which
+        ## is a django model label in the tests
+        self.assertIsInstance(APNSDevice._fields['owner'], OwnerField)
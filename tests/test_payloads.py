@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.test import SimpleTestCase
+
+from instapush import payloads
+from instapush.payloads import PayloadTemplate, compile_template
+
+from .utils import override_instapush
+
+
+PAYLOAD = {"aps": {"alert": u"Hello $name, ${count}$$ off", "badge": "$count"},
+        "data": "$data"}
+
+
+class PayloadTemplateTest(SimpleTestCase):
+
+    def setUp(self):
+        payloads._cache.clear()
+
+    def test_render_matches_encoding_the_filled_payload(self):
+        template = PayloadTemplate(PAYLOAD)
+        variables = {"name": u"Zoë \"Z\"", "count": 3, "data": {"id": [1, None]}}
+
+        rendered = template.render(variables)
+
+        self.assertEqual(json.loads(rendered.decode("utf-8")),
+                template.fill(variables))
+        self.assertEqual(json.loads(rendered.decode("utf-8")), {
+            "aps": {"alert": u"Hello Zoë \"Z\", 3$ off", "badge": 3},
+            "data": {"id": [1, None]},
+        })
+
+    def test_static_payload_renders_its_bytes(self):
+        template = PayloadTemplate({"aps": {"alert": "Hi"}})
+
+        self.assertEqual(template.render(), b'{"aps":{"alert":"Hi"}}')
+        self.assertEqual(template.static_size, len(template.render()))
+
+    def test_render_enforces_max_size(self):
+        template = PayloadTemplate(PAYLOAD, max_size=60,
+                overflow_error=OverflowError)
+
+        template.render({"name": "Al", "count": 1, "data": None})
+        with self.assertRaises(OverflowError):
+            template.render({"name": "A" * 40, "count": 1, "data": None})
+
+    def test_invalid_placeholder_is_rejected(self):
+        with self.assertRaises(ValueError):
+            PayloadTemplate({"alert": "costs $ 5"})
+
+    def test_compiled_templates_are_cached(self):
+        first = compile_template(PAYLOAD)
+
+        self.assertIs(compile_template(dict(PAYLOAD)), first)
+        self.assertIsNot(compile_template(PAYLOAD, max_size=256), first)
+
+    def test_least_recently_used_templates_are_evicted(self):
+        with override_instapush(TEMPLATE_CACHE_SIZE=2):
+            first = compile_template({"alert": "1"})
+            compile_template({"alert": "2"})
+            compile_template({"alert": "1"})
+            compile_template({"alert": "3"})
+
+            self.assertIs(compile_template({"alert": "1"}), first)
+            self.assertEqual(len(payloads._cache), 2)
+            self.assertNotIn(json.dumps({"alert": "2"}),
+                    [key[0] for key in payloads._cache])
@@ -0,0 +1,49 @@
+from django.test import TestCase
+
+from instapush.models import GCMDevice
+
+from .utils import FakeGCM, override_instapush
+
+
+class DevicePagesTest(TestCase):
+
+    def setUp(self):
+        self.devices = [GCMDevice.objects.create(registration_id="id%d" % index)
+                for index in range(7)]
+
+    def test_pages_are_fetched_in_pk_order_one_query_each(self):
+        pages = GCMDevice.objects.all().iter_device_pages(3)
+
+        ## the last page is known to be the last once a query comes back empty
+        with self.assertNumQueries(4):
+            pages = list(pages)
+
+        self.assertEqual(pages, [[(device.pk, device.registration_id)
+            for device in self.devices[start:start + 3]]
+            for start in range(0, 7, 3)])
+
+    def test_pages_start_after_the_given_pk(self):
+        pages = list(GCMDevice.objects.all().iter_device_pages(10,
+            after=self.devices[4].pk))
+
+        self.assertEqual(pages, [[(device.pk, device.registration_id)
+            for device in self.devices[5:]]])
+
+    def test_registration_id_pages_of_a_filtered_queryset(self):
+        GCMDevice.objects.filter(pk=self.devices[1].pk).update(active=False)
+
+        pages = list(GCMDevice.objects.active().iter_registration_id_pages(4))
+
+        self.assertEqual(pages, [["id0", "id2", "id3", "id4"], ["id5", "id6"]])
+
+    def test_send_message_posts_a_request_per_page(self):
+        session = FakeGCM()
+
+        with session.patch(), override_instapush(
+                GCM_SETTINGS={'MAX_RECIPIENTS': 3}):
+            result = GCMDevice.objects.all().send_message("hello")
+
+        self.assertEqual(result.success, 7)
+        self.assertEqual([values["registration_ids"] for _, values
+            in session.requests], [["id0", "id1", "id2"],
+                ["id3", "id4", "id5"], ["id6"]])
@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import TestCase
+
+from instapush import queue
+from instapush.queue.backends import DatabaseBackend, SQLiteBackend
+from instapush.queue.worker import Worker
+
+from .utils import mock
+
+
+CALLS = []
+
+
+def record(value, fail=False):
+    CALLS.append(value)
+    if fail:
+        raise ValueError(value)
+
+
+def outlive_lease(seconds, path):
+    time.sleep(seconds)
+    ## another worker tries to claim the job still running
+    CALLS.append(SQLiteBackend(path).claim(60))
+
+
+class BackendTests(object):
+    """
+    The behaviour every queue backend implements
+    """
+
+    def test_claim_leases_the_oldest_job(self):
+        first = self.backend.push('task', '1')
+        self.backend.push('task', '2')
+
+        job = self.backend.claim(60)
+        self.assertEqual((job.id, job.payload, job.attempts), (first, '1', 1))
+        self.assertEqual(self.backend.claim(60).payload, '2')
+        self.assertIsNone(self.backend.claim(60))
+
+    def test_expired_lease_hands_the_job_out_again(self):
+        self.backend.push('task', '1')
+        self.backend.claim(0.01)
+        time.sleep(0.05)
+
+        job = self.backend.claim(60)
+        self.assertEqual((job.payload, job.attempts), ('1', 2))
+
+    def test_extended_lease_keeps_the_job(self):
+        self.backend.push('task', '1')
+        job = self.backend.claim(0.01)
+
+        self.assertTrue(self.backend.extend(job, 60))
+        time.sleep(0.05)
+        self.assertIsNone(self.backend.claim(60))
+
+    def test_lease_of_a_job_claimed_again_is_not_extended(self):
+        self.backend.push('task', '1')
+        job = self.backend.claim(0.01)
+        time.sleep(0.05)
+        self.backend.claim(60)
+
+        self.assertFalse(self.backend.extend(job, 60))
+
+    def test_acked_job_is_removed(self):
+        self.backend.push('task', '1')
+        self.backend.ack(self.backend.claim(60))
+        self.assertIsNone(self.backend.claim(0))
+
+    def test_retried_job_waits_for_its_delay(self):
+        self.backend.push('task', '1')
+        self.backend.retry(self.backend.claim(60), 60, 'error')
+        self.assertIsNone(self.backend.claim(60))
+
+    def test_buried_job_is_not_run_again(self):
+        self.backend.push('task', '1')
+        self.backend.bury(self.backend.claim(0), 'error')
+        time.sleep(0.01)
+        self.assertIsNone(self.backend.claim(60))
+
+
+class DatabaseBackendTest(BackendTests, TestCase):
+    def setUp(self):
+        self.backend = DatabaseBackend()
+
+
+class SQLiteBackendTest(BackendTests, TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.backend = SQLiteBackend(os.path.join(directory, 'queue.sqlite3'))
+
+
+class WorkerTest(TestCase):
+    def setUp(self):
+        del CALLS[:]
+        self.backend = DatabaseBackend()
+        for patcher in (mock.patch.dict(queue.TASKS,
+                {'record': 'tests.test_queue.record'}),
+                ## workers handle SIGTERM and SIGINT, the test runner too
+                mock.patch('signal.signal')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def worker(self, **kwargs):
+        return Worker(backend=self.backend, burst=True, **kwargs)
+
+    def test_enqueue_rejects_unregistered_tasks(self):
+        self.assertRaises(ValueError, queue.enqueue, 'os.system', command='')
+
+    def test_runs_and_acks_jobs(self):
+        queue.enqueue('record', value=1)
+        queue.enqueue('record', value=2)
+        self.worker().run()
+
+        self.assertEqual(CALLS, [1, 2])
+        self.assertIsNone(self.backend.claim(0))
+
+    def test_failed_job_is_retried_with_backoff(self):
+        queue.enqueue('record', value=1, fail=True)
+        with mock.patch.object(self.backend, 'retry',
+                wraps=self.backend.retry) as retry:
+            self.worker().run()
+
+        self.assertEqual(CALLS, [1])
+        job, delay, error = retry.call_args[0]
+        self.assertEqual(delay, 2)
+        self.assertIn('ValueError', error)
+
+    def test_job_is_buried_after_max_attempts(self):
+        queue.enqueue('record', value=1, fail=True)
+        worker = self.worker(max_attempts=1)
+        with mock.patch.object(self.backend, 'bury',
+                wraps=self.backend.bury) as bury:
+            worker.run()
+
+        self.assertTrue(bury.called)
+        self.assertTrue(self.backend.model.objects.get().failed)
+
+    def test_lease_is_extended_while_the_job_runs(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'queue.sqlite3')
+        backend = SQLiteBackend(path)
+        backend.push('outlive_lease', json.dumps({'seconds': 0.3,
+            'path': path}))
+
+        with mock.patch.dict(queue.TASKS,
+                {'outlive_lease': 'tests.test_queue.outlive_lease'}):
+            Worker(backend=backend, lease=0.1, burst=True).run()
+
+        self.assertEqual(CALLS, [None])
+        self.assertIsNone(backend.claim(0))
@@ -0,0 +1,144 @@
+from django.core.cache import caches
+from django.test import SimpleTestCase
+
+from instapush.ratelimit import (
+    CacheBackend,
+    LocalBackend,
+    RateLimiter,
+    get_rate_limiter,
+)
+
+from .utils import mock, override_instapush
+
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch("instapush.ratelimit.time.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class LocalBackendTest(RateLimitTestCase):
+
+    def test_bucket_holds_one_second_of_tokens(self):
+        backend = LocalBackend()
+
+        self.assertEqual(backend.take("key", 10, 10), 0)
+        self.assertEqual(backend.take("key", 5, 10), 0.5)
+
+    def test_bucket_refills_at_rate(self):
+        backend = LocalBackend()
+        backend.take("key", 10, 10)
+
+        self.clock.now += 0.5
+        self.assertEqual(backend.take("key", 5, 10), 0)
+        self.assertGreater(backend.take("key", 1, 10), 0)
+
+    def test_buckets_are_kept_per_key(self):
+        backend = LocalBackend()
+        backend.take("key", 10, 10)
+
+        self.assertEqual(backend.take("other", 10, 10), 0)
+
+
+class CacheBackendTest(RateLimitTestCase):
+
+    def setUp(self):
+        super(CacheBackendTest, self).setUp()
+        caches["default"].clear()
+
+    def test_tokens_are_counted_per_one_second_window(self):
+        backend = CacheBackend()
+        self.clock.now = 1000.25
+
+        self.assertEqual(backend.take("key", 8, 10), 0)
+        self.assertEqual(backend.take("key", 4, 10), 0.75)
+
+        self.clock.now = 1001.0
+        self.assertEqual(backend.take("key", 4, 10), 0)
+
+    def test_refused_tokens_are_given_back(self):
+        backend = CacheBackend()
+
+        self.assertEqual(backend.take("key", 8, 10), 0)
+        self.assertGreater(backend.take("key", 11, 10), 0)
+        self.assertGreater(backend.take("key", 4, 10), 0)
+        self.assertEqual(backend.take("key", 2, 10), 0)
+
+
+class RateLimiterTest(RateLimitTestCase):
+
+    def test_tokens_are_taken_in_blocks_of_a_tenth_of_the_rate(self):
+        backend = mock.Mock(wraps=LocalBackend())
+        limiter = RateLimiter("key", 100, backend)
+
+        for _ in range(10):
+            self.assertEqual(limiter.reserve(), 0)
+
+        backend.take.assert_called_once_with("key", 10, 100.0)
+
+    def test_counts_above_the_rate_are_taken_over_several_seconds(self):
+        limiter = RateLimiter("key", 10, CacheBackend())
+        caches["default"].clear()
+
+        self.assertEqual(limiter.reserve(25), 1)
+        self.clock.now += 1
+        self.assertEqual(limiter.reserve(25), 1)
+        self.clock.now += 1
+        self.assertEqual(limiter.reserve(25), 0)
+
+    def test_reserve_returns_the_time_to_wait(self):
+        limiter = RateLimiter("key", 10, LocalBackend())
+
+        self.assertEqual(limiter.reserve(10), 0)
+        self.assertEqual(limiter.reserve(1), 0.1)
+
+    def test_throttling_halves_the_rate_once_per_cooldown(self):
+        limiter = RateLimiter("key", 100, LocalBackend(), min_rate=30)
+
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 50)
+
+        self.clock.now += RateLimiter.COOLDOWN
+        limiter.throttled()
+        ## never below min_rate
+        self.assertEqual(limiter.rate, 30)
+
+    def test_rate_recovers_after_throttling(self):
+        limiter = RateLimiter("key", 100, LocalBackend())
+        limiter.throttled()
+
+        self.clock.now += 2
+        limiter.reserve()
+        self.assertEqual(limiter.rate, 60)
+
+        self.clock.now += 60
+        limiter.reserve()
+        self.assertEqual(limiter.rate, 100)
+
+
+class GetRateLimiterTest(SimpleTestCase):
+
+    def test_no_limiter_without_a_rate_limit(self):
+        self.assertIsNone(get_rate_limiter('GCM_SETTINGS', 'api key'))
+
+    def test_limiter_is_shared_per_credential(self):
+        with override_instapush(GCM_SETTINGS={'RATE_LIMIT': 50}):
+            limiter = get_rate_limiter('GCM_SETTINGS', 'api key')
+
+            self.assertIs(get_rate_limiter('GCM_SETTINGS', 'api key'), limiter)
+            self.assertIsNot(get_rate_limiter('GCM_SETTINGS', 'other key'),
+                    limiter)
+            self.assertEqual(limiter.max_rate, 50)
+            self.assertNotIn('api key', limiter.key)
@@ -0,0 +1,31 @@
+from django.test import SimpleTestCase
+
+from instapush.settings import APNS_SETTINGS, Settings
+
+from .utils import override_instapush
+
+
+class SettingsTest(SimpleTestCase):
+
+    def test_settings_are_loaded_on_first_access(self):
+        settings = Settings()
+        self.assertIsNone(settings._values)
+
+        self.assertEqual(settings['GCM_SETTINGS']['API_KEY'], 'tests')
+        self.assertEqual(settings['APNS_SETTINGS']['PORT'], 2195)
+
+    def test_reload_runs_the_callbacks_and_loads_again(self):
+        settings = Settings()
+        reloaded = []
+        settings.on_reload(lambda: reloaded.append(True))
+        first = settings._get()
+
+        settings.reload()
+
+        self.assertEqual(reloaded, [True])
+        self.assertIsNot(settings._get(), first)
+
+    def test_sections_follow_overridden_settings(self):
+        with override_instapush(APNS_SETTINGS={'POOL_SIZE': 3}):
+            self.assertEqual(APNS_SETTINGS['POOL_SIZE'], 3)
+        self.assertNotEqual(APNS_SETTINGS['POOL_SIZE'], 3)
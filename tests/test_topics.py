@@ -0,0 +1,101 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from instapush.exceptions import GCMPushError
+from instapush.models.base import GCMDevice, GCMDeviceGroup
+
+from .utils import FakeGCM, FakeResponse, override_instapush
+
+
+class TopicTest(TestCase):
+    def setUp(self):
+        self.devices = [GCMDevice.objects.create(registration_id='r%d' % index)
+                for index in range(3)]
+
+    def test_subscribe_records_accepted_devices(self):
+        def respond(url, values):
+            return {'results': [{'error': 'INVALID_ARGUMENT'}
+                if token == 'r1' else {} for token in
+                values['registration_tokens']]}
+
+        gcm = FakeGCM(respond)
+        with gcm.patch():
+            failed = GCMDevice.objects.all().subscribe('news')
+
+        self.assertEqual(failed, {'r1': 'INVALID_ARGUMENT'})
+        url, values = gcm.requests[0]
+        self.assertTrue(url.endswith(':batchAdd'))
+        self.assertEqual(values['to'], '/topics/news')
+        self.assertEqual(set(GCMDevice.objects.subscribed_to('news')),
+                set([self.devices[0], self.devices[2]]))
+
+    def test_unsubscribe_removes_records(self):
+        with FakeGCM().patch():
+            GCMDevice.objects.all().subscribe('news')
+            self.devices[0].unsubscribe('news')
+
+        self.assertEqual(set(GCMDevice.objects.subscribed_to('news')),
+                set(self.devices[1:]))
+
+    def test_subscribing_twice_records_once(self):
+        with FakeGCM().patch():
+            self.devices[0].subscribe('news')
+            self.devices[0].subscribe('news')
+        self.assertEqual(self.devices[0].topic_subscriptions.count(), 1)
+
+    def test_topic_message_is_a_single_request(self):
+        from instapush.libs.gcm import gcm_send_topic_message
+
+        gcm = FakeGCM()
+        with gcm.patch():
+            gcm_send_topic_message('news', {'message': 'hi'})
+        self.assertEqual(gcm.requests, [(gcm.requests[0][0],
+            {'to': '/topics/news', 'data': {'message': 'hi'}})])
+
+    def test_topic_error_raises(self):
+        from instapush.libs.gcm import gcm_send_topic_message
+
+        with FakeGCM(lambda url, values: {'error': 'InvalidParameters'}
+                ).patch():
+            self.assertRaises(GCMPushError, gcm_send_topic_message, 'news',
+                    {'message': 'hi'})
+
+
+@override_instapush(GCM_SETTINGS={'SENDER_ID': 42})
+class DeviceGroupTest(TestCase):
+    def setUp(self):
+        self.devices = [GCMDevice.objects.create(registration_id='r%d' % index)
+                for index in range(3)]
+
+    def test_create_group(self):
+        gcm = FakeGCM()
+        with gcm.patch():
+            group = GCMDeviceGroup.objects.create_group('friends',
+                    self.devices[:2])
+
+        self.assertEqual(group.notification_key, 'key-friends')
+        self.assertEqual(set(group.devices.all()), set(self.devices[:2]))
+        self.assertEqual(gcm.requests[0][1]['registration_ids'], ['r0', 'r1'])
+
+    def test_add_and_remove_devices(self):
+        with FakeGCM().patch():
+            group = GCMDeviceGroup.objects.create_group('friends',
+                    self.devices[:1])
+            group.add_devices(self.devices[1:])
+            group.remove_devices(self.devices[:1])
+
+        self.assertEqual(set(group.devices.all()), set(self.devices[1:]))
+
+    def test_failed_creation_records_nothing(self):
+        error = FakeResponse(400, {'error': 'notification_key already exists'})
+        with FakeGCM(lambda url, values: error).patch():
+            self.assertRaises(GCMPushError,
+                    GCMDeviceGroup.objects.create_group, 'friends',
+                    self.devices)
+        self.assertFalse(GCMDeviceGroup.objects.exists())
+
+    def test_groups_require_sender_id(self):
+        with override_instapush(GCM_SETTINGS={'SENDER_ID': None}):
+            self.assertRaises(ImproperlyConfigured,
+                    GCMDeviceGroup.objects.create_group, 'friends',
+                    self.devices)
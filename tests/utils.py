@@ -0,0 +1,347 @@
+import copy
+import json
+import socket
+import struct
+import threading
+import time
+import zlib
+from binascii import hexlify
+from contextlib import closing, contextmanager
+
+from django.conf import settings
+from django.test import override_settings
+
+from instapush.libs.apns import APNSConnection
+
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+
+def override_instapush(**values):
+    """
+    Returns override_settings replacing INSTAPUSH_SETTINGS with a copy
+    updated with values. The provider settings dictionaries, e.g.
+    GCM_SETTINGS, are updated rather than replaced.
+    """
+
+    instapush_settings = copy.deepcopy(settings.INSTAPUSH_SETTINGS)
+    for key, value in values.items():
+        if key.endswith('_SETTINGS'):
+            instapush_settings.setdefault(key, {}).update(value)
+        else:
+            instapush_settings[key] = value
+    return override_settings(INSTAPUSH_SETTINGS=instapush_settings)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.content = body
+
+    def raise_for_status(self):
+        from requests import HTTPError
+        if self.status_code >= 400:
+            raise HTTPError(response=self)
+
+
+class FakeGCM(object):
+    """
+    Stands in for the requests session GCM is posted to. Each post is
+    recorded as a (url, values) tuple and answered by respond(url,
+    values), which returns a FakeResponse or the json body of a 200
+    response; by default every registration id is accepted.
+    """
+
+    def __init__(self, respond=None):
+        self.requests = []
+        self.respond = respond or self.accept
+
+    @staticmethod
+    def accept(url, values):
+        ids = values.get('registration_ids') or values.get(
+                'registration_tokens')
+        if 'notification_key_name' in values:
+            return {'notification_key': 'key-%s' % values[
+                'notification_key_name']}
+        if ids is None:
+            return {'message_id': 1}
+        return {'multicast_id': 1, 'success': len(ids), 'failure': 0,
+                'canonical_ids': 0, 'results': [{'message_id': str(index)}
+                    for index, _ in enumerate(ids)]}
+
+    def post(self, url, data, headers, timeout=None):
+        if headers.get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, zlib.MAX_WBITS | 16)
+        values = json.loads(data.decode('utf-8')) \
+                if headers['Content-Type'].startswith('application/json') \
+                else data.decode('utf-8')
+        self.requests.append((url, values))
+
+        response = self.respond(url, values)
+        if not isinstance(response, FakeResponse):
+            response = FakeResponse(body=response)
+        return response
+
+    def close(self):
+        pass
+
+    def patch(self):
+        """
+        Returns a patch of the session of the gcm senders
+        """
+        return mock.patch('instapush.libs.gcm.get_session', return_value=self)
+
+
+class FakeSocket(socket.socket):
+    """
+    A plain socket standing in for the TLS socket of a connection
+    """
+
+    def pending(self):
+        return 0
+
+
+class FakeGateway(object):
+    """
+    Plays the binary APNS gateway at the other end of socket pairs. A
+    frame to a token in reject gets an invalid token error response, and
+    once the frame shutdown_after was accepted a shutdown one, latency
+    seconds later, after which the connection is closed as APNS does.
+    Accepted frames are recorded as (identifier, token) tuples.
+    """
+
+    def __init__(self, reject=(), shutdown_after=None, latency=0):
+        self.reject = set(reject)
+        self.shutdown_after = shutdown_after
+        self.latency = latency
+        self.frames = []
+        self.connections = 0
+
+    def connect(self):
+        sock, peer = socket.socketpair()
+        self.connections += 1
+        thread = threading.Thread(target=self.serve, args=(peer,))
+        thread.daemon = True
+        thread.start()
+        return FakeSocket(fileno=sock.detach())
+
+    def serve(self, peer):
+        header = struct.Struct("!BI")
+        buffered = b""
+
+        with closing(peer):
+            while True:
+                data = peer.recv(65536)
+                if not data:
+                    return
+                buffered += data
+
+                while len(buffered) >= header.size:
+                    length = header.unpack_from(buffered)[1] + header.size
+                    if len(buffered) < length:
+                        break
+                    identifier, token = self.parse(buffered[header.size:length])
+                    buffered = buffered[length:]
+
+                    if token in self.reject:
+                        time.sleep(self.latency)
+                        peer.sendall(struct.pack("!BBI", 8, 8, identifier))
+                        return
+                    self.frames.append((identifier, token))
+                    if identifier == self.shutdown_after:
+                        self.shutdown_after = None
+                        time.sleep(self.latency)
+                        peer.sendall(struct.pack("!BBI", 8, 10, identifier))
+                        return
+
+    @staticmethod
+    def parse(frame):
+        items = {}
+        offset = 0
+        while offset < len(frame):
+            item, length = struct.unpack_from("!BH", frame, offset)
+            items[item] = frame[offset + 3:offset + 3 + length]
+            offset += 3 + length
+        return (struct.unpack("!I", items[3])[0],
+                hexlify(items[1]).decode("ascii"))
+
+
+class FakeAPNSConnection(APNSConnection):
+    """
+    An APNSConnection to a FakeGateway
+    """
+
+    def __init__(self, gateway):
+        super(FakeAPNSConnection, self).__init__(('localhost', 2195),
+                'cert.pem')
+        self.gateway = gateway
+
+    def connect(self):
+        self.close()
+        self.socket = self.gateway.connect()
+        self.last_used = time.time()
+
+
+def patch_apns(gateway):
+    """
+    Returns a patch of the binary APNS senders connecting to gateway
+    """
+
+    @contextmanager
+    def connection(**kwargs):
+        connection = FakeAPNSConnection(gateway)
+        connection.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    return mock.patch('instapush.libs.apns._apns_push_connection', connection)
+
+
+class FakeHTTP2Gateway(object):
+    """
+    Plays the HTTP/2 provider API at the other end of socket pairs,
+    answering each stream with responses.get(token, (200, None)), a
+    (status, reason) tuple, or never if that is None, delays[token]
+    seconds after the stream ended. A list of responses answers the
+    streams of that token in turn, repeating the last one. With goaway
+    set to (count, last_stream_id), the first connection to receive
+    count streams sends a GOAWAY for last_stream_id instead of answering
+    them.
+    Every stream received is recorded as a (connection, stream_id, token)
+    tuple.
+    """
+
+    def __init__(self, responses=None, goaway=None, delays=None):
+        self.responses = responses or {}
+        self.goaway = goaway
+        self.delays = delays or {}
+        self.streams = []
+        self.connections = 0
+        self.lock = threading.RLock()
+
+    def connect(self):
+        sock, peer = socket.socketpair()
+        self.connections += 1
+        thread = threading.Thread(target=self.serve,
+                args=(peer, self.connections))
+        thread.daemon = True
+        thread.start()
+        return FakeSocket(fileno=sock.detach())
+
+    def serve(self, peer, number):
+        import h2.config
+        import h2.connection
+
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(
+            client_side=False, header_encoding="utf-8"))
+        conn.initiate_connection()
+        peer.sendall(conn.data_to_send())
+
+        with closing(peer):
+            try:
+                self.answer(conn, peer, number)
+            except socket.error:
+                ## the client hung up
+                pass
+
+    def answer(self, conn, peer, number):
+        import h2.events
+
+        paths = {}
+        ended = []
+        while True:
+            data = peer.recv(65535)
+            if not data:
+                return
+
+            with self.lock:
+                events = conn.receive_data(data)
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    paths[event.stream_id] = dict(event.headers)[":path"]
+                elif isinstance(event, h2.events.DataReceived):
+                    with self.lock:
+                        conn.acknowledge_received_data(
+                                event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    token = paths.pop(event.stream_id).rsplit("/", 1)[1]
+                    self.streams.append((number, event.stream_id, token))
+                    ended.append((event.stream_id, token))
+
+            ## streams are held unanswered until the GOAWAY is sent
+            with self.lock:
+                if self.goaway and len(ended) >= self.goaway[0]:
+                    conn.close_connection(last_stream_id=self.goaway[1])
+                    self.goaway = None
+                    peer.sendall(conn.data_to_send())
+                    return
+                peer.sendall(conn.data_to_send())
+            if self.goaway:
+                continue
+
+            for stream_id, token in ended:
+                if token in self.delays:
+                    timer = threading.Timer(self.delays[token], self.respond,
+                            args=(conn, peer, stream_id, token))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    self.respond(conn, peer, stream_id, token)
+            del ended[:]
+
+    def respond(self, conn, peer, stream_id, token):
+        with self.lock:
+            self.build_response(conn, stream_id, token)
+            try:
+                peer.sendall(conn.data_to_send())
+            except socket.error:
+                pass
+
+    def build_response(self, conn, stream_id, token):
+        response = self.responses.get(token, (200, None))
+        if isinstance(response, list):
+            response = response.pop(0) if len(response) > 1 else response[0]
+        if response is None:
+            return
+
+        status, reason = response
+        if reason is None:
+            conn.send_headers(stream_id, [(":status", str(status))],
+                    end_stream=True)
+            return
+        body = json.dumps({"reason": reason}).encode("utf-8")
+        conn.send_headers(stream_id, [(":status", str(status)),
+            ("content-length", str(len(body)))])
+        conn.send_data(stream_id, body, end_stream=True)
+
+
+def patch_apns_http2(gateway):
+    """
+    Returns a patch of the HTTP/2 APNS senders connecting to gateway
+    """
+
+    from instapush.libs.apns_http2 import APNSHTTP2Connection
+
+    class FakeAPNSHTTP2Connection(APNSHTTP2Connection):
+        def _connect(self):
+            self.socket = gateway.connect()
+            self._handshake()
+
+    @contextmanager
+    def connection(**kwargs):
+        connection = FakeAPNSHTTP2Connection(('localhost', 443), 'cert.pem')
+        connection.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    return mock.patch('instapush.libs.apns_http2._apns_http2_connection',
+            connection)